@@ -1,46 +1,103 @@
 import argparse
 import asyncio
 from datetime import datetime
-import httpx
 import json
+import time
 from tqdm import tqdm
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
+from cache_experiment import CacheExperiment, add_cache_arguments
+from capacity_finder import CapacityFinder, add_capacity_arguments, get_probe_key
+from client_pool import ClientPool, add_client_pool_arguments
+from compression import CompressionMatrix, Decompressor, add_compression_arguments, add_compression_fields, check_encodings, encode_request
+from event_loop import add_event_loop_arguments, run
 from generate_message import generate_ara_message
+from load_profiles import ProfileRunner, StageRecord, get_stage_key, get_stage_stats, load_profile
+from harness_monitor import HarnessMonitor, add_harness_monitor_arguments
+from live_metrics import LiveMetrics, add_live_metrics_arguments
+from load_scheduler import add_load_arguments, run_burst, run_open_loop
+from payload_cache import JSON_HEADERS, encode_payload
+from query_generator import QueryGenerator, add_query_generator_arguments
+from result_stats import ResultStats
+from request_errors import classify, deadline
+from request_trace import TraceWriter, add_trace_arguments
+from request_timing import AsyncRequestTimer
+from results_sink import ResultsSink
+from results_store import add_results_store_arguments, check_format, write_columns
+from trapi_stream import TrapiReader, add_trapi_stream_arguments, empty_counts
 
-with open("aras.json", "r") as f:
-    aras = json.load(f)
+# filled from --targets
+aras = {}
 
 output = {
     "sequential": {},
     "concurrent": {},
+    "open_loop": {},
+    "profile": {},
+    "capacity": {},
+    "cache": {},
+    "compression": {},
 }
 
+client_pool = ClientPool(timeout=60, read_timeout=300, deadline=300)
+results_sink = ResultsSink()
+trapi_reader = TrapiReader()
+trace_writer = TraceWriter()
+live_metrics = LiveMetrics()
+harness_monitor = HarnessMonitor()
+query_generator = QueryGenerator()
 
-async def lookup(url: str) -> Dict[str, Any]:
-    """Run a single query lookup asynchronously."""
-    query = generate_ara_message()
-    status = "timeout"
-    start_time = datetime.now()
+
+async def lookup(url: str, bypass_cache: bool = True, request_encoding: Optional[str] = None, accept_encoding: Optional[str] = None) -> Dict[str, Any]:
+    """Run a single query lookup asynchronously, compressed or asking for a compressed response when given encodings."""
+    shape = None
+    if query_generator.enabled:
+        shape, query = query_generator.next(bypass_cache)
+    else:
+        query = encode_payload(generate_ara_message(bypass_cache))
+    status = None
+    error = None
+    counts = empty_counts()
+    trace_writer.write(url, query)
+    query, headers, compress_time = encode_request(query, JSON_HEADERS, request_encoding, accept_encoding)
+    timer = AsyncRequestTimer()
+    decompressor = None
     try:
-        async with httpx.AsyncClient(timeout=3600) as client:
-            response = await client.post(
-                url,
-                json=query,
-            )
-            status = response.status_code
-            response.raise_for_status()
-            response = response.json()
-            num_results = len((response.get("message") or {}).get("results") or [])
+        async with deadline(client_pool.deadline):
+            async with client_pool.client(url) as client:
+                async with client.stream(
+                    "POST",
+                    url,
+                    content=query,
+                    headers=headers,
+                    extensions={"trace": timer},
+                ) as response:
+                    status = response.status_code
+                    response.raise_for_status()
+                    if accept_encoding is not None:
+                        decompressor = Decompressor(response.headers.get("content-encoding"))
+                    counts = await trapi_reader.read(response, timer, decompressor=decompressor)
     except Exception as e:
-        num_results = 0
+        error = e
+        counts = empty_counts()
 
-    stop_time = datetime.now()
+    timer.stop()
+    client_pool.record(url, timer.new_connection)
+    error_class = classify(error, status)
     result = {
-        "status": status,
-        "num_results": num_results,
-        "response_time": (stop_time - start_time).total_seconds(),
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": timer.phases(),
+        "completed_at": time.time(),
     }
+    if accept_encoding is not None:
+        add_compression_fields(result, query, compress_time, decompressor)
+    if shape is not None:
+        result["query_shape"] = shape
+        query_generator.record(url, shape, result)
     return result
 
 
@@ -48,24 +105,14 @@ async def run_sequential(infores: str, ara: dict, output_filename: str):
     """Send squential queries to kps."""
     if infores not in output["sequential"]:
         output["sequential"][infores] = {}
-    results = []
+    stats = ResultStats()
     start_time = datetime.now()
-    for ndx in tqdm(range(0, 15)):
+    for ndx in tqdm(range(0, 15), disable=live_metrics.dashboard):
         result = await lookup(ara["url"])
-        results.append(result)
+        results_sink.record(stats, result, mode="sequential", target=infores, stage=15)
     end_time = datetime.now()
-    result_stats = {
-        "total_time": (end_time - start_time).total_seconds(),
-        "total_results": 0,
-        "statuses": {},
-        "results": results,
-    }
-    for result in results:
-        result_stats["total_results"] += result["num_results"]
-        if result["status"] not in result_stats["statuses"]:
-            result_stats["statuses"][result["status"]] = 1
-        else:
-            result_stats["statuses"][result["status"]] += 1
+    result_stats = stats.to_dict((end_time - start_time).total_seconds())
+    result_stats["harness"] = harness_monitor.check(f"sequential {infores} 15", stats.start_time)
     output["sequential"][infores] = result_stats
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
@@ -80,21 +127,12 @@ async def run_concurrent(infores: str, ara: dict, output_filename: str):
         queries = []
         for ndx in range(0, num):
             queries.append(lookup(ara["url"]))
+        stats = ResultStats()
         start_time = datetime.now()
-        results = await asyncio.gather(*queries, return_exceptions=True)
+        await run_burst(queries, lambda result: results_sink.record(stats, result, mode="concurrent", target=infores, stage=num))
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
+        result_stats = stats.to_dict((end_time - start_time).total_seconds())
+        result_stats["harness"] = harness_monitor.check(f"concurrent {infores} {num}", stats.start_time)
         output["concurrent"][infores][num] = result_stats
         with open(output_filename, "w") as f:
             json.dump(output, f, indent = 2)
@@ -102,24 +140,202 @@ async def run_concurrent(infores: str, ara: dict, output_filename: str):
         await asyncio.sleep(30)
 
 
+async def run_rate(infores: str, ara: dict, args: argparse.Namespace, output_filename: str):
+    """Send queries at a steady arrival rate."""
+    print(f"Sending {args.rate} requests/s to {infores} for {args.duration}s")
+    stats = ResultStats()
+    start_time = datetime.now()
+    rate_stats = await run_open_loop(
+        lambda: lookup(ara["url"]),
+        lambda result: results_sink.record(stats, result, mode="open_loop", target=infores, stage=args.rate),
+        args.rate,
+        args.duration,
+        arrival=args.arrival,
+        max_in_flight=args.max_in_flight,
+        seed=args.seed,
+    )
+    end_time = datetime.now()
+    result_stats = stats.to_dict((end_time - start_time).total_seconds())
+    result_stats["rate"] = rate_stats
+    result_stats["harness"] = harness_monitor.check(f"open loop {infores} {args.rate}", stats.start_time)
+    output["open_loop"][infores] = result_stats
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_profile(infores: str, ara: dict, stages: List[Dict[str, Any]], args: argparse.Namespace, output_filename: str):
+    """Drive a load profile."""
+    print(f"Running load profile against {infores}")
+    output["profile"][infores] = {}
+
+    async def send(stage: Dict[str, Any]) -> Dict[str, Any]:
+        return await lookup(ara["url"])
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="profile", target=infores, stage=get_stage_key(record.index, record.stage))
+
+    def on_stage_done(record: StageRecord):
+        result_stats = record.stats.to_dict(record.end_time - record.start_time)
+        result_stats["stage"] = get_stage_stats(record)
+        result_stats["harness"] = harness_monitor.check(f"profile {infores} {get_stage_key(record.index, record.stage)}", record.stats.start_time)
+        output["profile"][infores][get_stage_key(record.index, record.stage)] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    runner = ProfileRunner(send, stages, on_result, on_stage_done, arrival=args.arrival, max_in_flight=args.max_in_flight, seed=args.seed)
+    await runner.run()
+
+
+async def run_capacity(infores: str, ara: dict, args: argparse.Namespace, output_filename: str):
+    """Search for the most load an ara handles within the SLO."""
+    print(f"Finding the capacity of {infores}")
+    output["capacity"][infores] = {"probes": {}}
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="capacity", target=infores, stage=get_probe_key(record.stage))
+
+    def on_probe(record: StageRecord, point: Dict[str, Any]):
+        result_stats = record.stats.to_dict(record.end_time - record.start_time)
+        result_stats["stage"] = get_stage_stats(record)
+        result_stats["slo"] = point
+        result_stats["harness"] = harness_monitor.summary(record.stats.start_time)
+        output["capacity"][infores]["probes"][get_probe_key(record.stage)] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    finder = CapacityFinder(lambda: lookup(ara["url"]), on_result, on_probe, args, harness_monitor)
+    output["capacity"][infores].update(await finder.run())
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_cache(infores: str, ara: dict, args: argparse.Namespace, output_filename: str):
+    """Measure how much an ara's cache helps, the query bypassing the cache against the same query cached."""
+    print(f"Running the cache experiment against {infores}")
+    output["cache"][infores] = {}
+
+    def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+        results_sink.record(stats, result, mode="cache", target=infores, stage=stage_key)
+
+    def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+        result_stats = stats.to_dict(total_time)
+        result_stats["harness"] = harness_monitor.check(f"cache {infores} {stage_key}", stats.start_time)
+        output["cache"][infores][stage_key] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    experiment = CacheExperiment(
+        lambda: lookup(ara["url"], bypass_cache=True),
+        lambda: lookup(ara["url"], bypass_cache=False),
+        on_result,
+        on_stage,
+        args,
+    )
+    output["cache"][infores]["summary"] = await experiment.run()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_compression(infores: str, ara: dict, args: argparse.Namespace, output_filename: str):
+    """Measure what request and response compression buy against an ara."""
+    print(f"Running the compression matrix against {infores}")
+    output["compression"][infores] = {}
+
+    def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+        results_sink.record(stats, result, mode="compression", target=infores, stage=stage_key)
+
+    def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+        result_stats = stats.to_dict(total_time)
+        result_stats["harness"] = harness_monitor.check(f"compression {infores} {stage_key}", stats.start_time)
+        output["compression"][infores][stage_key] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    matrix = CompressionMatrix(
+        lambda request_encoding, accept_encoding: lookup(ara["url"], True, request_encoding, accept_encoding),
+        on_result,
+        on_stage,
+        args,
+    )
+    output["compression"][infores]["summary"] = await matrix.run()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
 async def main():
     parser = argparse.ArgumentParser(description=("Translator Stress Tester"))
+    add_client_pool_arguments(parser)
+    add_load_arguments(parser)
+    add_trapi_stream_arguments(parser)
+    add_event_loop_arguments(parser)
+    add_capacity_arguments(parser)
+    add_cache_arguments(parser)
+    add_compression_arguments(parser)
+    add_trace_arguments(parser)
+    add_live_metrics_arguments(parser)
+    add_harness_monitor_arguments(parser)
+    add_results_store_arguments(parser)
+    add_query_generator_arguments(parser)
+    parser.add_argument("--targets", type=str, help="ARA targets file, like mock/aras.json for the mock server", default="aras.json")
+    args = parser.parse_args()
+    check_format(args.results_format)
+    if args.mode == "compression":
+        check_encodings(args.request_encodings.split(",") + args.accept_encodings.split(","))
+    with open(args.targets, "r") as f:
+        aras.update(json.load(f))
+    if args.capture_trace is not None:
+        trace_writer.open(args.capture_trace, {ara["url"]: infores for infores, ara in aras.items()})
+    client_pool.configure(args)
+    trapi_reader.configure(args)
+    live_metrics.configure(args)
+    harness_monitor.configure(args)
+    query_generator.configure(args)
 
     timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     output_filename = f"results/ara_tests_{timestamp}.json"
+    results_sink.open(f"results/ara_tests_{timestamp}.jsonl")
+    output["records"] = results_sink.filename
+    await live_metrics.start(results_sink, client_pool)
+    harness_monitor.start()
 
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
     for infores, ara in aras.items():
         # run aras one at a time so KPs don't get completely bashed. That's for the ARS tests.
+        if args.mode == "open_loop":
+            await run_rate(infores, ara, args, output_filename)
+            continue
+        if args.mode == "profile":
+            await run_profile(infores, ara, load_profile(args.profile), args, output_filename)
+            continue
+        if args.mode == "capacity":
+            await run_capacity(infores, ara, args, output_filename)
+            continue
+        if args.mode == "cache":
+            await run_cache(infores, ara, args, output_filename)
+            continue
+        if args.mode == "compression":
+            await run_compression(infores, ara, args, output_filename)
+            continue
         print(f"Running sequential tests against {infores}")
         await run_sequential(infores, ara, output_filename)
         print(f"Running concurrent tests against {infores}")
         await run_concurrent(infores, ara, output_filename)
+    output["harness"] = await harness_monitor.stop()
+    await live_metrics.stop()
+    await client_pool.aclose()
+    trapi_reader.close()
+    results_sink.close()
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    trace_writer.close()
+    output["connections"] = client_pool.stats()
+    output["decoding"] = {**trapi_reader.settings(), "event_loop": args.event_loop}
+    output["trace"] = trace_writer.filename
+    output["workload"] = query_generator.summary({ara["url"]: infores for infores, ara in aras.items()})
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run(main)
@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Dict, Optional
+
+from client_pool import ClientPool
+
+
+class PendingQuery:
+    """An ARS query the poller is waiting on."""
+
+    def __init__(self, url: str, pk: str, submitted_at: float):
+        self.url = url
+        self.pk = pk
+        self.submitted_at = submitted_at
+        # when the query was last seen still running, on the perf_counter clock
+        self.last_running = submitted_at
+        self.polls = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ArsPoller:
+    """
+    One polling loop for every outstanding ARS query.
+
+    Each query is polled again after a fraction (precision) of the time it has
+    been running so far, kept between min_interval and max_interval, so quick
+    queries finish with sub-second precision and hour long ones don't get polled
+    every second. All polls share a budget of max_polls_per_second and
+    max_concurrent_polls, so a thousand queries in flight don't turn into a
+    polling storm against the ARS. The ARS has no batch status endpoint, so
+    spreading the polls out is all the batching there is. wait() resolves with
+    when the query was seen Done or Error and how sure that time is.
+    """
+
+    def __init__(
+        self,
+        client_pool: ClientPool,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        precision: float = 0.05,
+        max_polls_per_second: float = 20.0,
+        max_concurrent_polls: int = 20,
+        max_query_time: float = 3600,
+    ):
+        self.client_pool = client_pool
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.precision = precision
+        self.max_polls_per_second = max_polls_per_second
+        self.max_concurrent_polls = max_concurrent_polls
+        self.max_query_time = max_query_time
+        # (next poll time, tiebreak, query)
+        self.queue = []
+        self.counter = itertools.count()
+        self.in_flight = 0
+        self.next_token = 0.0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.tasks = set()
+        self.polls = 0
+        self.poll_errors = 0
+        self.max_pending = 0
+
+    def configure(self, args: argparse.Namespace):
+        self.min_interval = args.poll_min_interval
+        self.max_interval = args.poll_max_interval
+        self.precision = args.poll_precision
+        self.max_polls_per_second = args.poll_rate
+        self.max_concurrent_polls = args.max_concurrent_polls
+        # no point polling a query past the deadline its lookup gets cancelled at
+        if self.client_pool.deadline is not None:
+            self.max_query_time = self.client_pool.deadline
+
+    def schedule(self, query: PendingQuery, now: float):
+        interval = min(max((now - query.submitted_at) * self.precision, self.min_interval), self.max_interval)
+        heapq.heappush(self.queue, (now + interval, next(self.counter), query))
+        self.max_pending = max(self.max_pending, len(self.queue) + self.in_flight)
+
+    async def wait(self, url: str, pk: str, submitted_at: float) -> Dict[str, Any]:
+        """Wait until the query with parent pk is Done or Error, or has run out of time."""
+        query = PendingQuery(url, pk, submitted_at)
+        self.schedule(query, submitted_at)
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+        return await query.future
+
+    async def poll(self, query: PendingQuery):
+        poll_start = time.perf_counter()
+        status = None
+        merged_pk = None
+        try:
+            async with self.client_pool.client(query.url) as client:
+                response = await client.get(f"{query.url}/messages/{query.pk}?trace=y")
+                response.raise_for_status()
+                message = response.json()
+            status = message.get("status")
+            merged_pk = message.get("merged_version")
+        except Exception:
+            self.poll_errors += 1
+        finally:
+            self.in_flight -= 1
+            self.wakeup.set()
+        now = time.perf_counter()
+        self.polls += 1
+        query.polls += 1
+        if query.future.done():
+            # its lookup was cancelled at its deadline while this poll was out
+            return
+        if status == "Done" or status == "Error":
+            query.future.set_result({
+                "status": status,
+                "merged_pk": merged_pk,
+                "done_at": now,
+                # it finished somewhere between the last poll that saw it running and this one
+                "done_uncertainty": now - query.last_running,
+                "polls": query.polls,
+            })
+        elif now - query.submitted_at > self.max_query_time:
+            query.future.set_result({
+                "status": "timeout",
+                "merged_pk": None,
+                "done_at": None,
+                "done_uncertainty": None,
+                "polls": query.polls,
+            })
+        else:
+            if status is not None:
+                query.last_running = poll_start
+            self.schedule(query, now)
+
+    async def run(self):
+        while self.queue or self.in_flight:
+            now = time.perf_counter()
+            while (
+                self.queue and self.queue[0][0] <= now and
+                self.in_flight < self.max_concurrent_polls and
+                self.next_token <= now
+            ):
+                _, _, query = heapq.heappop(self.queue)
+                if query.future.done():
+                    continue
+                self.next_token = max(self.next_token, now) + 1 / self.max_polls_per_second
+                self.in_flight += 1
+                task = asyncio.create_task(self.poll(query))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            timeout = None
+            if self.queue and self.in_flight < self.max_concurrent_polls:
+                timeout = max(self.queue[0][0], self.next_token) - now
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "max_pending": self.max_pending,
+        }
+
+
+def add_ars_poller_arguments(parser: argparse.ArgumentParser):
+    """Add the ARS polling command line arguments."""
+    parser.add_argument("--poll_min_interval", type=float, help="Shortest wait between status polls of one query, and before the first", default=1.0)
+    parser.add_argument("--poll_max_interval", type=float, help="Longest wait between status polls of one query", default=30.0)
+    parser.add_argument("--poll_precision", type=float, help="Poll each query again after this fraction of how long it has run", default=0.05)
+    parser.add_argument("--poll_rate", type=float, help="Max status polls per second across all queries", default=20.0)
+    parser.add_argument("--max_concurrent_polls", type=int, help="Max status polls in flight at once", default=20)
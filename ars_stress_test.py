@@ -1,74 +1,140 @@
 import argparse
 import asyncio
 from datetime import datetime
-import httpx
 import json
+import time
 from tqdm import tqdm
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
+from ars_poller import ArsPoller, add_ars_poller_arguments
+from cache_experiment import CacheExperiment, add_cache_arguments
+from capacity_finder import CapacityFinder, add_capacity_arguments, get_probe_key
+from client_pool import ClientPool, add_client_pool_arguments
+from event_loop import add_event_loop_arguments, run
 from generate_message import generate_ara_message
+from load_profiles import ProfileRunner, StageRecord, get_stage_key, get_stage_stats, load_profile
+from harness_monitor import HarnessMonitor, add_harness_monitor_arguments
+from live_metrics import LiveMetrics, add_live_metrics_arguments
+from load_scheduler import add_load_arguments, run_burst, run_open_loop
+from payload_cache import JSON_HEADERS, encode_payload
+from query_generator import QueryGenerator, add_query_generator_arguments
+from result_stats import ResultStats
+from request_errors import classify, deadline
+from request_trace import TraceWriter, add_trace_arguments
+from request_timing import AsyncRequestTimer
+from results_sink import ResultsSink
+from results_store import MERGED_PHASES, add_results_store_arguments, check_format, write_columns
+from trapi_stream import TrapiReader, add_trapi_stream_arguments, empty_counts
 
 ars_url = "https://ars.ci.transltr.io/ars/api"
 
 output = {
     "sequential": {},
     "concurrent": {},
+    "open_loop": {},
+    "profile": {},
+    "capacity": {},
+    "cache": {},
 }
 
 MAX_QUERY_TIME = 3600
+# the submit, polls and merged fetch are quick calls, but the whole lookup waits on the job
+client_pool = ClientPool(timeout=60, read_timeout=120, deadline=MAX_QUERY_TIME)
+results_sink = ResultsSink()
+trapi_reader = TrapiReader()
+trace_writer = TraceWriter()
+live_metrics = LiveMetrics()
+harness_monitor = HarnessMonitor()
+query_generator = QueryGenerator()
 
+ars_poller = ArsPoller(client_pool, max_query_time=MAX_QUERY_TIME)
+MERGED_RESULTS_PATH = ("fields", "data", "message", "results")
+MERGED_KNOWLEDGE_GRAPH_PATH = ("fields", "data", "message", "knowledge_graph")
 
-async def lookup(url: str) -> Dict[str, Any]:
+
+def merged_phases(fetch_timer: AsyncRequestTimer) -> Dict[str, Optional[float]]:
+    """Get the merged message fetch's phases, merged_fetch being its total."""
+    phases = fetch_timer.phases()
+    return {"merged_fetch": phases["total"], **{f"merged_{phase}": phases[phase] for phase in MERGED_PHASES}}
+
+
+async def lookup(url: str, bypass_cache: bool = True) -> Dict[str, Any]:
     """Run a single query lookup asynchronously."""
-    query = generate_ara_message()
-    status = "timeout"
-    start_time = datetime.now()
+    shape = None
+    if query_generator.enabled:
+        shape, query = query_generator.next(bypass_cache)
+    else:
+        query = encode_payload(generate_ara_message(bypass_cache))
+    status = None
+    error = None
+    counts = empty_counts()
+    timer = AsyncRequestTimer()
+    ars_phases = {}
+    polls = 0
+    trace_writer.write(f"{url}/submit", query, "ARS")
     try:
-        async with httpx.AsyncClient(timeout=600) as client:
-            response = await client.post(
-                f"{url}/submit",
-                json=query,
-            )
-            status = response.status_code
-            response.raise_for_status()
-            response = response.json()
-            parent_pk = response.get("pk", "")
-            await asyncio.sleep(10)
-            current_time = datetime.now()
-            num_results = 0
-            while (current_time - start_time).total_seconds() <= MAX_QUERY_TIME:
-                res = await client.get(f"{url}/messages/{parent_pk}?trace=y")
-                res.raise_for_status()
-                response = res.json()
-                status = response.get("status")
-                if status == "Done" or status == "Error":
-                    merged_pk = response.get("merged_version")
-                    if merged_pk is None:
-                        print(
-                            f"Failed to get the ARS merged message from pk: {parent_pk}."
-                        )
-                        num_results = 0
-                    else:
-                        # get full merged pk
-                        res = await client.get(
-                            f"{url}/messages/{merged_pk}"
-                        )
-                        res.raise_for_status()
-                        merged_message = res.json()
-                        num_results = len((merged_message.get("fields", {}).get("data", {}).get("message") or {}).get("results") or [])
-                    break
+        async with deadline(client_pool.deadline):
+            async with client_pool.client(url) as client:
+                response = await client.post(
+                    f"{url}/submit",
+                    content=query,
+                    headers=JSON_HEADERS,
+                    extensions={"trace": timer},
+                )
+                status = response.status_code
+                response.raise_for_status()
+                response = response.json()
+                parent_pk = response.get("pk", "")
+            submitted_at = time.perf_counter()
+            ars_phases["submit"] = submitted_at - timer.start_time
+            job = await ars_poller.wait(url, parent_pk, submitted_at)
+            status = job["status"]
+            polls = job["polls"]
+            if job["done_at"] is not None:
+                ars_phases["time_to_done"] = job["done_at"] - submitted_at
+                ars_phases["done_uncertainty"] = job["done_uncertainty"]
+            if status == "Done" or status == "Error":
+                merged_pk = job["merged_pk"]
+                if merged_pk is None:
+                    print(
+                        f"Failed to get the ARS merged message from pk: {parent_pk}."
+                    )
                 else:
-                    current_time = datetime.now()
-                    await asyncio.sleep(10)
+                    # get full merged pk, timed on its own so its phases don't land on the submit's
+                    fetch_timer = AsyncRequestTimer()
+                    try:
+                        async with client_pool.client(url) as client:
+                            async with client.stream(
+                                "GET",
+                                f"{url}/messages/{merged_pk}",
+                                extensions={"trace": fetch_timer},
+                            ) as res:
+                                res.raise_for_status()
+                                counts = await trapi_reader.read(res, fetch_timer, MERGED_RESULTS_PATH, MERGED_KNOWLEDGE_GRAPH_PATH)
+                    finally:
+                        fetch_timer.stop()
+                        client_pool.record(url, fetch_timer.new_connection)
+                        ars_phases.update(merged_phases(fetch_timer))
     except Exception as e:
-        num_results = 0
+        error = e
+        counts = empty_counts()
 
-    stop_time = datetime.now()
+    timer.stop()
+    client_pool.record(url, timer.new_connection)
+    error_class = classify(error, status)
     result = {
-        "status": status,
-        "num_results": num_results,
-        "response_time": (stop_time - start_time).total_seconds(),
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": {**timer.phases(), **ars_phases},
+        "polls": polls,
+        "completed_at": time.time(),
     }
+    if shape is not None:
+        result["query_shape"] = shape
+        query_generator.record(url, shape, result)
     return result
 
 
@@ -76,24 +142,14 @@ async def run_sequential(output_filename: str):
     """Send squential queries to kps."""
     if "ars" not in output["sequential"]:
         output["sequential"]["ars"] = {}
-    results = []
+    stats = ResultStats()
     start_time = datetime.now()
-    for ndx in tqdm(range(0, 15)):
+    for ndx in tqdm(range(0, 15), disable=live_metrics.dashboard):
         result = await lookup(ars_url)
-        results.append(result)
+        results_sink.record(stats, result, mode="sequential", target="ars", stage=15)
     end_time = datetime.now()
-    result_stats = {
-        "total_time": (end_time - start_time).total_seconds(),
-        "total_results": 0,
-        "statuses": {},
-        "results": results,
-    }
-    for result in results:
-        result_stats["total_results"] += result["num_results"]
-        if result["status"] not in result_stats["statuses"]:
-            result_stats["statuses"][result["status"]] = 1
-        else:
-            result_stats["statuses"][result["status"]] += 1
+    result_stats = stats.to_dict((end_time - start_time).total_seconds())
+    result_stats["harness"] = harness_monitor.check("sequential 15", stats.start_time)
     output["sequential"]["ars"] = result_stats
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
@@ -108,21 +164,12 @@ async def run_concurrent(output_filename: str):
         queries = []
         for ndx in range(0, num):
             queries.append(lookup(ars_url))
+        stats = ResultStats()
         start_time = datetime.now()
-        results = await asyncio.gather(*queries, return_exceptions=True)
+        await run_burst(queries, lambda result: results_sink.record(stats, result, mode="concurrent", target="ars", stage=num))
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
+        result_stats = stats.to_dict((end_time - start_time).total_seconds())
+        result_stats["harness"] = harness_monitor.check(f"concurrent {num}", stats.start_time)
         output["concurrent"]["ars"][num] = result_stats
         with open(output_filename, "w") as f:
             json.dump(output, f, indent = 2)
@@ -130,20 +177,169 @@ async def run_concurrent(output_filename: str):
         await asyncio.sleep(300)
 
 
+async def run_rate(args: argparse.Namespace, output_filename: str):
+    """Send queries at a steady arrival rate."""
+    print(f"Sending {args.rate} requests/s to the ARS for {args.duration}s")
+    stats = ResultStats()
+    start_time = datetime.now()
+    rate_stats = await run_open_loop(
+        lambda: lookup(ars_url),
+        lambda result: results_sink.record(stats, result, mode="open_loop", target="ars", stage=args.rate),
+        args.rate,
+        args.duration,
+        arrival=args.arrival,
+        max_in_flight=args.max_in_flight,
+        seed=args.seed,
+    )
+    end_time = datetime.now()
+    result_stats = stats.to_dict((end_time - start_time).total_seconds())
+    result_stats["rate"] = rate_stats
+    result_stats["harness"] = harness_monitor.check(f"open loop {args.rate}", stats.start_time)
+    output["open_loop"]["ars"] = result_stats
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_profile(stages: List[Dict[str, Any]], args: argparse.Namespace, output_filename: str):
+    """Drive a load profile."""
+    print(f"Running load profile against the ARS")
+    output["profile"]["ars"] = {}
+
+    async def send(stage: Dict[str, Any]) -> Dict[str, Any]:
+        return await lookup(ars_url)
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="profile", target="ars", stage=get_stage_key(record.index, record.stage))
+
+    def on_stage_done(record: StageRecord):
+        result_stats = record.stats.to_dict(record.end_time - record.start_time)
+        result_stats["stage"] = get_stage_stats(record)
+        result_stats["harness"] = harness_monitor.check(f"profile {get_stage_key(record.index, record.stage)}", record.stats.start_time)
+        output["profile"]["ars"][get_stage_key(record.index, record.stage)] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    runner = ProfileRunner(send, stages, on_result, on_stage_done, arrival=args.arrival, max_in_flight=args.max_in_flight, seed=args.seed)
+    await runner.run()
+
+
+async def run_capacity(args: argparse.Namespace, output_filename: str):
+    """Search for the most load the ARS handles within the SLO."""
+    print(f"Finding the capacity of the ARS")
+    output["capacity"]["ars"] = {"probes": {}}
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="capacity", target="ars", stage=get_probe_key(record.stage))
+
+    def on_probe(record: StageRecord, point: Dict[str, Any]):
+        result_stats = record.stats.to_dict(record.end_time - record.start_time)
+        result_stats["stage"] = get_stage_stats(record)
+        result_stats["slo"] = point
+        result_stats["harness"] = harness_monitor.summary(record.stats.start_time)
+        output["capacity"]["ars"]["probes"][get_probe_key(record.stage)] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    finder = CapacityFinder(lambda: lookup(ars_url), on_result, on_probe, args, harness_monitor)
+    output["capacity"]["ars"].update(await finder.run())
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_cache(args: argparse.Namespace, output_filename: str):
+    """Measure how much the ARS's cache helps, the query bypassing the cache against the same query cached."""
+    print("Running the cache experiment against the ARS")
+    output["cache"]["ars"] = {}
+
+    def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+        results_sink.record(stats, result, mode="cache", target="ars", stage=stage_key)
+
+    def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+        result_stats = stats.to_dict(total_time)
+        result_stats["harness"] = harness_monitor.check(f"cache {stage_key}", stats.start_time)
+        output["cache"]["ars"][stage_key] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    experiment = CacheExperiment(
+        lambda: lookup(ars_url, bypass_cache=True),
+        lambda: lookup(ars_url, bypass_cache=False),
+        on_result,
+        on_stage,
+        args,
+    )
+    output["cache"]["ars"]["summary"] = await experiment.run()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
 async def main():
+    global ars_url
     parser = argparse.ArgumentParser(description=("Translator Stress Tester"))
+    add_client_pool_arguments(parser)
+    add_load_arguments(parser)
+    add_trapi_stream_arguments(parser)
+    add_event_loop_arguments(parser)
+    add_ars_poller_arguments(parser)
+    add_capacity_arguments(parser)
+    add_cache_arguments(parser)
+    add_trace_arguments(parser)
+    add_live_metrics_arguments(parser)
+    add_harness_monitor_arguments(parser)
+    add_results_store_arguments(parser)
+    add_query_generator_arguments(parser)
+    parser.add_argument("--ars_url", type=str, help="ARS api url, like http://127.0.0.1:8080/ars/api for the mock server", default=ars_url)
+    args = parser.parse_args()
+    check_format(args.results_format)
+    if args.mode == "compression":
+        raise SystemExit("The compression mode runs from kp_stress_tests.py and ara_stress_test.py")
+    ars_url = args.ars_url
+    client_pool.configure(args)
+    trapi_reader.configure(args)
+    live_metrics.configure(args)
+    harness_monitor.configure(args)
+    query_generator.configure(args)
+    # after the client pool, the poller gives up on a query at its deadline
+    ars_poller.configure(args)
+    if args.capture_trace is not None:
+        trace_writer.open(args.capture_trace)
 
     timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     output_filename = f"results/ars_tests_{timestamp}.json"
+    results_sink.open(f"results/ars_tests_{timestamp}.jsonl")
+    output["records"] = results_sink.filename
+    await live_metrics.start(results_sink, client_pool)
+    harness_monitor.start()
 
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
-    await run_sequential(output_filename)
-    await run_concurrent(output_filename)
+    if args.mode == "open_loop":
+        await run_rate(args, output_filename)
+    elif args.mode == "profile":
+        await run_profile(load_profile(args.profile), args, output_filename)
+    elif args.mode == "capacity":
+        await run_capacity(args, output_filename)
+    elif args.mode == "cache":
+        await run_cache(args, output_filename)
+    else:
+        await run_sequential(output_filename)
+        await run_concurrent(output_filename)
+    output["harness"] = await harness_monitor.stop()
+    await live_metrics.stop()
+    await client_pool.aclose()
+    trapi_reader.close()
+    results_sink.close()
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    trace_writer.close()
+    output["connections"] = client_pool.stats()
+    output["decoding"] = {**trapi_reader.settings(), "event_loop": args.event_loop}
+    output["trace"] = trace_writer.filename
+    output["workload"] = query_generator.summary({ars_url: "ARS"})
+    output["poller"] = ars_poller.stats()
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run(main)
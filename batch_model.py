@@ -0,0 +1,184 @@
+import argparse
+import itertools
+import math
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from result_stats import count_failures
+
+# latency = overhead + per_curie * batch + saturation * batch ** 2
+TERMS = ["overhead", "per_curie", "saturation"]
+# a worse fit than this says too little about batches that weren't run to recommend one
+MIN_R2 = 0.8
+
+
+def solve(matrix: List[List[float]], vector: List[float]) -> Optional[List[float]]:
+    """Solve a small linear system by Gaussian elimination, None if it's singular."""
+    size = len(vector)
+    rows = [row[:] + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(size):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [value - factor * pivot_value for value, pivot_value in zip(rows[row], rows[column])]
+    return [rows[row][size] / rows[row][row] for row in range(size)]
+
+
+def fit_batch_model(points: Sequence[Tuple[float, int, float]]) -> Optional[Dict[str, Any]]:
+    """
+    Fit latency against batch size from (batch size, requests, mean latency) points.
+
+    Weighting each stage's mean latency by its request count gives the same
+    least squares fit as every request on its own would, so stage summaries are
+    enough and nothing per request has to be kept. None of the terms can go
+    negative, a KP doesn't get faster per curie, so every subset of the terms is
+    fitted and the best one without a negative coefficient wins. The saturation
+    term is what makes big batches slower per curie than small ones.
+    """
+    points = [(batch, count, mean) for batch, count, mean in points if count and mean is not None]
+    if not points:
+        return None
+    best = None
+    for size in range(1, len(TERMS) + 1):
+        for terms in itertools.combinations(range(len(TERMS)), size):
+            if len(terms) > len(points):
+                continue
+            features = [[batch ** term for term in terms] for batch, _, _ in points]
+            matrix = [
+                [sum(count * row[i] * row[j] for row, (_, count, _) in zip(features, points)) for j in range(size)]
+                for i in range(size)
+            ]
+            vector = [sum(count * row[i] * mean for row, (_, count, mean) in zip(features, points)) for i in range(size)]
+            solution = solve(matrix, vector)
+            if solution is None or any(coefficient < 0 for coefficient in solution):
+                continue
+            coefficients = [0.0] * len(TERMS)
+            for term, coefficient in zip(terms, solution):
+                coefficients[term] = coefficient
+            error = sum(count * (mean - predict_coefficients(coefficients, batch)) ** 2 for batch, count, mean in points)
+            if best is None or error < best[0] - 1e-15:
+                best = (error, coefficients)
+    if best is None:
+        return None
+    error, coefficients = best
+    total = sum(count for _, count, _ in points)
+    average = sum(count * mean for _, count, mean in points) / total
+    spread = sum(count * (mean - average) ** 2 for _, count, mean in points)
+    model = dict(zip(TERMS, coefficients))
+    model["r2"] = 1 - error / spread if spread else None
+    return model
+
+
+def predict_coefficients(coefficients: Sequence[float], batch: float) -> float:
+    return coefficients[0] + coefficients[1] * batch + coefficients[2] * batch ** 2
+
+
+def predict(model: Dict[str, Any], batch: float) -> float:
+    """Get the predicted latency of one request of batch curies."""
+    return predict_coefficients([model[term] for term in TERMS], batch)
+
+
+def optimal_batch(model: Dict[str, Any], low: int, high: int) -> Optional[int]:
+    """
+    Get the batch size with the most curies per second for one request stream, within low and high.
+
+    Without a positive saturation term curies per second only grows with the
+    batch size and there's no optimum to find, and a fit under MIN_R2 can't be
+    trusted to place one, so both give None. So does an optimum outside low and
+    high, which would be a guess about batches nobody measured.
+    """
+    if model["saturation"] <= 0 or model["r2"] is None or model["r2"] < MIN_R2:
+        return None
+    # batch / latency peaks where the overhead equals the saturation cost
+    optimum = math.sqrt(model["overhead"] / model["saturation"])
+    if not low <= optimum <= high:
+        return None
+    candidates = {max(math.floor(optimum), low), min(math.ceil(optimum), high)}
+    return max(candidates, key=lambda batch: batch / predict(model, batch) if predict(model, batch) > 0 else 0)
+
+
+def fine_batch_sizes(optimum: int, measured: Sequence[int], low: int, high: int, count: int) -> List[int]:
+    """Get count batch sizes spread on a log scale from half to twice the optimum, skipping ones already run."""
+    if count <= 0:
+        return []
+    start, stop = max(optimum / 2, low), min(optimum * 2, high)
+    sizes = []
+    for index in range(count):
+        fraction = index / (count - 1) if count > 1 else 0.5
+        batch = int(round(start * (stop / start) ** fraction))
+        if batch not in measured and batch not in sizes:
+            sizes.append(batch)
+    return sizes
+
+
+def error_rate(stage: Dict[str, Any]) -> float:
+    requests = stage.get("num_requests") or 0
+    return count_failures(stage) / requests if requests else 1.0
+
+
+def trusted(stage: Dict[str, Any], max_error_rate: float) -> bool:
+    """Check a stage is fit to recommend from: few enough errors and a harness that kept up."""
+    return error_rate(stage) <= max_error_rate and not (stage.get("harness") or {}).get("saturated")
+
+
+def recommend(
+    sequential: Dict[int, Dict[str, Any]],
+    concurrent: Dict[Tuple[int, int], Dict[str, Any]],
+    low: int,
+    high: int,
+    max_error_rate: float,
+) -> Dict[str, Any]:
+    """
+    Fit one KP's batch cost model and recommend a batch size and concurrency.
+
+    sequential maps batch sizes to the stats of their sequential stages, which
+    the model is fitted on since nothing queues there. concurrent maps (batch
+    size, requests at once) to stage stats, the stage with the most curies per
+    second and no more than max_error_rate errors gives the concurrency. Stages
+    the harness was saturated in are left out of both. The model only picks the
+    batch size when it has an optimum inside the measured batch sizes, otherwise
+    it's the measured batch size with the most curies per second.
+    """
+    points = [(batch, stage["num_requests"], stage["latency"]["mean"]) for batch, stage in sequential.items() if trusted(stage, max_error_rate)]
+    model = fit_batch_model(points)
+    batches = {}
+    for batch, stage in sorted(sequential.items()):
+        mean = stage["latency"]["mean"]
+        requests = stage["num_requests"] or 1
+        batches[batch] = {
+            "latency": mean,
+            "predicted": predict(model, batch) if model is not None else None,
+            "curies_per_second": batch / mean if mean else None,
+            "results_per_curie": stage["total_results"] / requests / batch,
+            "bytes_per_curie": stage["response_bytes"] / requests / batch,
+            "error_rate": error_rate(stage),
+        }
+    measured = [batch for batch, _, _ in points if low <= batch <= high and batches[batch]["curies_per_second"] is not None]
+    optimum = None
+    if model is not None and measured:
+        optimum = optimal_batch(model, min(measured), max(measured))
+    best_measured = max(measured, key=lambda batch: batches[batch]["curies_per_second"], default=None)
+    best_concurrent = None
+    for (batch, concurrency), stage in concurrent.items():
+        if not stage["total_time"] or not trusted(stage, max_error_rate):
+            continue
+        curies_per_second = stage["num_requests"] * batch / stage["total_time"]
+        if best_concurrent is None or curies_per_second > best_concurrent["curies_per_second"]:
+            best_concurrent = {"batch_size": batch, "concurrency": concurrency, "curies_per_second": curies_per_second}
+    return {
+        "model": model,
+        "batches": batches,
+        "optimal_batch_size": optimum if optimum is not None else best_measured,
+        # "model" when the fit has an optimum between the measured batch sizes, "measured" when it's the best stage
+        "optimal_batch_from": "model" if optimum is not None else "measured" if best_measured is not None else None,
+        "best_concurrent": best_concurrent,
+    }
+
+
+def add_batch_model_arguments(parser: argparse.ArgumentParser):
+    """Add the batch size model command line arguments."""
+    parser.add_argument("--max_batch_size", type=int, help="Largest batch size to recommend or sweep", default=1000)
+    parser.add_argument("--batch_error_rate", type=float, help="Max error rate of a stage used for the batch model and recommendation", default=0.05)
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from latency_histogram import LatencyHistogram
+from result_stats import ResultStats
+
+# a warm request faster than all but this percent of cold ones looks like a cache hit
+HIT_PERCENTILE = 5
+
+
+def get_cache_stage_key(temperature: str, concurrency: int) -> str:
+    """Get the output key for a cold or warm cache stage."""
+    return f"{temperature}_{concurrency}"
+
+
+def fraction_below(histogram: LatencyHistogram, seconds: float) -> float:
+    """Get the fraction of recorded latencies at or below seconds."""
+    if not histogram.count:
+        return 0.0
+    # buckets are in microseconds
+    below = sum(count for index, count in histogram.counts.items() if histogram.bucket_value(index) <= seconds * 1_000_000)
+    return below / histogram.count
+
+
+def estimate_hit_ratio(cold: LatencyHistogram, warm: LatencyHistogram) -> Optional[float]:
+    """
+    Estimate the fraction of warm requests that were answered from the target's cache.
+
+    A miss should take about as long as a cold request, so HIT_PERCENTILE percent
+    of misses land under the cold HIT_PERCENTILE percentile anyway. Every warm
+    request under it beyond that share is taken to be a hit.
+    """
+    threshold = cold.percentile(HIT_PERCENTILE)
+    if threshold is None or not warm.count:
+        return None
+    share = HIT_PERCENTILE / 100
+    return min(max((fraction_below(warm, threshold) - share) / (1 - share), 0.0), 1.0)
+
+
+def ratio(numerator: Optional[float], denominator: Optional[float]) -> Optional[float]:
+    if numerator is None or not denominator:
+        return None
+    return numerator / denominator
+
+
+def describe(stats: ResultStats, total_time: float) -> Dict[str, Any]:
+    # by error class, a 200 that failed in the body didn't get its answer
+    successes = stats.errors.get("ok", 0)
+    return {
+        "mean": stats.latency.summary()["mean"],
+        "p50": stats.latency.percentile(50),
+        "p95": stats.latency.percentile(95),
+        "throughput": stats.num_requests / total_time if total_time else None,
+        "error_rate": 1 - successes / stats.num_requests if stats.num_requests else None,
+    }
+
+
+async def run_pool(
+    send: Callable[[], Awaitable[Dict[str, Any]]],
+    record: Callable[[Dict[str, Any]], None],
+    num_requests: int,
+    concurrency: int,
+) -> float:
+    """Send num_requests requests with concurrency of them in flight, giving back how long it took."""
+    loop = asyncio.get_running_loop()
+    remaining = num_requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            record(await send())
+
+    start_time = loop.time()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, num_requests))])
+    return loop.time() - start_time
+
+
+class CacheExperiment:
+    """
+    Measure how much a target's cache helps, at a few concurrency levels.
+
+    Each level runs a cold stage, where send_cold never repeats a query (or asks
+    the target to bypass its cache), then primes the cache with one warm query
+    and runs a warm stage of that same query over and over with send_warm. Both
+    stages send cache_requests requests with concurrency of them in flight.
+    The summary has the cold over warm speedup, an estimate of the warm hit
+    ratio and how warm and cold latency grow with concurrency.
+    """
+
+    def __init__(
+        self,
+        send_cold: Callable[[], Awaitable[Dict[str, Any]]],
+        send_warm: Callable[[], Awaitable[Dict[str, Any]]],
+        on_result: Callable[[str, ResultStats, Dict[str, Any]], None],
+        on_stage: Callable[[str, ResultStats, float], None],
+        args: argparse.Namespace,
+    ):
+        self.send_cold = send_cold
+        self.send_warm = send_warm
+        self.on_result = on_result
+        self.on_stage = on_stage
+        self.levels = [int(level) for level in args.cache_concurrency.split(",")]
+        self.num_requests = args.cache_requests
+
+    async def run_stage(self, stage_key: str, send: Callable[[], Awaitable[Dict[str, Any]]], concurrency: int) -> Dict[str, Any]:
+        stats = ResultStats()
+        total_time = await run_pool(send, lambda result: self.on_result(stage_key, stats, result), self.num_requests, concurrency)
+        self.on_stage(stage_key, stats, total_time)
+        return {"stats": stats, "total_time": total_time}
+
+    async def run(self) -> Dict[str, Any]:
+        levels = {}
+        primed = False
+        for concurrency in self.levels:
+            print(f"  {concurrency} concurrent, cold")
+            cold = await self.run_stage(get_cache_stage_key("cold", concurrency), self.send_cold, concurrency)
+            if not primed:
+                await self.send_warm()
+                primed = True
+            print(f"  {concurrency} concurrent, warm")
+            warm = await self.run_stage(get_cache_stage_key("warm", concurrency), self.send_warm, concurrency)
+            cold_stats = describe(cold["stats"], cold["total_time"])
+            warm_stats = describe(warm["stats"], warm["total_time"])
+            levels[concurrency] = {
+                "cold": cold_stats,
+                "warm": warm_stats,
+                "speedup": ratio(cold_stats["p50"], warm_stats["p50"]),
+                "mean_speedup": ratio(cold_stats["mean"], warm_stats["mean"]),
+                "hit_ratio": estimate_hit_ratio(cold["stats"].latency, warm["stats"].latency),
+            }
+        lowest, highest = levels[min(levels)], levels[max(levels)]
+        return {
+            "speedup": lowest["speedup"],
+            "hit_ratio": lowest["hit_ratio"],
+            # how many times slower the median gets from the lowest concurrency to the highest
+            "warm_scaling": ratio(highest["warm"]["p50"], lowest["warm"]["p50"]),
+            "cold_scaling": ratio(highest["cold"]["p50"], lowest["cold"]["p50"]),
+            "levels": levels,
+        }
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    """Add the cache experiment command line arguments."""
+    parser.add_argument("--cache_concurrency", type=str, help="Comma separated concurrency levels of the cache experiment", default="1,10,50")
+    parser.add_argument("--cache_requests", type=int, help="Requests in each cold and warm cache stage", default=100)
@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from harness_monitor import HarnessMonitor
+from load_profiles import ProfileRunner, StageRecord, get_stage_stats
+from result_stats import ResultStats
+
+
+def get_probe_key(stage: Dict[str, Any]) -> str:
+    """Get the output key for a capacity probe stage."""
+    if "rate" in stage:
+        return f"{stage['rate']}rps"
+    return f"{stage['concurrency']}c"
+
+
+def check_slo(stats: ResultStats, args: argparse.Namespace) -> Dict[str, Any]:
+    """Check one probe's stats against the SLO."""
+    latency = stats.latency.percentile(args.slo_percentile)
+    # by error class, a 200 that hit its deadline or failed in the body is an error
+    error_rate = 1 - stats.errors.get("ok", 0) / stats.num_requests if stats.num_requests else 1.0
+    return {
+        "passed": (
+            stats.num_requests > 0 and
+            latency is not None and latency <= args.slo_latency and
+            error_rate <= args.slo_error_rate
+        ),
+        "latency": latency,
+        "error_rate": error_rate,
+    }
+
+
+class CapacityFinder:
+    """
+    Search for the highest rate or concurrency a service handles within an SLO.
+
+    Load grows by growth times per probe while the SLO holds, and once a probe
+    misses it the search bisects between the last load that passed and the first
+    that failed until they are within precision of each other, so only a handful of
+    probes run anywhere near the knee and none run long past it. Each probe is a
+    single step stage of probe_duration seconds, rate probes go out open loop so
+    queueing shows up in the latency the SLO is checked against. With a harness
+    monitor, the search stops at the first probe the harness itself couldn't keep
+    up with, since past that it measures the harness and not the service.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[], Awaitable[Dict[str, Any]]],
+        on_result: Callable[[StageRecord, Dict[str, Any]], None],
+        on_probe: Callable[[StageRecord, Dict[str, Any]], None],
+        args: argparse.Namespace,
+        harness: Optional[HarnessMonitor] = None,
+    ):
+        self.send = send
+        self.on_result = on_result
+        self.on_probe = on_probe
+        self.args = args
+        self.by = args.capacity_by
+        self.curve: List[Dict[str, Any]] = []
+        self.harness = harness
+        self.harness_limited: Optional[float] = None
+
+    def load_value(self, load: float) -> float:
+        # concurrency has to be a whole number of workers
+        return max(int(round(load)), 1) if self.by == "concurrency" else load
+
+    async def probe(self, load: float) -> bool:
+        stage = {"type": "step", "duration": self.args.probe_duration, self.by: load}
+        done = []
+        runner = ProfileRunner(
+            lambda stage: self.send(),
+            [stage],
+            self.on_result,
+            done.append,
+            arrival=self.args.arrival,
+            max_in_flight=self.args.max_in_flight,
+            seed=self.args.seed,
+        )
+        await runner.run()
+        record = done[0]
+        slo = check_slo(record.stats, self.args)
+        point = {
+            "load": load,
+            **slo,
+            "num_requests": record.stats.num_requests,
+            "achieved_rate": get_stage_stats(record)["achieved_rate"],
+        }
+        probe_name = f"{load} {'rps' if self.by == 'rate' else 'concurrent'}"
+        if self.harness is not None:
+            point["harness_saturated"] = self.harness.check(f"the {probe_name} probe", record.stats.start_time)["saturated"]
+            if point["harness_saturated"]:
+                self.harness_limited = load
+        self.curve.append(point)
+        self.on_probe(record, point)
+        print(f"  {probe_name}: {'passed' if slo['passed'] else 'failed'}")
+        if self.args.probe_cooldown:
+            await asyncio.sleep(self.args.probe_cooldown)
+        return slo["passed"]
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        passed_load: Optional[float] = None
+        failed_load: Optional[float] = None
+        load = self.load_value(args.capacity_start)
+        while len(self.curve) < args.max_probes:
+            passed = await self.probe(load)
+            if self.harness_limited is not None:
+                break
+            if passed:
+                passed_load = load
+                if load >= args.capacity_max:
+                    break
+                load = self.load_value(min(load * args.capacity_growth, args.capacity_max))
+            else:
+                failed_load = load
+                break
+        while failed_load is not None and self.harness_limited is None and len(self.curve) < args.max_probes:
+            low = passed_load or 0
+            if failed_load - low <= args.capacity_precision * failed_load:
+                break
+            load = self.load_value((low + failed_load) / 2)
+            if load <= low or load >= failed_load:
+                break
+            passed = await self.probe(load)
+            if self.harness_limited is not None:
+                break
+            if passed:
+                passed_load = load
+            else:
+                failed_load = load
+        return {
+            "by": self.by,
+            "slo": {
+                "percentile": args.slo_percentile,
+                "latency": args.slo_latency,
+                "error_rate": args.slo_error_rate,
+            },
+            "capacity": passed_load,
+            "first_failure": failed_load,
+            # the load the harness ran out of headroom at, the capacity is at least the last load that passed
+            "harness_limited": self.harness_limited,
+            "curve": sorted(self.curve, key=lambda point: point["load"]),
+        }
+
+
+def add_capacity_arguments(parser: argparse.ArgumentParser):
+    """Add the capacity finder command line arguments."""
+    parser.add_argument("--capacity_by", type=str, choices=["rate", "concurrency"], help="Search for the max rate or the max concurrency", default="rate")
+    parser.add_argument("--capacity_start", type=float, help="Load of the first capacity probe", default=1)
+    parser.add_argument("--capacity_max", type=float, help="Highest load to probe", default=1000)
+    parser.add_argument("--capacity_growth", type=float, help="Load multiplier between probes until the SLO is missed", default=2)
+    parser.add_argument("--capacity_precision", type=float, help="Stop bisecting once the pass/fail loads are this fraction apart", default=0.1)
+    parser.add_argument("--probe_duration", type=float, help="Seconds to run each capacity probe for", default=60)
+    parser.add_argument("--probe_cooldown", type=float, help="Seconds to let the service recover between probes", default=10)
+    parser.add_argument("--max_probes", type=int, help="Most probes to run per service", default=20)
+    parser.add_argument("--slo_percentile", type=float, help="Latency percentile the SLO is on", default=95)
+    parser.add_argument("--slo_latency", type=float, help="Max seconds for the SLO percentile", default=10)
+    parser.add_argument("--slo_error_rate", type=float, help="Max fraction of failed requests", default=0.01)
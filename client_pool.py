@@ -0,0 +1,179 @@
+import argparse
+from contextlib import asynccontextmanager, contextmanager
+import httpx
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+
+def get_host(url: str) -> str:
+    """Get the scheme and host:port a url will connect to."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class ClientPool:
+    """
+    Shared httpx clients, one connection pool per target host.
+
+    In cold mode every request gets a brand new client so each request pays
+    for its own DNS, TCP and TLS setup, like the original harness did. timeout
+    is the default for every phase of a request, connect_timeout and
+    read_timeout override it for connecting and for each wait on the response,
+    and deadline is the most a whole request may take before the runners
+    cancel it.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 600,
+        max_connections: Optional[int] = None,
+        max_keepalive: Optional[int] = None,
+        keepalive_expiry: float = 5.0,
+        http2: bool = False,
+        cold: bool = False,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.cold = cold
+        self.async_clients: Dict[str, httpx.AsyncClient] = {}
+        self.sync_clients: Dict[str, httpx.Client] = {}
+        self.connection_stats: Dict[str, Dict[str, int]] = {}
+        self.in_flight: Dict[str, int] = {}
+
+    def configure(self, args: argparse.Namespace):
+        """Apply the client pool command line arguments."""
+        self.max_connections = args.max_connections
+        self.max_keepalive = args.max_keepalive
+        self.keepalive_expiry = args.keepalive_expiry
+        self.http2 = args.http2
+        self.cold = args.cold_connections
+        self.connect_timeout = args.connect_timeout
+        if args.read_timeout is not None:
+            self.read_timeout = args.read_timeout
+        if args.deadline is not None:
+            # 0 turns the deadline off
+            self.deadline = args.deadline or None
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                raise SystemExit("--http2 requires the h2 package: pip install httpx[http2]")
+
+    def timeouts(self, limit: Optional[float] = None) -> httpx.Timeout:
+        """Get the client timeouts, each capped at limit seconds when given one."""
+        def cap(seconds: float) -> float:
+            return seconds if limit is None else min(seconds, limit)
+
+        timeouts = {}
+        if self.connect_timeout is not None:
+            timeouts["connect"] = cap(self.connect_timeout)
+        if self.read_timeout is not None:
+            timeouts["read"] = cap(self.read_timeout)
+        return httpx.Timeout(cap(self.timeout), **timeouts)
+
+    def limits(self) -> httpx.Limits:
+        if self.cold:
+            return httpx.Limits(max_connections=None, max_keepalive_connections=0)
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @asynccontextmanager
+    async def client(self, url: str):
+        """Get the async client for the host of the given url."""
+        host = get_host(url)
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        try:
+            if self.cold:
+                async with httpx.AsyncClient(timeout=self.timeouts(), limits=self.limits(), http2=self.http2) as client:
+                    yield client
+                return
+            if host not in self.async_clients:
+                self.async_clients[host] = httpx.AsyncClient(
+                    timeout=self.timeouts(),
+                    limits=self.limits(),
+                    http2=self.http2,
+                )
+            yield self.async_clients[host]
+        finally:
+            self.in_flight[host] -= 1
+
+    @contextmanager
+    def sync_client(self, url: str):
+        """Get the sync client for the host of the given url."""
+        host = get_host(url)
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        try:
+            if self.cold:
+                with httpx.Client(timeout=self.timeouts(), limits=self.limits(), http2=self.http2) as client:
+                    yield client
+                return
+            if host not in self.sync_clients:
+                self.sync_clients[host] = httpx.Client(
+                    timeout=self.timeouts(),
+                    limits=self.limits(),
+                    http2=self.http2,
+                )
+            yield self.sync_clients[host]
+        finally:
+            self.in_flight[host] -= 1
+
+    def record(self, url: str, new_connection: bool):
+        """Count a finished request against its host."""
+        host = get_host(url)
+        if host not in self.connection_stats:
+            self.connection_stats[host] = {
+                "requests": 0,
+                "new_connections": 0,
+                "reused_connections": 0,
+            }
+        stats = self.connection_stats[host]
+        stats["requests"] += 1
+        if new_connection:
+            stats["new_connections"] += 1
+        else:
+            stats["reused_connections"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": "cold" if self.cold else "reuse",
+            "http2": self.http2,
+            "timeouts": {
+                "default": self.timeout,
+                "connect": self.connect_timeout,
+                "read": self.read_timeout,
+                "deadline": self.deadline,
+            },
+            "hosts": self.connection_stats,
+        }
+
+    async def aclose(self):
+        for client in self.async_clients.values():
+            await client.aclose()
+        for client in self.sync_clients.values():
+            client.close()
+        self.async_clients = {}
+        self.sync_clients = {}
+
+
+def add_client_pool_arguments(parser: argparse.ArgumentParser):
+    """Add the client pool command line arguments."""
+    parser.add_argument("--max_connections", type=int, help="Max open connections per host", default=None)
+    parser.add_argument("--max_keepalive", type=int, help="Max idle keep-alive connections per host", default=None)
+    parser.add_argument("--keepalive_expiry", type=float, help="Seconds to keep idle connections open", default=5.0)
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 when the server supports it")
+    parser.add_argument("--cold_connections", action="store_true", help="Open a new connection for every request")
+    parser.add_argument("--connect_timeout", type=float, help="Seconds to wait for a connection to open", default=10.0)
+    parser.add_argument("--read_timeout", type=float, help="Seconds to wait for each read of a response, the script's own default (a few minutes) if not given", default=None)
+    parser.add_argument("--deadline", type=float, help="Seconds a whole request may take before it's cancelled and its slot freed, the script's own default if not given, 0 for none", default=None)
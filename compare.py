@@ -0,0 +1,269 @@
+import argparse
+from datetime import datetime
+import glob
+import json
+import math
+import os
+from statistics import NormalDist
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from latency_histogram import LatencyHistogram
+from request_errors import normalize_statuses
+from result_stats import count_failures
+
+
+class Cell:
+    """Everything compared about one target / stage across one or more runs."""
+
+    def __init__(self):
+        self.latency: Optional[LatencyHistogram] = None
+        self.num_requests = 0
+        self.errors = 0
+        # requests per second of each latency window, the samples throughput is compared on
+        self.throughputs: List[float] = []
+        self.runs = 0
+        # any run whose harness couldn't keep up makes the cell's numbers suspect
+        self.harness_saturated = False
+
+    def add(self, stats: Dict[str, Any]):
+        histogram = LatencyHistogram.from_dict(stats["latency_histogram"])
+        if self.latency is None:
+            self.latency = histogram
+        else:
+            self.latency.merge(histogram)
+        self.num_requests += stats["num_requests"]
+        # a 200 that timed out or failed in the body is an error too
+        self.errors += count_failures(stats)
+        windows = stats.get("latency_windows") or []
+        # the last window is usually cut short by the end of the stage
+        if len(windows) > 2:
+            windows = windows[:-1]
+        self.throughputs.extend(window["throughput"] for window in windows)
+        self.runs += 1
+        self.harness_saturated = self.harness_saturated or bool((stats.get("harness") or {}).get("saturated"))
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.num_requests if self.num_requests else 0.0
+
+
+def find_cells(output: Dict[str, Any], path: Tuple[str, ...] = ()) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Find every stage's stats in a results file, keyed by mode/target/stage."""
+    for key, value in output.items():
+        if not isinstance(value, dict):
+            continue
+        if "latency_histogram" in value:
+            yield "/".join(path + (str(key),)), value
+        else:
+            yield from find_cells(value, path + (str(key),))
+
+
+def load_cells(filenames: List[str]) -> Dict[str, Cell]:
+    """Load results files, pooling the cells they have in common."""
+    cells: Dict[str, Cell] = {}
+    for filename in filenames:
+        with open(filename, "r") as f:
+            output = json.load(f)
+        for key, stats in find_cells(output):
+            if not stats.get("num_requests"):
+                continue
+            if key not in cells:
+                cells[key] = Cell()
+            # JSON turned the HTTP status keys into strings
+            cells[key].add(dict(stats, statuses=normalize_statuses(stats["statuses"])))
+    return cells
+
+
+def normal_sf(z: float) -> float:
+    """Get the chance a standard normal is above z."""
+    return math.erfc(z / math.sqrt(2)) / 2
+
+
+def rank_test(baseline: Dict[int, int], candidate: Dict[int, int]) -> Tuple[float, float]:
+    """
+    One sided Mann-Whitney U test that candidate values run higher than baseline's.
+
+    Takes value counts (histogram buckets or anything else that sorts), so runs
+    of any size are compared in time proportional to the number of distinct
+    values. Values in the same bucket are ties. Gives back the chance a
+    candidate value is above a baseline one (0.5 is no change) and the p-value.
+    """
+    n_baseline = sum(baseline.values())
+    n_candidate = sum(candidate.values())
+    if not n_baseline or not n_candidate:
+        return 0.5, 1.0
+    u = 0.0
+    below = 0
+    ties = 0
+    for value in sorted(set(baseline) | set(candidate)):
+        baseline_count = baseline.get(value, 0)
+        candidate_count = candidate.get(value, 0)
+        u += candidate_count * (below + baseline_count / 2)
+        below += baseline_count
+        tied = baseline_count + candidate_count
+        ties += tied ** 3 - tied
+    total = n_baseline + n_candidate
+    mean = n_baseline * n_candidate / 2
+    variance = n_baseline * n_candidate / 12 * ((total + 1) - ties / (total * (total - 1) if total > 1 else 1))
+    if variance <= 0:
+        return u / (n_baseline * n_candidate), 1.0
+    # continuity correction
+    z = (u - mean - 0.5) / math.sqrt(variance)
+    return u / (n_baseline * n_candidate), normal_sf(z)
+
+
+def percentile_interval(histogram: LatencyHistogram, percentile: float, confidence: float) -> Tuple[Optional[float], Optional[float]]:
+    """Get a distribution free confidence interval for a percentile from the order statistics around it."""
+    n = histogram.count
+    if not n:
+        return None, None
+    p = percentile / 100
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    spread = z * math.sqrt(n * p * (1 - p))
+    low = max(math.floor(n * p - spread), 1)
+    high = min(math.ceil(n * p + spread) + 1, n)
+    return histogram.percentile(100 * low / n), histogram.percentile(100 * high / n)
+
+
+def two_proportion_test(errors_a: int, n_a: int, errors_b: int, n_b: int) -> float:
+    """One sided p-value that b's error rate is above a's."""
+    if not n_a or not n_b:
+        return 1.0
+    pooled = (errors_a + errors_b) / (n_a + n_b)
+    if pooled in [0, 1]:
+        return 1.0
+    z = (errors_b / n_b - errors_a / n_a) / math.sqrt(pooled * (1 - pooled) * (1 / n_a + 1 / n_b))
+    return normal_sf(z)
+
+
+def counts(values: List[float]) -> Dict[float, int]:
+    counted: Dict[float, int] = {}
+    for value in values:
+        counted[value] = counted.get(value, 0) + 1
+    return counted
+
+
+def relative_change(baseline: Optional[float], candidate: Optional[float]) -> Optional[float]:
+    if baseline is None or candidate is None or baseline == 0:
+        return None
+    return (candidate - baseline) / baseline
+
+
+def compare_cell(baseline: Cell, candidate: Cell, args: argparse.Namespace) -> Dict[str, Any]:
+    """Compare one cell of two runs and flag significant regressions past the thresholds."""
+    regressions = []
+    latency = {}
+    for percentile in args.percentiles:
+        baseline_value = baseline.latency.percentile(percentile)
+        candidate_value = candidate.latency.percentile(percentile)
+        baseline_low, baseline_high = percentile_interval(baseline.latency, percentile, args.confidence)
+        candidate_low, candidate_high = percentile_interval(candidate.latency, percentile, args.confidence)
+        latency[f"p{percentile:g}"] = {
+            "baseline": baseline_value,
+            "candidate": candidate_value,
+            "change": relative_change(baseline_value, candidate_value),
+            # every delta the two percentile intervals allow, so it's conservative
+            "delta_interval": [candidate_low - baseline_high, candidate_high - baseline_low],
+        }
+    shift, latency_p = rank_test(baseline.latency.counts, candidate.latency.counts)
+    for name, percentile_stats in latency.items():
+        change = percentile_stats["change"]
+        if latency_p < args.alpha and percentile_stats["delta_interval"][0] > 0 and change is not None and change > args.threshold:
+            regressions.append(f"{name} latency up {change * 100:.0f}% (p={latency_p:.3g})")
+
+    baseline_rate = sum(baseline.throughputs) / len(baseline.throughputs) if baseline.throughputs else None
+    candidate_rate = sum(candidate.throughputs) / len(candidate.throughputs) if candidate.throughputs else None
+    throughput_change = relative_change(baseline_rate, candidate_rate)
+    # throughput regresses when the candidate's windows run lower, the same test with the runs swapped
+    _, throughput_p = rank_test(counts(candidate.throughputs), counts(baseline.throughputs))
+    if throughput_p < args.alpha and throughput_change is not None and -throughput_change > args.threshold:
+        regressions.append(f"throughput down {-throughput_change * 100:.0f}% (p={throughput_p:.3g})")
+
+    error_p = two_proportion_test(baseline.errors, baseline.num_requests, candidate.errors, candidate.num_requests)
+    error_change = candidate.error_rate - baseline.error_rate
+    if error_p < args.alpha and error_change > args.error_rate_threshold:
+        regressions.append(f"error rate up {error_change * 100:.1f} points (p={error_p:.3g})")
+
+    return {
+        "requests": {"baseline": baseline.num_requests, "candidate": candidate.num_requests},
+        "latency": latency,
+        "latency_shift": shift,
+        "latency_p": latency_p,
+        "throughput": {"baseline": baseline_rate, "candidate": candidate_rate, "change": throughput_change, "p": throughput_p},
+        "error_rate": {"baseline": baseline.error_rate, "candidate": candidate.error_rate, "p": error_p},
+        "regressions": regressions,
+        "harness_saturated": baseline.harness_saturated or candidate.harness_saturated,
+    }
+
+
+def compare_runs(baseline: Dict[str, Cell], candidate: Dict[str, Cell], args: argparse.Namespace) -> Dict[str, Any]:
+    """Compare every cell two runs have in common."""
+    compared = {}
+    for key in sorted(set(baseline) & set(candidate)):
+        if min(baseline[key].num_requests, candidate[key].num_requests) < args.min_requests:
+            continue
+        compared[key] = compare_cell(baseline[key], candidate[key], args)
+    return {
+        "cells": compared,
+        "only_in_baseline": sorted(set(baseline) - set(candidate)),
+        "only_in_candidate": sorted(set(candidate) - set(baseline)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=("Compare Stress Test Results"))
+    parser.add_argument("results", type=str, nargs="*", help="Results files, the first is the baseline the others are each compared to")
+    parser.add_argument("--baseline_dir", type=str, help="Pool every results file in this directory into the baseline", default=None)
+    parser.add_argument("--percentiles", type=str, help="Comma separated latency percentiles to compare", default="50,95,99")
+    parser.add_argument("--alpha", type=float, help="Significance level a change has to pass to count", default=0.01)
+    parser.add_argument("--confidence", type=float, help="Confidence of the percentile intervals", default=0.95)
+    parser.add_argument("--threshold", type=float, help="Fraction slower or less throughput that counts as a regression", default=0.1)
+    parser.add_argument("--error_rate_threshold", type=float, help="Increase in error rate that counts as a regression", default=0.01)
+    parser.add_argument("--min_requests", type=int, help="Skip cells with fewer requests than this in either run", default=30)
+    args = parser.parse_args()
+    args.percentiles = [float(percentile) for percentile in args.percentiles.split(",")]
+
+    if args.baseline_dir is not None:
+        baseline_files = sorted(glob.glob(os.path.join(args.baseline_dir, "*.json")))
+        candidate_files = args.results
+    else:
+        baseline_files = args.results[:1]
+        candidate_files = args.results[1:]
+    if not baseline_files or not candidate_files:
+        raise SystemExit("Give a baseline (first results file or --baseline_dir) and at least one results file to compare to it")
+
+    baseline = load_cells(baseline_files)
+    report = {"baseline": baseline_files, "comparisons": {}}
+    regressions = 0
+    for filename in candidate_files:
+        comparison = compare_runs(baseline, load_cells([filename]), args)
+        report["comparisons"][filename] = comparison
+        print(f"{filename} against {', '.join(baseline_files)}")
+        for key, cell in comparison["cells"].items():
+            p95 = cell["latency"].get("p95", next(iter(cell["latency"].values())))
+            throughput_change = cell["throughput"]["change"]
+            print(
+                f"  {key}: p95 {(p95['change'] or 0) * 100:+.0f}%, "
+                f"throughput {(throughput_change or 0) * 100:+.0f}%, "
+                f"error rate {cell['error_rate']['baseline'] * 100:.1f}% -> {cell['error_rate']['candidate'] * 100:.1f}%"
+            )
+            for regression in cell["regressions"]:
+                if cell["harness_saturated"]:
+                    # the harness was the bottleneck, so it isn't the target's regression
+                    print(f"    Not counted, harness saturated: {regression}")
+                    continue
+                print(f"    Regression: {regression}")
+                regressions += 1
+    report["regressions"] = regressions
+
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    with open(f"results/compare_{timestamp}.json", "w") as f:
+        json.dump(report, f, indent = 2)
+    print(f"{regressions} significant regressions")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
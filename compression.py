@@ -0,0 +1,199 @@
+import argparse
+import gzip
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from cache_experiment import describe, ratio, run_pool
+from result_stats import ResultStats
+
+ENCODINGS = ["identity", "gzip", "zstd"]
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def check_encodings(encodings: List[str]):
+    """Fail early on unknown encodings, or zstd without the zstandard package."""
+    for encoding in encodings:
+        if encoding not in ENCODINGS:
+            raise SystemExit(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+    if "zstd" in encodings:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise SystemExit("zstd compression requires zstandard: pip install zstandard")
+
+
+def compress(body: bytes, encoding: str) -> Tuple[bytes, float]:
+    """Compress a request body, giving back the compressed bytes and the seconds it took."""
+    start_time = time.perf_counter()
+    if encoding == "gzip":
+        body = gzip.compress(body, GZIP_LEVEL)
+    elif encoding == "zstd":
+        import zstandard
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    elif encoding != "identity":
+        raise ValueError(f"Unknown encoding {encoding}")
+    return body, time.perf_counter() - start_time
+
+
+def encode_request(body: bytes, headers: Dict[str, str], request_encoding: Optional[str], accept_encoding: Optional[str]) -> Tuple[bytes, Dict[str, str], Optional[float]]:
+    """Compress a request body and set its encoding headers, giving back the body, headers and seconds spent compressing."""
+    compress_time = None
+    if request_encoding is not None and request_encoding != "identity":
+        body, compress_time = compress(body, request_encoding)
+        headers = {**headers, "Content-Encoding": request_encoding}
+    if accept_encoding is not None:
+        headers = {**headers, "Accept-Encoding": accept_encoding}
+    return body, headers, compress_time
+
+
+class Decompressor:
+    """
+    Undoes a response's Content-Encoding by hand, a chunk at a time.
+
+    httpx would decode the body inside its own reads, mixed in with waiting on the
+    network, so the compression mode reads the raw body and decodes it here,
+    where the CPU it takes and the bytes that came over the wire can be counted.
+    """
+
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = (encoding or "identity").strip().lower()
+        self.wire_bytes = 0
+        self.seconds = 0.0
+        if self.encoding == "gzip":
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif self.encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+        elif self.encoding == "zstd":
+            import zstandard
+            self.decoder = zstandard.ZstdDecompressor().decompressobj()
+        elif self.encoding == "identity":
+            self.decoder = None
+        else:
+            raise ValueError(f"Can't decode a {self.encoding} response")
+
+    def decompress(self, chunk: bytes) -> bytes:
+        self.wire_bytes += len(chunk)
+        if self.decoder is None:
+            return chunk
+        start_time = time.perf_counter()
+        try:
+            return self.decoder.decompress(chunk)
+        except Exception as e:
+            raise ValueError(f"Invalid {self.encoding} response body: {e}")
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+    def flush(self) -> bytes:
+        if self.decoder is None or not hasattr(self.decoder, "flush"):
+            return b""
+        start_time = time.perf_counter()
+        chunk = self.decoder.flush()
+        self.seconds += time.perf_counter() - start_time
+        return chunk
+
+
+def add_compression_fields(result: Dict[str, Any], body: bytes, compress_time: Optional[float], decompressor: Optional[Decompressor]):
+    """Add what a compression mode request sent, received and spent on compression to its result."""
+    result["request_bytes"] = len(body)
+    result["wire_bytes"] = decompressor.wire_bytes if decompressor is not None else None
+    result["response_encoding"] = decompressor.encoding if decompressor is not None else None
+    result["phases"] = {
+        **(result.get("phases") or {}),
+        "compress": compress_time,
+        "decompress": decompressor.seconds if decompressor is not None else None,
+    }
+
+
+def get_combination_key(request_encoding: str, accept_encoding: str) -> str:
+    """Get the output key for a request encoding / Accept-Encoding combination."""
+    return f"{request_encoding}_{accept_encoding}"
+
+
+def mean(total: float, count: int) -> Optional[float]:
+    return total / count if count else None
+
+
+class CompressionMatrix:
+    """
+    Measure what compression buys against one target.
+
+    Every combination of request body encoding and Accept-Encoding sends
+    compression_requests requests with compression_concurrency of them in
+    flight, through send(request_encoding, accept_encoding). The summary has,
+    per combination, the latency, bytes sent and received on the wire against
+    the decoded response size, the client CPU spent compressing requests and
+    decompressing responses and the speedup over sending everything
+    uncompressed.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, str], Awaitable[Dict[str, Any]]],
+        on_result: Callable[[str, ResultStats, Dict[str, Any]], None],
+        on_stage: Callable[[str, ResultStats, float], None],
+        args: argparse.Namespace,
+    ):
+        self.send = send
+        self.on_result = on_result
+        self.on_stage = on_stage
+        self.request_encodings = args.request_encodings.split(",")
+        self.accept_encodings = args.accept_encodings.split(",")
+        self.num_requests = args.compression_requests
+        self.concurrency = args.compression_concurrency
+
+    async def run_combination(self, request_encoding: str, accept_encoding: str) -> Dict[str, Any]:
+        stage_key = get_combination_key(request_encoding, accept_encoding)
+        stats = ResultStats()
+        totals = {"request_bytes": 0, "wire_bytes": 0, "compress": 0.0, "decompress": 0.0}
+        response_encodings: Dict[str, int] = {}
+
+        def record(result: Dict[str, Any]):
+            for key in ["request_bytes", "wire_bytes"]:
+                totals[key] += result.get(key) or 0
+            for phase in ["compress", "decompress"]:
+                totals[phase] += (result.get("phases") or {}).get(phase) or 0.0
+            encoding = result.get("response_encoding")
+            if encoding is not None:
+                response_encodings[encoding] = response_encodings.get(encoding, 0) + 1
+            self.on_result(stage_key, stats, result)
+
+        total_time = await run_pool(lambda: self.send(request_encoding, accept_encoding), record, self.num_requests, self.concurrency)
+        self.on_stage(stage_key, stats, total_time)
+        count = stats.num_requests
+        return {
+            **describe(stats, total_time),
+            "request_bytes": mean(totals["request_bytes"], count),
+            "wire_bytes": mean(totals["wire_bytes"], count),
+            "response_bytes": mean(stats.response_bytes, count),
+            "compression_ratio": ratio(stats.response_bytes, totals["wire_bytes"]),
+            "compress_time": mean(totals["compress"], count),
+            "decompress_time": mean(totals["decompress"], count),
+            # what the server actually answered with, it's free to ignore Accept-Encoding
+            "response_encodings": response_encodings,
+        }
+
+    async def run(self) -> Dict[str, Any]:
+        combinations = {}
+        for request_encoding in self.request_encodings:
+            for accept_encoding in self.accept_encodings:
+                print(f"  request {request_encoding}, accept {accept_encoding}")
+                combinations[get_combination_key(request_encoding, accept_encoding)] = await self.run_combination(request_encoding, accept_encoding)
+        baseline = combinations.get(get_combination_key("identity", "identity"))
+        for combination in combinations.values():
+            combination["speedup"] = ratio(baseline["p50"], combination["p50"]) if baseline else None
+        fastest = min(
+            (key for key, combination in combinations.items() if combination["p50"] is not None),
+            key=lambda key: combinations[key]["p50"],
+            default=None,
+        )
+        return {"fastest": fastest, "combinations": combinations}
+
+
+def add_compression_arguments(parser: argparse.ArgumentParser):
+    """Add the compression mode command line arguments."""
+    parser.add_argument("--request_encodings", type=str, help="Comma separated request body encodings to try: identity, gzip, zstd (needs zstandard)", default="identity,gzip")
+    parser.add_argument("--accept_encodings", type=str, help="Comma separated Accept-Encoding values to try: identity, gzip, zstd (needs zstandard)", default="identity,gzip")
+    parser.add_argument("--compression_requests", type=int, help="Requests sent with each encoding combination", default=50)
+    parser.add_argument("--compression_concurrency", type=int, help="Requests in flight in the compression mode", default=1)
@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import json
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from payload_cache import merge_cache_stats
+from result_stats import ResultStats
+from results_sink import ResultsSink
+
+# worker messages carry whole batches of records on one line
+STREAM_LIMIT = 1 << 26
+# rate stats, profile stage stats and harness stats fields that add up or take the max across workers
+SUM_KEYS = {"target_rate", "achieved_rate", "completed_rate", "scheduled", "sent", "dropped", "late", "reasons"}
+MAX_KEYS = {"duration", "max_send_lag", "drain_time", "max_cpu", "max_rss", "max_tasks", "max_loop_lag", "saturated"}
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Split a host:port address."""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+def merge_counters(merged: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine the rate or stage stats two workers reported for the same stage."""
+    merged = dict(merged)
+    for key, value in other.items():
+        if key not in merged:
+            merged[key] = value
+        elif isinstance(value, dict) and isinstance(merged[key], dict):
+            merged[key] = merge_counters(merged[key], value)
+        elif key in SUM_KEYS:
+            merged[key] += value
+        elif key in MAX_KEYS:
+            merged[key] = max((value for value in [merged[key], value] if value is not None), default=None)
+    return merged
+
+
+def merge_connections(merged: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Add up the per host connection counters of two workers' client pools."""
+    merged = dict(merged, hosts=dict(merged.get("hosts", {})))
+    for host, counters in other.get("hosts", {}).items():
+        host_counters = dict(merged["hosts"].get(host, {}))
+        for key, value in counters.items():
+            host_counters[key] = host_counters.get(key, 0) + value
+        merged["hosts"][host] = host_counters
+    for key, value in other.items():
+        if key != "hosts":
+            merged.setdefault(key, value)
+    return merged
+
+
+class RecordStream:
+    """File-like end of a worker's connection that ResultsSink writes its record lines to."""
+
+    def __init__(self, worker: "Worker"):
+        self.worker = worker
+
+    def write(self, text: str):
+        # the sink writes from sync code, Worker.drain holds back new requests until these go out
+        self.worker.send_nowait({"type": "records", "text": text})
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Worker:
+    """
+    A worker process's link to its coordinator.
+
+    The worker connects, gets its index, the worker count and the coordinator's
+    command line arguments back, runs its share of the load and streams its records
+    and finished stages back instead of writing any files itself. Before each stage
+    it waits at a barrier until every worker has got there, so their stages start
+    together. Outside of worker mode index is 0 of 1, so share() hands back the
+    whole load and barrier() doesn't wait. A slow link to the coordinator pushes
+    back through drain(), which the lookups wait on before every request, so the
+    worker never buffers more than about one flush of records.
+    """
+
+    def __init__(self):
+        self.index = 0
+        self.num_workers = 1
+        self.reader = None
+        self.writer = None
+        self.barriers: Dict[str, asyncio.Event] = {}
+        self.listener: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    async def connect(self, address: str) -> argparse.Namespace:
+        """Connect to the coordinator and wait for the go, returning the arguments to run with."""
+        host, port = parse_address(address)
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT)
+        await self.send({"type": "hello"})
+        start = json.loads(await self.reader.readline())
+        self.index = start["index"]
+        self.num_workers = start["num_workers"]
+        args = start["args"]
+        if args.get("seed") is not None:
+            # the same seed everywhere would line up every worker's poisson arrivals
+            args["seed"] += self.index
+        print(f"Running as worker {self.index + 1} of {self.num_workers}")
+        return argparse.Namespace(**args)
+
+    def share(self, total: Union[int, float]) -> Union[int, float]:
+        """Get this worker's share of a request count, concurrency or rate."""
+        if isinstance(total, int):
+            return total // self.num_workers + (1 if self.index < total % self.num_workers else 0)
+        return total / self.num_workers
+
+    async def send(self, message: Dict[str, Any]):
+        self.send_nowait(message)
+        await self.writer.drain()
+
+    def send_nowait(self, message: Dict[str, Any]):
+        """Queue a message on the link without waiting for it to go out."""
+        self.writer.write(encode_message(message))
+
+    async def drain(self):
+        """Wait until the link has sent enough of what's queued on it, right away outside of worker mode."""
+        if self.connected:
+            await self.writer.drain()
+
+    def records(self) -> RecordStream:
+        return RecordStream(self)
+
+    async def listen(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if message["type"] == "go":
+                self.barriers.setdefault(message["name"], asyncio.Event()).set()
+
+    async def barrier(self, name: str):
+        """Wait until every worker has reached the barrier called name."""
+        if not self.connected:
+            return
+        if self.listener is None:
+            self.listener = asyncio.create_task(self.listen())
+        await self.send({"type": "barrier", "name": name})
+        await self.barriers.setdefault(name, asyncio.Event()).wait()
+
+    def send_stage(self, mode: str, target: str, stage: str, stats: ResultStats, total_time: float, extra: Dict[str, Any]):
+        """Hand a finished stage to the coordinator to merge with the other workers'."""
+        self.send_nowait({
+            "type": "stage",
+            "mode": mode,
+            "target": target,
+            "stage": stage,
+            "total_time": total_time,
+            "stats": stats.to_state(),
+            "extra": extra,
+        })
+
+    async def close(self, connections: Dict[str, Any], payload_cache: Dict[str, Any]):
+        self.send_nowait({"type": "done", "connections": connections, "payload_cache": payload_cache})
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        await self.writer.drain()
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.writer = None
+
+
+class Coordinator:
+    """
+    Run the load from several worker processes and merge what they send back.
+
+    Local workers are started as copies of the running script and remote workers
+    connect on their own (run the script with --coordinator host:port elsewhere).
+    Once every worker has connected they're all told to start at once, their
+    records are appended to the coordinator's results sink as they arrive and each
+    stage is merged through ResultStats.merge and handed to on_stage whenever
+    another worker finishes it. A barrier is released, with a go to every worker,
+    once each worker still running has reached it. No broker is needed, the
+    coordinator is a plain TCP server speaking JSON lines.
+    """
+
+    def __init__(self, sink: ResultsSink, on_stage: Callable[[str, str, str, Dict[str, Any]], None]):
+        self.sink = sink
+        self.on_stage = on_stage
+        self.stages: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.connections: Dict[str, Any] = {}
+        self.payload_cache: Dict[str, Any] = {}
+        self.writers: List[asyncio.StreamWriter] = []
+        # barrier name -> workers waiting at it
+        self.barriers: Dict[str, int] = {}
+        self.num_workers = 0
+        self.num_finished = 0
+        self.all_connected = asyncio.Event()
+        self.started = asyncio.Event()
+        self.all_finished = asyncio.Event()
+
+    def add_stage(self, message: Dict[str, Any]):
+        key = (message["mode"], message["target"], message["stage"])
+        stats = ResultStats.from_state(message["stats"])
+        if key not in self.stages:
+            self.stages[key] = {
+                "stats": stats,
+                "total_time": message["total_time"],
+                "extra": message["extra"],
+                "workers": 1,
+            }
+        else:
+            merged = self.stages[key]
+            merged["stats"].merge(stats)
+            merged["total_time"] = max(merged["total_time"], message["total_time"])
+            merged["extra"] = merge_counters(merged["extra"], message["extra"])
+            merged["workers"] += 1
+        merged = self.stages[key]
+        result_stats = merged["stats"].to_dict(merged["total_time"])
+        result_stats.update(merged["extra"])
+        result_stats["workers"] = merged["workers"]
+        self.on_stage(*key, result_stats)
+
+    def release_barriers(self):
+        """Send a go for every barrier all of the workers still running are waiting at."""
+        for name, waiting in list(self.barriers.items()):
+            if waiting >= self.num_workers - self.num_finished:
+                del self.barriers[name]
+                for writer in self.writers:
+                    if not writer.is_closing():
+                        writer.write(encode_message({"type": "go", "name": name}))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await reader.readline()
+        if not hello or self.all_connected.is_set():
+            writer.close()
+            return
+        self.writers.append(writer)
+        if len(self.writers) == self.num_workers:
+            self.all_connected.set()
+        await self.started.wait()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    print("Lost a worker before it finished")
+                    break
+                message = json.loads(line)
+                if message["type"] == "records":
+                    self.sink.write_lines(message["text"])
+                elif message["type"] == "stage":
+                    self.add_stage(message)
+                elif message["type"] == "barrier":
+                    self.barriers[message["name"]] = self.barriers.get(message["name"], 0) + 1
+                    self.release_barriers()
+                elif message["type"] == "done":
+                    self.connections = merge_connections(self.connections, message["connections"])
+                    self.payload_cache = merge_cache_stats(self.payload_cache, message["payload_cache"])
+                    break
+        finally:
+            writer.close()
+            self.num_finished += 1
+            # a worker that's gone mustn't hold the others up
+            self.release_barriers()
+            if self.num_finished == self.num_workers:
+                self.all_finished.set()
+
+    async def run(self, args: argparse.Namespace):
+        """Start the workers, wait until all of them have finished and flush the merged records."""
+        self.num_workers = args.workers + args.remote_workers
+        host, port = parse_address(args.listen)
+        server = await asyncio.start_server(self.handle, host, port, limit=STREAM_LIMIT)
+        port = server.sockets[0].getsockname()[1]
+        print(f"Coordinator waiting for {self.num_workers} workers on {host}:{port}")
+        processes = []
+        for _ in range(args.workers):
+            processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, sys.argv[0], "--coordinator", f"{'127.0.0.1' if host in ['0.0.0.0', ''] else host}:{port}",
+                # the event loop is picked before a worker hears its arguments from the coordinator
+                *(["--event_loop", args.event_loop] if getattr(args, "event_loop", "asyncio") != "asyncio" else []),
+            ))
+        waiters = [asyncio.create_task(process.wait()) for process in processes]
+        connected = asyncio.create_task(self.all_connected.wait())
+        await asyncio.wait([connected] + waiters, return_when=asyncio.FIRST_COMPLETED)
+        if not self.all_connected.is_set():
+            connected.cancel()
+            server.close()
+            raise RuntimeError("A local worker exited before every worker connected")
+
+        for index, writer in enumerate(self.writers):
+            writer.write(encode_message({
+                "type": "start",
+                "index": index,
+                "num_workers": self.num_workers,
+                "args": vars(args),
+            }))
+        self.started.set()
+        async with server:
+            await self.all_finished.wait()
+            await asyncio.gather(*waiters)
+        self.sink.flush()
+
+
+def add_distributed_arguments(parser: argparse.ArgumentParser):
+    """Add the coordinator and worker command line arguments."""
+    parser.add_argument("--workers", type=int, help="Local worker processes to spread the load over", default=0)
+    parser.add_argument("--remote_workers", type=int, help="Workers on other machines for the coordinator to wait for", default=0)
+    parser.add_argument("--listen", type=str, help="Coordinator host:port, use 0.0.0.0:<port> for remote workers", default="127.0.0.1:0")
+    parser.add_argument("--coordinator", type=str, help="Run as a worker of the coordinator at host:port", default=None)
@@ -0,0 +1,26 @@
+import argparse
+import asyncio
+from typing import Any, Callable, Coroutine
+
+EVENT_LOOPS = ["asyncio", "uvloop"]
+
+
+def run(main: Callable[[], Coroutine[Any, Any, Any]]):
+    """Run a script's main on the event loop picked with --event_loop."""
+    # the loop has to be picked before it starts, which is before main parses the rest of the arguments
+    parser = argparse.ArgumentParser(add_help=False)
+    add_event_loop_arguments(parser)
+    args, _ = parser.parse_known_args()
+    if args.event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            raise SystemExit("--event_loop uvloop requires uvloop: pip install uvloop")
+        uvloop.run(main())
+        return
+    asyncio.run(main())
+
+
+def add_event_loop_arguments(parser: argparse.ArgumentParser):
+    """Add the event loop command line arguments."""
+    parser.add_argument("--event_loop", type=str, choices=EVENT_LOOPS, help="Event loop to run on, uvloop (pip install uvloop) has less overhead per request at high concurrency", default="asyncio")
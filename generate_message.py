@@ -1,11 +1,11 @@
 from typing import Any, Dict, List, Optional
 
 
-def generate_kp_message(curies: List[str], kp_overrides: Optional[Dict[str, Any]] = {}) -> Dict[str, Any]:
-    """Create a message to send to Translator services"""
+def generate_kp_message(curies: List[str], kp_overrides: Optional[Dict[str, Any]] = {}, bypass_cache: Optional[bool] = None) -> Dict[str, Any]:
+    """Create a message to send to Translator services, only asking about the cache when bypass_cache is given"""
     predicates = kp_overrides.get("predicates") or ["biolink:treats_or_applied_or_studied_to_treat"]
 
-    return {
+    message = {
         "message": {
             "query_graph": {
                 "nodes": {
@@ -28,9 +28,12 @@ def generate_kp_message(curies: List[str], kp_overrides: Optional[Dict[str, Any]
             },
         },
     }
+    if bypass_cache is not None:
+        message["bypass_cache"] = bypass_cache
+    return message
 
 
-def generate_ara_message():
+def generate_ara_message(bypass_cache: bool = True):
     return {
         "message": {
             "query_graph": {
@@ -61,5 +64,5 @@ def generate_ara_message():
                 }
             }
         },
-        "bypass_cache": True,
+        "bypass_cache": bypass_cache,
     }
\ No newline at end of file
@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import os
+import resource
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from latency_histogram import LatencyHistogram, WindowedHistogram
+
+
+def get_rss() -> int:
+    """Get the current resident memory of this process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # no /proc, settle for the peak (kilobytes on linux, bytes on macos)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a callback that should fire every interval seconds.
+
+    A harness whose loop is busy parsing responses or scheduling requests sends late
+    and times late, so lag here means the numbers are the harness's, not the target's.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lag = LatencyHistogram()
+        self.task: Optional[asyncio.Task] = None
+
+    async def sample(self):
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag.record(max(time.perf_counter() - start_time - self.interval, 0))
+
+    def start(self):
+        self.lag = LatencyHistogram()
+        self.task = asyncio.create_task(self.sample())
+
+    async def stop(self) -> Dict[str, Any]:
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return self.lag.summary()
+
+
+def count_sockets() -> Optional[int]:
+    """Get how many sockets this process has open, None without /proc."""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            # closed since it was listed
+            pass
+    return sockets
+
+
+class HarnessMonitor:
+    """
+    Watches the load generator itself for the whole run, to tell its stalls from the target's.
+
+    Loop lag is sampled every interval seconds like LoopLagMonitor does, into one
+    histogram per second of the run, and CPU, RSS, open sockets and running
+    tasks once every sample_interval seconds. summary cuts out any stage's slice
+    of that afterwards, so stages don't have to start or stop anything. A stage whose p99 loop lag or
+    CPU went past the limits is marked saturated: its latencies include time the
+    harness sat on responses.
+    """
+
+    def __init__(self, interval: float = 0.01, sample_interval: float = 1.0):
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.max_loop_lag = 0.1
+        self.max_cpu = 0.9
+        self.start_time = time.time()
+        self.lag = WindowedHistogram(1.0)
+        # (wall time, cpu seconds, rss, sockets, tasks)
+        self.samples: List[Tuple[float, float, int, Optional[int], int]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def configure(self, args: argparse.Namespace):
+        self.max_loop_lag = args.max_loop_lag
+        self.max_cpu = args.max_harness_cpu
+
+    def sample_resources(self):
+        try:
+            tasks = len(asyncio.all_tasks())
+        except RuntimeError:
+            tasks = 0
+        self.samples.append((time.time(), time.process_time(), get_rss(), count_sockets(), tasks))
+
+    async def sample(self):
+        next_sample = 0.0
+        while True:
+            started_at = time.time()
+            start_time = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag.record(started_at - self.start_time, max(time.perf_counter() - start_time - self.interval, 0))
+            if start_time >= next_sample:
+                self.sample_resources()
+                next_sample = start_time + self.sample_interval
+
+    def start(self):
+        self.start_time = time.time()
+        self.lag = WindowedHistogram(1.0)
+        self.samples = []
+        self.sample_resources()
+        self.task = asyncio.create_task(self.sample())
+
+    def summary(self, start_time: Optional[float] = None, end_time: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Summarize the harness between start_time and end_time, the whole run by default.
+
+        CPU is measured from the last resource sample before start_time, and isn't
+        used to mark a stage shorter than sample_interval saturated.
+        """
+        self.sample_resources()
+        start_time = self.start_time if start_time is None else start_time
+        end_time = time.time() if end_time is None else end_time
+        # the last sample before the stage gives its CPU a starting point
+        before = [sample for sample in self.samples if sample[0] <= start_time]
+        during = before[-1:] + [sample for sample in self.samples if start_time < sample[0] <= end_time]
+        cpu = None
+        max_cpu = 0.0
+        for (wall, cpu_seconds, *_), (next_wall, next_cpu_seconds, *_) in zip(during, during[1:]):
+            if next_wall > wall:
+                max_cpu = max(max_cpu, (next_cpu_seconds - cpu_seconds) / (next_wall - wall))
+        if len(during) >= 2 and during[-1][0] > during[0][0]:
+            cpu = (during[-1][1] - during[0][1]) / (during[-1][0] - during[0][0])
+        sockets = [sample[3] for sample in during if sample[3] is not None]
+        summary = {
+            "cpu": cpu,
+            "max_cpu": max_cpu,
+            "max_rss": max((sample[2] for sample in during), default=None),
+            "max_sockets": max(sockets) if sockets else None,
+            "max_tasks": max((sample[4] for sample in during), default=None),
+        }
+        reasons = []
+        lag = LatencyHistogram(self.lag.precision_bits)
+        first = int((start_time - self.start_time) // self.lag.window)
+        last = int((end_time - self.start_time) // self.lag.window)
+        for index, histogram in self.lag.windows.items():
+            if first <= index <= last:
+                lag.merge(histogram)
+        summary["loop_lag"] = lag.summary()
+        summary["max_loop_lag"] = lag.max or 0.0
+        p99 = lag.percentile(99)
+        if p99 is not None and p99 > self.max_loop_lag:
+            reasons.append(f"p99 loop lag {p99 * 1e3:.0f}ms")
+        # a stage shorter than a sample interval is mostly measured over whatever ran before it
+        if cpu is not None and cpu > self.max_cpu and end_time - start_time >= self.sample_interval:
+            reasons.append(f"{cpu * 100:.0f}% CPU")
+        summary["saturated"] = bool(reasons)
+        summary["reasons"] = reasons
+        return summary
+
+    def check(self, stage: str, start_time: float, end_time: Optional[float] = None) -> Dict[str, Any]:
+        """Summarize a stage, warning when the harness was too busy to trust its numbers."""
+        summary = self.summary(start_time, end_time)
+        if summary["saturated"]:
+            print(f"Harness saturated during {stage} ({', '.join(summary['reasons'])}), its latencies are the harness's as much as the target's")
+        return summary
+
+    async def stop(self) -> Dict[str, Any]:
+        """Stop sampling and summarize the whole run."""
+        summary = self.summary()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        return summary
+
+
+def add_harness_monitor_arguments(parser: argparse.ArgumentParser):
+    """Add the harness saturation command line arguments."""
+    parser.add_argument("--max_loop_lag", type=float, help="Seconds of p99 event loop lag past which a stage is marked saturated", default=0.1)
+    parser.add_argument("--max_harness_cpu", type=float, help="Fraction of a core the harness can use before a stage is marked saturated", default=0.9)
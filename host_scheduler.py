@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from client_pool import get_host
+
+
+def group_by_host(targets: Dict[str, dict]) -> Dict[str, List[Tuple[str, dict]]]:
+    """Group targets by the host their url points at, keeping their order."""
+    groups: Dict[str, List[Tuple[str, dict]]] = {}
+    for infores, target in targets.items():
+        groups.setdefault(get_host(target["url"]), []).append((infores, target))
+    return groups
+
+
+class HostScheduler:
+    """
+    Runs the tests of many targets, interleaving hosts instead of targets.
+
+    Targets that share a host (like all the automat routes) take turns, at most
+    targets_per_host at a time, so one target's load doesn't show up in
+    another's numbers, while targets on different hosts run side by side, at
+    most max_parallel_hosts hosts at a time.
+    """
+
+    def __init__(self, max_parallel_hosts: Optional[int] = None, targets_per_host: int = 1):
+        self.max_parallel_hosts = max_parallel_hosts
+        self.targets_per_host = targets_per_host
+
+    def configure(self, args: argparse.Namespace):
+        self.max_parallel_hosts = args.max_parallel_hosts
+        self.targets_per_host = args.targets_per_host
+
+    async def run(self, targets: Dict[str, dict], run_target: Callable[[str, dict], Awaitable[None]]):
+        groups = group_by_host(targets)
+        hosts = asyncio.Semaphore(self.max_parallel_hosts or len(groups) or 1)
+
+        async def run_host(host_targets: List[Tuple[str, dict]]):
+            async with hosts:
+                slots = asyncio.Semaphore(self.targets_per_host)
+
+                async def run_one(infores: str, target: dict):
+                    async with slots:
+                        await run_target(infores, target)
+
+                await asyncio.gather(*[run_one(infores, target) for infores, target in host_targets])
+
+        await asyncio.gather(*[run_host(host_targets) for host_targets in groups.values()])
+
+
+class ConcurrencyBudget:
+    """
+    Caps how many requests are in flight per host and in total.
+
+    Requests wait for a slot before they go out, the host's first and then the
+    global one, and the wait is handed back so it can be recorded next to the
+    request's other phases. Without any limits nothing waits and None is handed
+    back, but the peak in-flight counts are still tracked.
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None, max_per_host: Optional[int] = None):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.global_slots: Optional[asyncio.Semaphore] = None
+        self.host_slots: Dict[str, asyncio.Semaphore] = {}
+        self.in_flight = 0
+        self.host_in_flight: Dict[str, int] = {}
+        self.peak_in_flight = 0
+        self.peak_host_in_flight: Dict[str, int] = {}
+        self.waits = 0
+        self.max_wait = 0.0
+
+    def configure(self, args: argparse.Namespace):
+        self.max_in_flight = args.global_in_flight_limit
+        self.max_per_host = args.host_in_flight_limit
+
+    @property
+    def limited(self) -> bool:
+        return self.max_in_flight is not None or self.max_per_host is not None
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        """Hold a request slot for url's host, yielding how long it took to get one."""
+        host = get_host(url)
+        start_time = time.perf_counter()
+        host_slot = None
+        if self.max_per_host is not None:
+            if host not in self.host_slots:
+                self.host_slots[host] = asyncio.Semaphore(self.max_per_host)
+            host_slot = self.host_slots[host]
+            await host_slot.acquire()
+        if self.max_in_flight is not None and self.global_slots is None:
+            self.global_slots = asyncio.Semaphore(self.max_in_flight)
+        try:
+            if self.global_slots is not None:
+                await self.global_slots.acquire()
+        except BaseException:
+            if host_slot is not None:
+                host_slot.release()
+            raise
+        wait = time.perf_counter() - start_time
+        if wait > 0.001:
+            self.waits += 1
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        self.host_in_flight[host] = self.host_in_flight.get(host, 0) + 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.peak_host_in_flight[host] = max(self.peak_host_in_flight.get(host, 0), self.host_in_flight[host])
+        try:
+            yield wait if self.limited else None
+        finally:
+            self.in_flight -= 1
+            self.host_in_flight[host] -= 1
+            if self.global_slots is not None:
+                self.global_slots.release()
+            if host_slot is not None:
+                host_slot.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "global_limit": self.max_in_flight,
+            "host_limit": self.max_per_host,
+            "peak_in_flight": self.peak_in_flight,
+            "peak_host_in_flight": self.peak_host_in_flight,
+            "waits": self.waits,
+            "max_wait": self.max_wait,
+        }
+
+
+def add_host_scheduler_arguments(parser: argparse.ArgumentParser):
+    """Add the host scheduling and in-flight budget command line arguments."""
+    parser.add_argument("--max_parallel_hosts", type=int, help="Most hosts to test at the same time, all of them by default", default=None)
+    parser.add_argument("--targets_per_host", type=int, help="Targets on the same host to test at the same time", default=1)
+    parser.add_argument("--global_in_flight_limit", type=int, help="Most requests in flight across all hosts", default=None)
+    parser.add_argument("--host_in_flight_limit", type=int, help="Most requests in flight to any one host", default=None)
@@ -1,124 +1,188 @@
 import argparse
 import asyncio
 from datetime import datetime
-import httpx
+import itertools
 import json
+import math
+import random
+import time
 from tqdm import tqdm
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
+from batch_model import add_batch_model_arguments, fine_batch_sizes, recommend
+from cache_experiment import CacheExperiment, add_cache_arguments
+from capacity_finder import CapacityFinder, add_capacity_arguments, get_probe_key
+from client_pool import ClientPool, add_client_pool_arguments
+from event_loop import add_event_loop_arguments, run
 from generate_message import generate_kp_message
+from harness_monitor import HarnessMonitor, add_harness_monitor_arguments
+from host_scheduler import ConcurrencyBudget, HostScheduler, add_host_scheduler_arguments
+from load_profiles import ProfileRunner, StageRecord, get_stage_key, get_stage_stats, load_profile
+from live_metrics import LiveMetrics, add_live_metrics_arguments
+from load_scheduler import add_load_arguments, run_burst, run_open_loop
+from payload_cache import JSON_HEADERS, PayloadCache, add_payload_cache_arguments
+from result_stats import ResultStats
+from request_errors import SyncDeadline, classify, deadline
+from request_trace import TraceWriter, add_trace_arguments
+from request_timing import AsyncRequestTimer, RequestTimer
+from results_sink import ResultsSink
+from results_store import add_results_store_arguments, check_format, write_columns
+from trapi_stream import TrapiReader, add_trapi_stream_arguments, empty_counts
 
 with open("curie_list.json", "r") as f:
     all_curies = json.load(f)
 
-with open("kps.json", "r") as f:
-    kps = json.load(f)
+# filled from --targets
+kps = {}
 
 output = {
     "sequential": {},
     "concurrent": {},
+    "open_loop": {},
+    "profile": {},
+    "capacity": {},
+    "batch_model": {},
+    "cache": {},
 }
 
+client_pool = ClientPool(timeout=60, read_timeout=300, deadline=600)
+results_sink = ResultsSink()
+trapi_reader = TrapiReader()
+payload_cache = PayloadCache()
+host_scheduler = HostScheduler()
+request_budget = ConcurrencyBudget()
+trace_writer = TraceWriter()
+live_metrics = LiveMetrics()
+harness_monitor = HarnessMonitor()
+
+
+def get_payload_key(url: str, curies: List[str], bypass_cache: Optional[bool] = None) -> Tuple[str, Tuple[str, ...], Optional[bool]]:
+    """Get the payload cache key of a kp's request body, the same for sync and async lookups."""
+    return (url, tuple(curies), bypass_cache)
+
 
 def single_lookup(url: str, curies: List[str], kp_overrides: Dict[str, Any]) -> Dict[str, Any]:
     """Run a single query lookup synchronously."""
-    query = generate_kp_message(curies, kp_overrides)
-    status = "timeout"
-    start_time = datetime.now()
+    body = payload_cache.get(get_payload_key(url, curies), lambda: generate_kp_message(curies, kp_overrides))
+    status = None
+    error = None
+    counts = empty_counts()
+    timer = RequestTimer()
+    trace_writer.write(url, body)
+    request_deadline = SyncDeadline(client_pool.deadline)
     try:
-        with httpx.Client(timeout=600) as client:
-            response = client.post(
+        with client_pool.sync_client(url) as client:
+            with client.stream(
+                "POST",
                 url,
-                json=query,
-            )
-            status = response.status_code
-            response.raise_for_status()
-            response = response.json()
-            if (
-                "message" in response and
-                "errors" in response["message"]
-            ):
-                with open("kp_response.json", "w") as f:
-                    json.dump(response, f, indent=2)
-                exit()
-            num_results = len((response.get("message") or {}).get("results") or [])
+                content=body,
+                headers=JSON_HEADERS,
+                extensions={"trace": timer},
+                # no single wait may outlast the deadline, and the reads check it in between
+                timeout=client_pool.timeouts(request_deadline.remaining()),
+            ) as response:
+                status = response.status_code
+                response.raise_for_status()
+                counts = trapi_reader.read_sync(response, timer, deadline=request_deadline)
     except Exception as e:
-        num_results = 0
+        error = e
+        counts = empty_counts()
 
-    stop_time = datetime.now()
+    timer.stop()
+    client_pool.record(url, timer.new_connection)
+    error_class = classify(error, status)
     result = {
-        "status": status,
-        "num_results": num_results,
-        "response_time": (stop_time - start_time).total_seconds(),
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": timer.phases(),
+        "completed_at": time.time(),
         "num_curies": len(curies),
-        "curies": curies,
     }
     return result
 
 
-async def single_async_lookup(url: str, curies: List[str], kp_overrides: Dict[str, Any]) -> Dict[str, Any]:
-    """Run a single query lookup asynchronously."""
-    query = generate_kp_message(curies, kp_overrides)
-    status = "timeout"
-    start_time = datetime.now()
+async def single_async_lookup(
+    url: str,
+    curies: List[str],
+    kp_overrides: Dict[str, Any],
+    bypass_cache: Optional[bool] = None,
+    single_use: bool = False,
+) -> Dict[str, Any]:
+    """Run a single query lookup asynchronously, without caching the body when it's single_use."""
+    body = payload_cache.get(
+        get_payload_key(url, curies, bypass_cache),
+        lambda: generate_kp_message(curies, kp_overrides, bypass_cache),
+        store=not single_use,
+    )
+    status = None
+    error = None
+    counts = empty_counts()
+    timer = AsyncRequestTimer()
+    budget_wait = None
+    trace_writer.write(url, body)
     try:
-        async with httpx.AsyncClient(timeout=600) as client:
-            response = await client.post(
-                url,
-                json=query,
-            )
-            status = response.status_code
-            response.raise_for_status()
-            response = response.json()
-            num_results = len((response.get("message") or {}).get("results") or [])
+        async with request_budget.slot(url) as budget_wait:
+            # waiting for the slot is budget_wait, not part of the request's own time
+            timer.start()
+            async with deadline(client_pool.deadline):
+                async with client_pool.client(url) as client:
+                    async with client.stream(
+                        "POST",
+                        url,
+                        content=body,
+                        headers=JSON_HEADERS,
+                        extensions={"trace": timer},
+                    ) as response:
+                        status = response.status_code
+                        response.raise_for_status()
+                        counts = await trapi_reader.read(response, timer)
     except Exception as e:
-        num_results = 0
+        error = e
+        counts = empty_counts()
 
-    stop_time = datetime.now()
+    timer.stop()
+    client_pool.record(url, timer.new_connection)
+    error_class = classify(error, status)
     result = {
-        "status": status,
-        "num_results": num_results,
-        "response_time": (stop_time - start_time).total_seconds(),
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": {**timer.phases(), "budget_wait": budget_wait},
+        "completed_at": time.time(),
         "num_curies": len(curies),
-        "curies": curies,
     }
     return result
 
 
-def run_sequential(num_curies: int, output_filename: str):
+async def run_sequential(num_curies: int, output_filename: str, targets: Optional[Dict[str, dict]] = None):
     """Send squential queries to kps."""
-    for infores, kp in kps.items():
+    for infores, kp in (targets or kps).items():
         print(f"Sending {len(all_curies) / num_curies} sequential requests to {infores}")
         if infores not in output["sequential"]:
             output["sequential"][infores] = {}
         output["sequential"][infores][num_curies] = {}
-        results = []
+        stats = ResultStats()
         start_time = datetime.now()
-        for ndx in tqdm(range(0, len(all_curies), num_curies)):
+        for ndx in tqdm(range(0, len(all_curies), num_curies), disable=live_metrics.dashboard):
             curies = all_curies[ndx : min(ndx + num_curies, len(all_curies))]
-            result = single_lookup(kp["url"], curies, kp)
-            results.append(result)
+            # on a worker thread, so the loop keeps serving /metrics and the dashboard in between
+            result = await asyncio.to_thread(single_lookup, kp["url"], curies, kp)
+            results_sink.record(stats, result, mode="sequential", target=infores, stage=num_curies)
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
-        output["sequential"][infores][num_curies] = result_stats
+        output["sequential"][infores][num_curies] = stats.to_dict((end_time - start_time).total_seconds())
+        output["sequential"][infores][num_curies]["harness"] = harness_monitor.check(f"sequential {infores} {num_curies}", stats.start_time)
         with open(output_filename, "w") as f:
             json.dump(output, f, indent = 2)
 
 
-async def run_concurrent(num_curies: int, output_filename: str):
+async def run_concurrent(num_curies: int, output_filename: str, targets: Optional[Dict[str, dict]] = None):
     """Send concurrent async queries to kps."""
-    for infores, kp in kps.items():
+    async def run_kp(infores: str, kp: dict):
         print(f"Sending {len(all_curies) / num_curies} concurrent requests to {infores}")
         if infores not in output["concurrent"]:
             output["concurrent"][infores] = {}
@@ -127,44 +191,264 @@ async def run_concurrent(num_curies: int, output_filename: str):
         for ndx in range(0, len(all_curies), num_curies):
             query_curies.append(all_curies[ndx : min(ndx + num_curies, len(all_curies))])
         lookups = [single_async_lookup(kp["url"], curies, kp) for curies in query_curies]
+        stats = ResultStats()
         start_time = datetime.now()
-        results = await asyncio.gather(*lookups, return_exceptions=True)
+        await run_burst(lookups, lambda result: results_sink.record(stats, result, mode="concurrent", target=infores, stage=num_curies))
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
-        output["concurrent"][infores][num_curies] = result_stats
+        output["concurrent"][infores][num_curies] = stats.to_dict((end_time - start_time).total_seconds())
+        output["concurrent"][infores][num_curies]["harness"] = harness_monitor.check(f"concurrent {infores} {num_curies}", stats.start_time)
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    await host_scheduler.run(targets or kps, run_kp)
+
+
+def recommend_batch(infores: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Fit a kp's batch cost model on its sequential stages and recommend a batch size and concurrency."""
+    # the concurrent stages send every batch of the curie list at once
+    return recommend(
+        {int(num_curies): stage for num_curies, stage in output["sequential"].get(infores, {}).items()},
+        {
+            (int(num_curies), math.ceil(len(all_curies) / int(num_curies))): stage
+            for num_curies, stage in output["concurrent"].get(infores, {}).items()
+        },
+        1,
+        min(args.max_batch_size, len(all_curies)),
+        args.batch_error_rate,
+    )
+
+
+async def run_adaptive_sweep(batch_sizes: List[int], args: argparse.Namespace, output_filename: str):
+    """Sweep finer batch sizes around each kp's predicted optimum, then recommend from everything that ran."""
+    for infores, kp in kps.items():
+        recommendation = recommend_batch(infores, args)
+        if recommendation["optimal_batch_size"] is not None:
+            high = min(args.max_batch_size, len(all_curies))
+            for num_curies in fine_batch_sizes(recommendation["optimal_batch_size"], batch_sizes, 1, high, args.adaptive_sweep):
+                await run_sequential(num_curies, output_filename, {infores: kp})
+                await run_concurrent(num_curies, output_filename, {infores: kp})
+        output["batch_model"][infores] = recommend_batch(infores, args)
+        print(f"Best batch size for {infores}: {output['batch_model'][infores]['optimal_batch_size']}")
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+
+async def run_rate(num_curies: int, args: argparse.Namespace, output_filename: str):
+    """Send queries to kps at a steady arrival rate."""
+    query_curies = []
+    for ndx in range(0, len(all_curies), num_curies):
+        query_curies.append(all_curies[ndx : min(ndx + num_curies, len(all_curies))])
+
+    async def run_kp(infores: str, kp: dict):
+        print(f"Sending {args.rate} requests/s to {infores} for {args.duration}s")
+        if infores not in output["open_loop"]:
+            output["open_loop"][infores] = {}
+        batches = itertools.cycle(query_curies)
+        stats = ResultStats()
+        start_time = datetime.now()
+        rate_stats = await run_open_loop(
+            lambda: single_async_lookup(kp["url"], next(batches), kp),
+            lambda result: results_sink.record(stats, result, mode="open_loop", target=infores, stage=num_curies),
+            args.rate,
+            args.duration,
+            arrival=args.arrival,
+            max_in_flight=args.max_in_flight,
+            seed=args.seed,
+        )
+        end_time = datetime.now()
+        result_stats = stats.to_dict((end_time - start_time).total_seconds())
+        result_stats["rate"] = rate_stats
+        result_stats["harness"] = harness_monitor.check(f"open loop {infores} {num_curies}", stats.start_time)
+        output["open_loop"][infores][num_curies] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    await host_scheduler.run(kps, run_kp)
+
+
+async def run_profile(stages: List[Dict[str, Any]], default_num_curies: int, args: argparse.Namespace, output_filename: str):
+    """Drive each kp through a load profile."""
+    async def run_kp(infores: str, kp: dict):
+        print(f"Running load profile against {infores}")
+        output["profile"][infores] = {}
+        batches = {}
+
+        async def send(stage: Dict[str, Any]) -> Dict[str, Any]:
+            num_curies = stage.get("num_curies", default_num_curies)
+            if num_curies not in batches:
+                batches[num_curies] = itertools.cycle([
+                    all_curies[ndx : min(ndx + num_curies, len(all_curies))]
+                    for ndx in range(0, len(all_curies), num_curies)
+                ])
+            return await single_async_lookup(kp["url"], next(batches[num_curies]), kp)
+
+        def on_result(record: StageRecord, result: Dict[str, Any]):
+            results_sink.record(record.stats, result, mode="profile", target=infores, stage=get_stage_key(record.index, record.stage))
+
+        def on_stage_done(record: StageRecord):
+            result_stats = record.stats.to_dict(record.end_time - record.start_time)
+            result_stats["stage"] = get_stage_stats(record)
+            result_stats["harness"] = harness_monitor.check(f"profile {infores} {get_stage_key(record.index, record.stage)}", record.stats.start_time)
+            output["profile"][infores][get_stage_key(record.index, record.stage)] = result_stats
+            with open(output_filename, "w") as f:
+                json.dump(output, f, indent = 2)
+
+        runner = ProfileRunner(send, stages, on_result, on_stage_done, arrival=args.arrival, max_in_flight=args.max_in_flight, seed=args.seed)
+        await runner.run()
+
+    await host_scheduler.run(kps, run_kp)
+
+
+async def run_capacity(num_curies: int, args: argparse.Namespace, output_filename: str):
+    """Search for the most load each kp handles within the SLO."""
+    async def run_kp(infores: str, kp: dict):
+        print(f"Finding the capacity of {infores}")
+        output["capacity"][infores] = {"probes": {}}
+        batches = itertools.cycle([
+            all_curies[ndx : min(ndx + num_curies, len(all_curies))]
+            for ndx in range(0, len(all_curies), num_curies)
+        ])
+
+        def on_result(record: StageRecord, result: Dict[str, Any]):
+            results_sink.record(record.stats, result, mode="capacity", target=infores, stage=get_probe_key(record.stage))
+
+        def on_probe(record: StageRecord, point: Dict[str, Any]):
+            result_stats = record.stats.to_dict(record.end_time - record.start_time)
+            result_stats["stage"] = get_stage_stats(record)
+            result_stats["slo"] = point
+            result_stats["harness"] = harness_monitor.summary(record.stats.start_time)
+            output["capacity"][infores]["probes"][get_probe_key(record.stage)] = result_stats
+            with open(output_filename, "w") as f:
+                json.dump(output, f, indent = 2)
+
+        finder = CapacityFinder(lambda: single_async_lookup(kp["url"], next(batches), kp), on_result, on_probe, args, harness_monitor)
+        output["capacity"][infores].update(await finder.run())
         with open(output_filename, "w") as f:
             json.dump(output, f, indent = 2)
 
+    await host_scheduler.run(kps, run_kp)
+
+
+async def run_cache(num_curies: int, args: argparse.Namespace, output_filename: str):
+    """Measure how much each kp's cache helps, cold queries that never repeat against one repeated warm query."""
+    async def run_kp(infores: str, kp: dict):
+        print(f"Running the cache experiment against {infores}")
+        output["cache"][infores] = {}
+        rng = random.Random(args.seed)
+        warm_curies = all_curies[:num_curies]
+        seen = {frozenset(warm_curies)}
+
+        def cold_curies() -> List[str]:
+            # a new combination of curies every time, for as long as the curie list has new ones
+            for _ in range(100):
+                curies = rng.sample(all_curies, num_curies)
+                if frozenset(curies) not in seen:
+                    break
+            seen.add(frozenset(curies))
+            return curies
+
+        def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+            results_sink.record(stats, result, mode="cache", target=infores, stage=stage_key)
+
+        def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+            result_stats = stats.to_dict(total_time)
+            result_stats["harness"] = harness_monitor.check(f"cache {infores} {stage_key}", stats.start_time)
+            output["cache"][infores][stage_key] = result_stats
+            with open(output_filename, "w") as f:
+                json.dump(output, f, indent = 2)
+
+        experiment = CacheExperiment(
+            # cold curies never repeat, so their bodies would only push the warm one out of the cache
+            lambda: single_async_lookup(kp["url"], cold_curies(), kp, bypass_cache=True, single_use=True),
+            lambda: single_async_lookup(kp["url"], warm_curies, kp, bypass_cache=False),
+            on_result,
+            on_stage,
+            args,
+        )
+        output["cache"][infores]["summary"] = await experiment.run()
+        print(f"Cache speedup for {infores}: {output['cache'][infores]['summary']['speedup']}")
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    await host_scheduler.run(kps, run_kp)
+
 
 async def main():
     parser = argparse.ArgumentParser(description=("Translator Stress Tester"))
     parser.add_argument("--batch_sizes", type=str, help="Comma separated curie batch sizes", default="1,10,100,1000")
+    add_client_pool_arguments(parser)
+    add_load_arguments(parser)
+    add_trapi_stream_arguments(parser)
+    add_event_loop_arguments(parser)
+    add_payload_cache_arguments(parser)
+    add_capacity_arguments(parser)
+    add_cache_arguments(parser)
+    add_host_scheduler_arguments(parser)
+    add_batch_model_arguments(parser)
+    parser.add_argument("--adaptive_sweep", type=int, help="Extra batch sizes to run around each KP's predicted optimum after the sweep, 0 for none", default=0)
+    add_trace_arguments(parser)
+    add_live_metrics_arguments(parser)
+    add_harness_monitor_arguments(parser)
+    add_results_store_arguments(parser)
+    parser.add_argument("--targets", type=str, help="KP targets file, like mock/kps.json for the mock server", default="kps.json")
     args = parser.parse_args()
+    check_format(args.results_format)
+    if args.mode == "compression":
+        raise SystemExit("The compression mode runs from kp_stress_tests.py and ara_stress_test.py")
+    with open(args.targets, "r") as f:
+        kps.update(json.load(f))
+    if args.capture_trace is not None:
+        trace_writer.open(args.capture_trace, {kp["url"]: infores for infores, kp in kps.items()})
+    client_pool.configure(args)
+    trapi_reader.configure(args)
+    live_metrics.configure(args)
+    harness_monitor.configure(args)
+    payload_cache.configure(args)
+    host_scheduler.configure(args)
+    request_budget.configure(args)
     batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(",")]
 
     timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     output_filename = f"results/kp_tests_{timestamp}.json"
+    results_sink.open(f"results/kp_tests_{timestamp}.jsonl")
+    output["records"] = results_sink.filename
+    await live_metrics.start(results_sink, client_pool)
+    harness_monitor.start()
 
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
-    for num_curies in batch_sizes:
-        run_sequential(num_curies, output_filename)
-        await run_concurrent(num_curies, output_filename)
+    if args.mode == "profile":
+        # batch sizes come from the profile stages, defaulting to the first one given
+        await run_profile(load_profile(args.profile), batch_sizes[0], args, output_filename)
+    elif args.mode == "capacity":
+        await run_capacity(batch_sizes[0], args, output_filename)
+    elif args.mode == "cache":
+        await run_cache(batch_sizes[0], args, output_filename)
+    else:
+        for num_curies in batch_sizes:
+            if args.mode == "open_loop":
+                await run_rate(num_curies, args, output_filename)
+                continue
+            await run_sequential(num_curies, output_filename)
+            await run_concurrent(num_curies, output_filename)
+        if args.mode != "open_loop":
+            await run_adaptive_sweep(batch_sizes, args, output_filename)
+    output["harness"] = await harness_monitor.stop()
+    await live_metrics.stop()
+    await client_pool.aclose()
+    trapi_reader.close()
+    results_sink.close()
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    trace_writer.close()
+    output["connections"] = client_pool.stats()
+    output["decoding"] = {**trapi_reader.settings(), "event_loop": args.event_loop}
+    output["payload_cache"] = payload_cache.stats()
+    output["budget"] = request_budget.stats()
+    output["trace"] = trace_writer.filename
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run(main)
@@ -2,137 +2,440 @@ import argparse
 import asyncio
 import copy
 from datetime import datetime
-import httpx
 import json
+import time
 from tqdm import tqdm
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-with open("kp_queries.json", "r") as f:
-    kps = json.load(f)
+from batch_model import add_batch_model_arguments, recommend
+from cache_experiment import CacheExperiment, add_cache_arguments
+from capacity_finder import CapacityFinder, add_capacity_arguments, get_probe_key
+from client_pool import ClientPool, add_client_pool_arguments
+from compression import CompressionMatrix, Decompressor, add_compression_arguments, add_compression_fields, check_encodings, encode_request
+from distributed import Coordinator, Worker, add_distributed_arguments
+from event_loop import add_event_loop_arguments, run
+from harness_monitor import HarnessMonitor, add_harness_monitor_arguments
+from host_scheduler import ConcurrencyBudget, HostScheduler, add_host_scheduler_arguments
+from load_profiles import ProfileRunner, StageRecord, get_stage_key, get_stage_stats, load_profile
+from live_metrics import LiveMetrics, add_live_metrics_arguments
+from load_scheduler import add_load_arguments, run_burst, run_open_loop
+from payload_cache import JSON_HEADERS, PayloadCache, add_payload_cache_arguments
+from result_stats import ResultStats
+from request_errors import classify, deadline
+from request_trace import TraceWriter, add_trace_arguments
+from request_timing import AsyncRequestTimer
+from results_sink import ResultsSink
+from results_store import add_results_store_arguments, check_format, write_columns
+from trapi_stream import TrapiReader, add_trapi_stream_arguments, empty_counts
+
+# filled from --targets
+kps = {}
 
 output = {
     "sequential": {},
     "concurrent": {},
+    "open_loop": {},
+    "profile": {},
+    "capacity": {},
+    "batch_model": {},
+    "cache": {},
+    "compression": {},
 }
 
+client_pool = ClientPool(timeout=60, read_timeout=300, deadline=600)
+results_sink = ResultsSink()
+trapi_reader = TrapiReader()
+worker = Worker()
+payload_cache = PayloadCache()
+host_scheduler = HostScheduler()
+request_budget = ConcurrencyBudget()
+trace_writer = TraceWriter()
+live_metrics = LiveMetrics()
+harness_monitor = HarnessMonitor()
+
 
-def generate_message(query, num_curies):
+def generate_message(query, num_curies, bypass_cache=True):
     nodes = query["message"]["query_graph"]["nodes"]
     for node in nodes.values():
         if "ids" in node:
             node["ids"] = node["ids"][:num_curies]
-    query["bypass_cache"] = True
+    query["bypass_cache"] = bypass_cache
     return query
 
 
-async def lookup(kp: dict, num_curies: int) -> Dict[str, Any]:
-    """Run a single query lookup asynchronously."""
-    status = "timeout"
-    start_time = datetime.now()
+async def lookup(
+    kp: dict,
+    num_curies: int,
+    bypass_cache: bool = True,
+    request_encoding: Optional[str] = None,
+    accept_encoding: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Run a single query lookup asynchronously, compressed or asking for a compressed response when given encodings."""
+    status = None
+    error = None
+    counts = empty_counts()
+    body = payload_cache.get(
+        ("kp_query", kp["url"], num_curies, bypass_cache),
+        lambda: generate_message(copy.deepcopy(kp["query"]), num_curies, bypass_cache),
+    )
+    trace_writer.write(kp["url"], body)
+    body, headers, compress_time = encode_request(body, JSON_HEADERS, request_encoding, accept_encoding)
+    timer = AsyncRequestTimer()
+    budget_wait = None
+    decompressor = None
+    # a worker whose link to the coordinator is backed up waits here instead of buffering more records
+    await worker.drain()
     try:
-        async with httpx.AsyncClient(timeout=600) as client:
-            response = await client.post(
-                kp["url"],
-                json=generate_message(copy.deepcopy(kp["query"]), num_curies),
-            )
-            status = response.status_code
-            response.raise_for_status()
-            response = response.json()
-            num_results = len((response.get("message") or {}).get("results") or [])
+        async with request_budget.slot(kp["url"]) as budget_wait:
+            # waiting for the slot is budget_wait, not part of the request's own time
+            timer.start()
+            async with deadline(client_pool.deadline):
+                async with client_pool.client(kp["url"]) as client:
+                    async with client.stream(
+                        "POST",
+                        kp["url"],
+                        content=body,
+                        headers=headers,
+                        extensions={"trace": timer},
+                    ) as response:
+                        status = response.status_code
+                        response.raise_for_status()
+                        if accept_encoding is not None:
+                            decompressor = Decompressor(response.headers.get("content-encoding"))
+                        counts = await trapi_reader.read(response, timer, decompressor=decompressor)
     except Exception as e:
-        num_results = 0
+        error = e
+        counts = empty_counts()
 
-    stop_time = datetime.now()
+    timer.stop()
+    client_pool.record(kp["url"], timer.new_connection)
+    error_class = classify(error, status)
     result = {
-        "status": status,
-        "num_results": num_results,
-        "response_time": (stop_time - start_time).total_seconds(),
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": {**timer.phases(), "budget_wait": budget_wait},
+        "completed_at": time.time(),
+        "num_curies": num_curies,
     }
+    if accept_encoding is not None:
+        add_compression_fields(result, body, compress_time, decompressor)
     return result
 
 
+def save_stage(mode: str, infores: str, stage_key: str, stats: ResultStats, total_time: float, output_filename: str, **extra: Any):
+    """Write out a finished stage, or hand it to the coordinator when running as a worker."""
+    extra["harness"] = harness_monitor.check(f"{mode} {infores} {stage_key}", stats.start_time)
+    if worker.connected:
+        worker.send_stage(mode, infores, stage_key, stats, total_time, extra)
+        return
+    result_stats = stats.to_dict(total_time)
+    result_stats.update(extra)
+    write_stage(mode, infores, stage_key, result_stats, output_filename)
+
+
+def write_stage(mode: str, infores: str, stage_key: str, result_stats: Dict[str, Any], output_filename: str):
+    if infores not in output[mode]:
+        output[mode][infores] = {}
+    output[mode][infores][stage_key] = result_stats
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
 async def run_sequential(infores: str, kp: dict, output_filename: str):
     """Send squential queries to kps."""
     # for num in [(1, 1000)]:
     for num in [(900, 1), (180, 10), (90, 100), (30, 1000)]:
         print(f"Sending {num} sequential requests to {infores}")
-        if infores not in output["sequential"]:
-            output["sequential"][infores] = {}
-        output["sequential"][infores][f"{num[0]}_{num[1]}"] = {}
-        results = []
+        stats = ResultStats()
         start_time = datetime.now()
         for ndx in range(0, num[0]):
             result = await lookup(kp, num[1])
-            results.append(result)
+            results_sink.record(stats, result, mode="sequential", target=infores, stage=f"{num[0]}_{num[1]}")
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
-        output["sequential"][infores][f"{num[0]}_{num[1]}"] = result_stats
-        with open(output_filename, "w") as f:
-            json.dump(output, f, indent = 2)
+        save_stage("sequential", infores, f"{num[0]}_{num[1]}", stats, (end_time - start_time).total_seconds(), output_filename)
 
 
 async def run_concurrent(infores: str, kp: dict, output_filename: str):
     """Send concurrent async queries to kps."""
     for num in [(10, 1), (100, 1), (1000, 1), (10, 10), (100, 10), (1000, 10), (10, 1000), (100, 1000), (1000, 1000)]:
-        print(f"Sending {num[0]} concurrent requests to {infores}")
-        if infores not in output["concurrent"]:
-            output["concurrent"][infores] = {}
-        output["concurrent"][infores][f"{num[0]}_{num[1]}"] = {}
-        lookups = [lookup(kp, num[1]) for _ in range(0, num[0])]
+        print(f"Sending {worker.share(num[0])} concurrent requests to {infores}")
+        lookups = [lookup(kp, num[1]) for _ in range(0, worker.share(num[0]))]
+        stats = ResultStats()
+        await worker.barrier(f"{infores} concurrent {num[0]}_{num[1]}")
+        start_time = datetime.now()
+        await run_burst(lookups, lambda result: results_sink.record(stats, result, mode="concurrent", target=infores, stage=f"{num[0]}_{num[1]}"))
+        end_time = datetime.now()
+        save_stage("concurrent", infores, f"{num[0]}_{num[1]}", stats, (end_time - start_time).total_seconds(), output_filename)
+
+
+async def run_rate(infores: str, kp: dict, args: argparse.Namespace, output_filename: str):
+    """Send queries to kps at a steady arrival rate."""
+    for num_curies in [1, 10, 1000]:
+        print(f"Sending {worker.share(args.rate)} requests/s with {num_curies} curies to {infores} for {args.duration}s")
+        stats = ResultStats()
+        await worker.barrier(f"{infores} open_loop {args.rate}_{num_curies}")
         start_time = datetime.now()
-        results = await asyncio.gather(*lookups)
+        rate_stats = await run_open_loop(
+            lambda: lookup(kp, num_curies),
+            lambda result: results_sink.record(stats, result, mode="open_loop", target=infores, stage=f"{args.rate}_{num_curies}"),
+            worker.share(args.rate),
+            args.duration,
+            arrival=args.arrival,
+            max_in_flight=args.max_in_flight,
+            seed=args.seed,
+        )
         end_time = datetime.now()
-        result_stats = {
-            "total_time": (end_time - start_time).total_seconds(),
-            "total_results": 0,
-            "statuses": {},
-            "results": results,
-        }
-        for result in results:
-            result_stats["total_results"] += result["num_results"]
-            if result["status"] not in result_stats["statuses"]:
-                result_stats["statuses"][result["status"]] = 1
-            else:
-                result_stats["statuses"][result["status"]] += 1
-        output["concurrent"][infores][f"{num[0]}_{num[1]}"] = result_stats
+        save_stage("open_loop", infores, f"{args.rate}_{num_curies}", stats, (end_time - start_time).total_seconds(), output_filename, rate=rate_stats)
+
+
+async def run_profile(infores: str, kp: dict, stages: List[Dict[str, Any]], args: argparse.Namespace, output_filename: str):
+    """Drive a kp through a load profile."""
+    print(f"Running load profile against {infores}")
+
+    async def send(stage: Dict[str, Any]) -> Dict[str, Any]:
+        return await lookup(kp, stage.get("num_curies", 1))
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="profile", target=infores, stage=get_stage_key(record.index, record.stage))
+
+    def on_stage_done(record: StageRecord):
+        save_stage("profile", infores, get_stage_key(record.index, record.stage), record.stats, record.end_time - record.start_time, output_filename, stage=get_stage_stats(record))
+
+    runner = ProfileRunner(send, stages, on_result, on_stage_done, arrival=args.arrival, max_in_flight=args.max_in_flight, seed=args.seed, share=worker.share)
+    # the stages run back to back on the clock, so starting together keeps them lined up
+    await worker.barrier(f"{infores} profile")
+    await runner.run()
+
+
+async def run_capacity(infores: str, kp: dict, args: argparse.Namespace, output_filename: str):
+    """Search for the most load a kp handles within the SLO."""
+    print(f"Finding the capacity of {infores}")
+    output["capacity"][infores] = {"probes": {}}
+
+    def on_result(record: StageRecord, result: Dict[str, Any]):
+        results_sink.record(record.stats, result, mode="capacity", target=infores, stage=get_probe_key(record.stage))
+
+    def on_probe(record: StageRecord, point: Dict[str, Any]):
+        result_stats = record.stats.to_dict(record.end_time - record.start_time)
+        result_stats["stage"] = get_stage_stats(record)
+        result_stats["slo"] = point
+        result_stats["harness"] = harness_monitor.summary(record.stats.start_time)
+        output["capacity"][infores]["probes"][get_probe_key(record.stage)] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    finder = CapacityFinder(lambda: lookup(kp, args.capacity_curies), on_result, on_probe, args, harness_monitor)
+    output["capacity"][infores].update(await finder.run())
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_cache(infores: str, kp: dict, args: argparse.Namespace, output_filename: str):
+    """Measure how much a kp's cache helps, the query bypassing the cache against the same query cached."""
+    print(f"Running the cache experiment against {infores}")
+    output["cache"][infores] = {}
+
+    def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+        results_sink.record(stats, result, mode="cache", target=infores, stage=stage_key)
+
+    def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+        result_stats = stats.to_dict(total_time)
+        result_stats["harness"] = harness_monitor.check(f"cache {infores} {stage_key}", stats.start_time)
+        output["cache"][infores][stage_key] = result_stats
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    experiment = CacheExperiment(
+        lambda: lookup(kp, args.cache_curies, bypass_cache=True),
+        lambda: lookup(kp, args.cache_curies, bypass_cache=False),
+        on_result,
+        on_stage,
+        args,
+    )
+    output["cache"][infores]["summary"] = await experiment.run()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+async def run_compression(infores: str, kp: dict, args: argparse.Namespace, output_filename: str):
+    """Measure what request and response compression buy against a kp, with big batches."""
+    print(f"Running the compression matrix against {infores}")
+    output["compression"][infores] = {}
+
+    def on_result(stage_key: str, stats: ResultStats, result: Dict[str, Any]):
+        results_sink.record(stats, result, mode="compression", target=infores, stage=stage_key)
+
+    def on_stage(stage_key: str, stats: ResultStats, total_time: float):
+        result_stats = stats.to_dict(total_time)
+        result_stats["harness"] = harness_monitor.check(f"compression {infores} {stage_key}", stats.start_time)
+        output["compression"][infores][stage_key] = result_stats
         with open(output_filename, "w") as f:
             json.dump(output, f, indent = 2)
 
+    matrix = CompressionMatrix(
+        lambda request_encoding, accept_encoding: lookup(kp, args.compression_curies, True, request_encoding, accept_encoding),
+        on_result,
+        on_stage,
+        args,
+    )
+    output["compression"][infores]["summary"] = await matrix.run()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+def recommend_batches(args: argparse.Namespace):
+    """Fit each kp's batch cost model on its sequential stages and recommend a batch size and concurrency."""
+    for infores, stages in output["sequential"].items():
+        # stage keys are <requests>_<curies per request>, concurrent ones send all their requests at once
+        concurrent = {}
+        for stage_key, stage in output["concurrent"].get(infores, {}).items():
+            concurrency, num_curies = stage_key.split("_")
+            concurrent[(int(num_curies), int(concurrency))] = stage
+        output["batch_model"][infores] = recommend(
+            {int(stage_key.split("_")[1]): stage for stage_key, stage in stages.items()},
+            concurrent,
+            1,
+            args.max_batch_size,
+            args.batch_error_rate,
+        )
+
 
-async def run_tests(infores: str, kp: dict, output_filename: str):
-    await run_sequential(infores, kp, output_filename)
-    # let the KPs cool off a little
+async def run_tests(infores: str, kp: dict, args: argparse.Namespace, output_filename: str):
+    if args.mode == "open_loop":
+        await run_rate(infores, kp, args, output_filename)
+        return
+    if args.mode == "profile":
+        await run_profile(infores, kp, load_profile(args.profile), args, output_filename)
+        return
+    if args.mode == "capacity":
+        await run_capacity(infores, kp, args, output_filename)
+        return
+    if args.mode == "cache":
+        await run_cache(infores, kp, args, output_filename)
+        return
+    if args.mode == "compression":
+        await run_compression(infores, kp, args, output_filename)
+        return
+    # sequential requests can't be spread out, so the first worker sends all of them
+    if worker.index == 0:
+        await run_sequential(infores, kp, output_filename)
+    # the others wait for it, then let the KPs cool off a little
+    await worker.barrier(f"{infores} sequential")
     await asyncio.sleep(60)
     await run_concurrent(infores, kp, output_filename)
 
 
-async def main():
-    parser = argparse.ArgumentParser(description=("Translator Stress Tester"))
-
+async def run_coordinator(args: argparse.Namespace):
+    """Spread the tests over worker processes and merge their results into one results file."""
     timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     output_filename = f"results/stress_tests_{timestamp}.json"
+    results_sink.open(f"results/stress_tests_{timestamp}.jsonl")
+    output["records"] = results_sink.filename
+
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
 
+    coordinator = Coordinator(
+        results_sink,
+        lambda mode, infores, stage_key, result_stats: write_stage(mode, infores, stage_key, result_stats, output_filename),
+    )
+    await coordinator.run(args)
+
+    results_sink.close()
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    recommend_batches(args)
+    output["connections"] = coordinator.connections
+    output["payload_cache"] = coordinator.payload_cache
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
-    tests = [run_tests(infores, kp, output_filename) for infores, kp in kps.items()]
-    await asyncio.gather(*tests)
 
-        
+async def main():
+    parser = argparse.ArgumentParser(description=("Translator Stress Tester"))
+    add_client_pool_arguments(parser)
+    add_load_arguments(parser)
+    add_trapi_stream_arguments(parser)
+    add_event_loop_arguments(parser)
+    add_distributed_arguments(parser)
+    add_payload_cache_arguments(parser)
+    add_capacity_arguments(parser)
+    add_cache_arguments(parser)
+    add_compression_arguments(parser)
+    add_host_scheduler_arguments(parser)
+    add_batch_model_arguments(parser)
+    add_trace_arguments(parser)
+    add_live_metrics_arguments(parser)
+    add_harness_monitor_arguments(parser)
+    add_results_store_arguments(parser)
+    parser.add_argument("--capacity_curies", type=int, help="Curies per query while finding capacity", default=1)
+    parser.add_argument("--cache_curies", type=int, help="Curies per query in the cache experiment", default=1)
+    parser.add_argument("--compression_curies", type=int, help="Curies per query in the compression matrix", default=1000)
+    parser.add_argument("--targets", type=str, help="KP queries file, like mock/kp_queries.json for the mock server", default="kp_queries.json")
+    args = parser.parse_args()
+    check_format(args.results_format)
+    if args.mode == "compression":
+        check_encodings(args.request_encodings.split(",") + args.accept_encodings.split(","))
+    if args.coordinator is not None:
+        args = await worker.connect(args.coordinator)
+    elif args.workers or args.remote_workers:
+        if args.mode in ["capacity", "cache", "compression"]:
+            raise SystemExit(f"The {args.mode} mode has to see all of the load, run it without workers")
+        await run_coordinator(args)
+        return
+    client_pool.configure(args)
+    trapi_reader.configure(args)
+    live_metrics.configure(args)
+    harness_monitor.configure(args)
+    payload_cache.configure(args)
+    host_scheduler.configure(args)
+    request_budget.configure(args)
+    with open(args.targets, "r") as f:
+        kps.update(json.load(f))
+    if args.capture_trace is not None:
+        # workers each capture to their own file, replay.py merges them back together
+        trace_file = f"{args.capture_trace}.{worker.index}" if worker.connected else args.capture_trace
+        trace_writer.open(trace_file, {kp["url"]: infores for infores, kp in kps.items()})
+
+    if worker.connected:
+        output_filename = None
+        results_sink.open_stream(worker.records(), f"worker_{worker.index}")
+    else:
+        timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        output_filename = f"results/stress_tests_{timestamp}.json"
+        results_sink.open(f"results/stress_tests_{timestamp}.jsonl")
+        output["records"] = results_sink.filename
+
+        with open(output_filename, "w") as f:
+            json.dump(output, f, indent = 2)
+    # workers on the same machine can't share a port, each serves its own after the coordinator's
+    await live_metrics.start(results_sink, client_pool, worker.index + 1 if worker.connected else 0, not worker.connected)
+    harness_monitor.start()
+
+    await host_scheduler.run(kps, lambda infores, kp: run_tests(infores, kp, args, output_filename))
+
+    harness = await harness_monitor.stop()
+    await live_metrics.stop()
+    await client_pool.aclose()
+    trapi_reader.close()
+    results_sink.close()
+    trace_writer.close()
+    if worker.connected:
+        await worker.close(client_pool.stats(), payload_cache.stats())
+        return
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    recommend_batches(args)
+    output["connections"] = client_pool.stats()
+    output["decoding"] = {**trapi_reader.settings(), "event_loop": args.event_loop}
+    output["payload_cache"] = payload_cache.stats()
+    output["budget"] = request_budget.stats()
+    output["harness"] = harness
+    output["trace"] = trace_writer.filename
     with open(output_filename, "w") as f:
         json.dump(output, f, indent = 2)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run(main)
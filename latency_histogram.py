@@ -0,0 +1,156 @@
+from typing import Any, Dict, Iterable, Optional
+
+PERCENTILES = [50, 90, 95, 99, 99.9]
+
+
+class LatencyHistogram:
+    """
+    HDR-style log-linear latency histogram.
+
+    Latencies are stored in microseconds in buckets whose width grows with the
+    value, so every recorded value is off by less than 1 / 2 ** (precision_bits - 1)
+    of itself while memory only grows with the range of values seen, never with the
+    number of requests. Histograms with the same precision can be merged, so stage,
+    target and worker histograms can be combined after the fact.
+    """
+
+    def __init__(self, precision_bits: int = 8):
+        self.precision_bits = precision_bits
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket_index(self, value: int) -> int:
+        if value < 1 << self.precision_bits:
+            return value
+        shift = value.bit_length() - self.precision_bits
+        return (shift << self.precision_bits) + (value >> shift)
+
+    def bucket_value(self, index: int) -> float:
+        """Get the midpoint of a bucket, in microseconds."""
+        shift = index >> self.precision_bits
+        if shift == 0:
+            return index
+        mantissa = index & ((1 << self.precision_bits) - 1)
+        low = mantissa << shift
+        high = ((mantissa + 1) << shift) - 1
+        return (low + high) / 2
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1_000_000), 0)
+        index = self.bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other: "LatencyHistogram"):
+        if other.precision_bits != self.precision_bits:
+            raise ValueError("Can't merge histograms with different precision")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """Get a latency percentile in seconds."""
+        if self.count == 0:
+            return None
+        target = percentile / 100 * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                value = self.bucket_value(index) / 1_000_000
+                # bucket midpoints can land just outside what was actually seen
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self, percentiles: Iterable[float] = PERCENTILES) -> Dict[str, Any]:
+        summary = {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+        }
+        for percentile in percentiles:
+            summary[f"p{percentile}"] = self.percentile(percentile)
+        return summary
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "precision_bits": self.precision_bits,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "counts": {str(index): count for index, count in sorted(self.counts.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencyHistogram":
+        histogram = cls(data["precision_bits"])
+        histogram.counts = {int(index): count for index, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class WindowedHistogram:
+    """A LatencyHistogram per fixed time window, for latency over time in long runs."""
+
+    def __init__(self, window: float = 10.0, precision_bits: int = 8):
+        self.window = window
+        self.precision_bits = precision_bits
+        self.windows: Dict[int, LatencyHistogram] = {}
+
+    def record(self, elapsed: float, seconds: float):
+        """Record a latency that finished elapsed seconds into the run."""
+        index = max(int(elapsed // self.window), 0)
+        if index not in self.windows:
+            self.windows[index] = LatencyHistogram(self.precision_bits)
+        self.windows[index].record(seconds)
+
+    def merge(self, other: "WindowedHistogram"):
+        if other.window != self.window:
+            raise ValueError("Can't merge windowed histograms with different windows")
+        for index, histogram in other.windows.items():
+            if index not in self.windows:
+                self.windows[index] = LatencyHistogram(self.precision_bits)
+            self.windows[index].merge(histogram)
+
+    def series(self):
+        """Get a throughput and latency percentile summary per window."""
+        series = []
+        for index in sorted(self.windows):
+            histogram = self.windows[index]
+            window_stats = {
+                "start": index * self.window,
+                "throughput": histogram.count / self.window,
+            }
+            window_stats.update(histogram.summary())
+            series.append(window_stats)
+        return series
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "window": self.window,
+            "windows": {str(index): histogram.to_dict() for index, histogram in sorted(self.windows.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "WindowedHistogram":
+        windowed = cls(data["window"])
+        windowed.windows = {int(index): LatencyHistogram.from_dict(histogram) for index, histogram in data["windows"].items()}
+        if windowed.windows:
+            windowed.precision_bits = next(iter(windowed.windows.values())).precision_bits
+        return windowed
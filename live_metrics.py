@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from client_pool import ClientPool
+from harness_monitor import get_rss
+from latency_histogram import LatencyHistogram, WindowedHistogram
+
+QUANTILES = [50, 95, 99]
+
+
+class TargetMetrics:
+    """Cumulative status counts and rolling latency for one target."""
+
+    def __init__(self, start_time: float, resolution: float):
+        self.start_time = start_time
+        self.statuses: Dict[Any, int] = {}
+        self.errors = 0
+        self.recent = WindowedHistogram(resolution)
+
+    def record(self, now: float, result: Dict[str, Any]):
+        status = result["status"]
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        # a 200 can still fail in the body, the error class is what says whether it worked
+        if result.get("error", "ok") != "ok":
+            self.errors += 1
+        self.recent.record(now - self.start_time, result["response_time"])
+
+    def window(self, now: float, seconds: float) -> Tuple[LatencyHistogram, float]:
+        """Get the latencies of about the last seconds seconds and how long they cover, dropping anything older."""
+        resolution = self.recent.window
+        elapsed = now - self.start_time
+        first = max(int((elapsed - seconds) // resolution) + 1, 0)
+        for index in [index for index in self.recent.windows if index < first]:
+            del self.recent.windows[index]
+        merged = LatencyHistogram(self.recent.precision_bits)
+        for histogram in self.recent.windows.values():
+            merged.merge(histogram)
+        return merged, max(elapsed - first * resolution, 1e-9)
+
+
+class LiveMetrics:
+    """
+    Live view of a run while it's going, instead of only once a stage is written out.
+
+    Every result the results sink records is counted against its target, which
+    is a couple of dict updates and a histogram bucket on the hot path. All the
+    rolling throughput and percentile math happens when someone looks: the
+    OpenMetrics endpoint when it's scraped, the terminal dashboard every
+    dashboard_interval seconds. In-flight requests come from the client pool.
+    """
+
+    def __init__(self, window: float = 60.0, resolution: float = 5.0):
+        self.window = window
+        self.resolution = resolution
+        self.port: Optional[int] = None
+        self.host = "127.0.0.1"
+        self.dashboard = False
+        self.dashboard_interval = 5.0
+        self.start_time = time.time()
+        self.targets: Dict[str, TargetMetrics] = {}
+        self.client_pool: Optional[ClientPool] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_cpu = (time.perf_counter(), time.process_time())
+
+    def configure(self, args: argparse.Namespace):
+        self.window = args.metrics_window
+        self.port = args.metrics_port
+        self.host = args.metrics_host
+        self.dashboard = args.dashboard
+        self.dashboard_interval = args.dashboard_interval
+
+    @property
+    def enabled(self) -> bool:
+        return self.port is not None or self.dashboard
+
+    def record(self, target: Any, result: Dict[str, Any]):
+        now = time.time()
+        target = str(target)
+        if target not in self.targets:
+            self.targets[target] = TargetMetrics(self.start_time, self.resolution)
+        self.targets[target].record(now, result)
+
+    def cpu_utilization(self) -> float:
+        """Get the fraction of a core the harness used since the last call."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        last_wall, last_cpu = self.last_cpu
+        self.last_cpu = (wall, cpu)
+        return (cpu - last_cpu) / (wall - last_wall) if wall > last_wall else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get the rolling stats of every target."""
+        now = time.time()
+        targets = {}
+        for target, metrics in self.targets.items():
+            window, span = metrics.window(now, self.window)
+            targets[target] = {
+                "throughput": window.count / span,
+                "latency": {quantile: window.percentile(quantile) for quantile in QUANTILES},
+                "statuses": dict(metrics.statuses),
+                "errors": metrics.errors,
+                "requests": sum(metrics.statuses.values()),
+            }
+        return {
+            "elapsed": now - self.start_time,
+            "targets": targets,
+            "in_flight": dict(self.client_pool.in_flight) if self.client_pool is not None else {},
+            "cpu_seconds": time.process_time(),
+            "rss": get_rss(),
+        }
+
+    def openmetrics(self) -> str:
+        snapshot = self.snapshot()
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help: str, samples: List[tuple]):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ",".join(f'{key}="{str(label).replace(chr(34), chr(39))}"' for key, label in labels.items())
+                sample_name = f"{name}_total" if kind == "counter" else name
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+
+        targets = snapshot["targets"].items()
+        metric("stress_requests", "counter", "Finished requests by target and status.", [
+            ({"target": target, "status": status}, count)
+            for target, stats in targets for status, count in stats["statuses"].items()
+        ])
+        metric("stress_errors", "counter", "Finished requests without a success status.", [
+            ({"target": target}, stats["errors"]) for target, stats in targets
+        ])
+        metric("stress_throughput", "gauge", f"Requests per second finished over the last {self.window:g}s.", [
+            ({"target": target}, stats["throughput"]) for target, stats in targets
+        ])
+        metric("stress_latency_seconds", "gauge", f"Latency percentiles over the last {self.window:g}s.", [
+            ({"target": target, "quantile": quantile / 100}, seconds)
+            for target, stats in targets for quantile, seconds in stats["latency"].items()
+        ])
+        metric("stress_in_flight", "gauge", "HTTP requests in flight by host.", [
+            ({"host": host}, count) for host, count in snapshot["in_flight"].items()
+        ])
+        metric("stress_process_cpu_seconds", "counter", "CPU seconds used by the harness.", [({}, snapshot["cpu_seconds"])])
+        metric("stress_process_resident_memory_bytes", "gauge", "Resident memory of the harness.", [({}, snapshot["rss"])])
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                pass
+            path = request_line.decode("latin-1").split()[1] if request_line else "/"
+            if path.split("?")[0] == "/metrics":
+                status, body = "200 OK", self.openmetrics().encode()
+            else:
+                status, body = "404 Not Found", b"Not found, try /metrics\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    def render(self) -> str:
+        """Render the dashboard as text."""
+        snapshot = self.snapshot()
+        lines = [
+            f"{snapshot['elapsed']:.0f}s elapsed, harness {self.cpu_utilization() * 100:.0f}% CPU, "
+            f"{snapshot['rss'] / 1e6:.0f}MB RSS, "
+            f"{sum(snapshot['in_flight'].values())} in flight (last {self.window:g}s below)",
+            f"{'target':<40} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'done':>8} {'errors':>8}  statuses",
+        ]
+        for target, stats in snapshot["targets"].items():
+            latency = [f"{seconds:.3f}" if seconds is not None else "-" for seconds in stats["latency"].values()]
+            statuses = " ".join(f"{status}:{count}" for status, count in stats["statuses"].items())
+            lines.append(
+                f"{target[:40]:<40} {stats['throughput']:>8.1f} {latency[0]:>8} {latency[1]:>8} {latency[2]:>8} "
+                f"{stats['requests']:>8} {stats['errors']:>8}  {statuses}"
+            )
+        return "\n".join(lines)
+
+    async def show_dashboard(self):
+        while True:
+            await asyncio.sleep(self.dashboard_interval)
+            text = self.render()
+            if sys.stdout.isatty():
+                # redraw in place instead of scrolling
+                text = "\x1b[H\x1b[2J" + text
+            print(text, flush=True)
+
+    async def start(self, results_sink, client_pool: ClientPool, port_offset: int = 0, dashboard: bool = True):
+        """Start feeding off the results sink and serving the endpoint and dashboard that were asked for."""
+        if not self.enabled:
+            return
+        self.start_time = time.time()
+        self.client_pool = client_pool
+        results_sink.metrics = self
+        if self.port is not None:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port + port_offset)
+            print(f"Serving live metrics on http://{self.host}:{self.port + port_offset}/metrics")
+        if self.dashboard and dashboard:
+            self.task = asyncio.create_task(self.show_dashboard())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            print(self.render())
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def add_live_metrics_arguments(parser: argparse.ArgumentParser):
+    """Add the live metrics command line arguments."""
+    parser.add_argument("--metrics_port", type=int, help="Serve live OpenMetrics on this port at /metrics, off by default", default=None)
+    parser.add_argument("--metrics_host", type=str, help="Address to serve live metrics on", default="127.0.0.1")
+    parser.add_argument("--metrics_window", type=float, help="Seconds of recent requests the live throughput and percentiles cover", default=60)
+    parser.add_argument("--dashboard", action="store_true", help="Show a live dashboard in the terminal instead of progress bars")
+    parser.add_argument("--dashboard_interval", type=float, help="Seconds between dashboard refreshes", default=5)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from load_scheduler import next_interval
+from result_stats import ResultStats
+
+STAGE_TYPES = ["ramp", "step", "spike", "soak", "pause"]
+
+
+def load_profile(filename: str) -> List[Dict[str, Any]]:
+    """
+    Load a load profile config file into a flat list of stages.
+
+    A profile looks like:
+    {
+      "stages": [
+        {"type": "ramp", "duration": 300, "concurrency": [1, 100]},
+        {"type": "step", "duration": 60, "rate": [5, 10, 20]},
+        {"type": "spike", "duration": 30, "rate": 200},
+        {"type": "pause", "duration": 60},
+        {"type": "soak", "duration": 14400, "rate": 5, "num_curies": 10}
+      ]
+    }
+
+    Ramps go linearly from the first to the second value over the stage duration,
+    steps with a list of values are expanded into one plateau per value and
+    pauses send nothing so the target can cool down. Any other keys on a stage
+    (like num_curies) are passed through to the runner.
+    """
+    with open(filename, "r") as f:
+        profile = json.load(f)
+    stages = []
+    for stage in profile["stages"]:
+        stage_type = stage.get("type", "step")
+        if stage_type not in STAGE_TYPES:
+            raise ValueError(f"Unknown stage type {stage_type}, expected one of {STAGE_TYPES}")
+        if "duration" not in stage:
+            raise ValueError(f"Stage {stage} is missing a duration")
+        load_keys = [key for key in ["concurrency", "rate"] if key in stage]
+        if stage_type == "pause":
+            if load_keys:
+                raise ValueError("Pause stages can't have a concurrency or rate")
+        elif len(load_keys) != 1:
+            raise ValueError(f"Stage {stage} needs exactly one of concurrency or rate")
+        if stage_type == "ramp":
+            value = stage[load_keys[0]]
+            if not isinstance(value, list) or len(value) != 2:
+                raise ValueError(f"Ramp stage {stage} needs a [start, end] {load_keys[0]}")
+            stages.append(dict(stage, type=stage_type))
+        elif load_keys and isinstance(stage[load_keys[0]], list):
+            if stage_type != "step":
+                raise ValueError(f"Only ramp and step stages can take a list of values: {stage}")
+            for value in stage[load_keys[0]]:
+                stages.append(dict(stage, type=stage_type, **{load_keys[0]: value}))
+        else:
+            stages.append(dict(stage, type=stage_type))
+    return stages
+
+
+def get_stage_key(index: int, stage: Dict[str, Any]) -> str:
+    """Get the output key for a profile stage."""
+    if stage["type"] == "pause":
+        return f"{index}_pause"
+    load = stage.get("concurrency", stage.get("rate", 0))
+    if isinstance(load, list):
+        load = f"{load[0]}-{load[1]}"
+    unit = "c" if "concurrency" in stage else "rps"
+    return f"{index}_{stage['type']}_{load}{unit}"
+
+
+def stage_value(stage: Dict[str, Any], key: str, fraction: float) -> float:
+    """Get the concurrency or rate a stage asks for at a fraction of the way through it."""
+    value = stage[key]
+    if isinstance(value, list):
+        return value[0] + (value[1] - value[0]) * min(max(fraction, 0), 1)
+    return value
+
+
+class StageRecord:
+    """Bookkeeping for the requests that were started during one profile stage."""
+
+    def __init__(self, index: int, stage: Dict[str, Any]):
+        self.index = index
+        self.stage = stage
+        self.stats = ResultStats()
+        self.in_flight = 0
+        self.ended = False
+        self.reported = False
+        self.start_time = 0.0
+        self.end_time = 0.0
+        self.sent = 0
+        self.late = 0
+        self.dropped = 0
+        self.max_send_lag = 0.0
+
+
+class ProfileRunner:
+    """
+    Drive one target through a list of profile stages without stopping between them.
+
+    Concurrency stages keep a pool of workers that each send requests back to back,
+    rate stages schedule requests open loop. When a stage ends the requests it
+    started keep going and are still counted against it, while the next stage
+    starts right away. on_result is called with the stage record as each request
+    finishes and on_stage_done once every request of a stage has finished. share
+    turns the concurrency or rate a stage asks for into the part of it this runner
+    should send, for when the load is spread over several workers.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        stages: List[Dict[str, Any]],
+        on_result: Callable[[StageRecord, Dict[str, Any]], None],
+        on_stage_done: Callable[[StageRecord], None],
+        arrival: str = "fixed",
+        max_in_flight: Optional[int] = None,
+        late_threshold: float = 0.05,
+        seed: Optional[int] = None,
+        tick: float = 1.0,
+        share: Callable[[float], float] = lambda value: value,
+    ):
+        self.send = send
+        self.stages = stages
+        self.on_result = on_result
+        self.on_stage_done = on_stage_done
+        self.arrival = arrival
+        self.max_in_flight = max_in_flight
+        self.late_threshold = late_threshold
+        self.rng = random.Random(seed)
+        self.tick = tick
+        self.share = share
+        self.record = None
+        self.target_concurrency = 0
+        self.active_workers = 0
+        self.in_flight = 0
+        self.tasks = set()
+
+    def track(self, coroutine: Awaitable):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def start_request(self, record: StageRecord):
+        record.sent += 1
+        record.in_flight += 1
+        self.in_flight += 1
+
+    async def timed_send(self, record: StageRecord, scheduled_time: Optional[float] = None):
+        """Send one request that start_request has already counted as in flight."""
+        loop = asyncio.get_running_loop()
+        send_time = loop.time()
+        try:
+            result = await self.send(record.stage)
+            if scheduled_time is not None:
+                stop_time = loop.time()
+                result["service_time"] = result["response_time"]
+                result["response_time"] = stop_time - scheduled_time
+                result["send_lag"] = send_time - scheduled_time
+            self.on_result(record, result)
+        finally:
+            record.in_flight -= 1
+            self.in_flight -= 1
+            self.check_done(record)
+
+    def check_done(self, record: StageRecord):
+        if record.ended and record.in_flight == 0 and not record.reported:
+            record.reported = True
+            record.end_time = asyncio.get_running_loop().time()
+            self.on_stage_done(record)
+
+    async def worker(self):
+        while True:
+            if self.active_workers > self.target_concurrency:
+                self.active_workers -= 1
+                return
+            record = self.record
+            self.start_request(record)
+            await self.timed_send(record)
+
+    def set_concurrency(self, concurrency: int):
+        self.target_concurrency = concurrency
+        while self.active_workers < self.target_concurrency:
+            self.active_workers += 1
+            self.track(self.worker())
+
+    async def sleep_until(self, when: float):
+        delay = when - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def drive_concurrency(self, record: StageRecord, stage_start: float, stage_end: float):
+        loop = asyncio.get_running_loop()
+        duration = record.stage["duration"]
+        while loop.time() < stage_end:
+            fraction = (loop.time() - stage_start) / duration if duration else 1
+            self.set_concurrency(self.share(round(stage_value(record.stage, "concurrency", fraction))))
+            await self.sleep_until(min(loop.time() + self.tick, stage_end))
+
+    async def drive_rate(self, record: StageRecord, stage_start: float, stage_end: float):
+        loop = asyncio.get_running_loop()
+        duration = record.stage["duration"]
+        scheduled_time = stage_start
+        while scheduled_time < stage_end:
+            fraction = (scheduled_time - stage_start) / duration if duration else 1
+            rate = self.share(float(stage_value(record.stage, "rate", fraction)))
+            if rate <= 0:
+                scheduled_time = min(scheduled_time + self.tick, stage_end)
+                await self.sleep_until(scheduled_time)
+                continue
+            await self.sleep_until(scheduled_time)
+            send_lag = loop.time() - scheduled_time
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                record.dropped += 1
+            else:
+                self.start_request(record)
+                if send_lag > self.late_threshold:
+                    record.late += 1
+                record.max_send_lag = max(record.max_send_lag, send_lag)
+                self.track(self.timed_send(record, scheduled_time))
+            scheduled_time += next_interval(rate, self.arrival, self.rng)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stage_start = loop.time()
+        for index, stage in enumerate(self.stages):
+            stage_end = stage_start + stage["duration"]
+            previous = self.record
+            self.record = StageRecord(index, stage)
+            self.record.start_time = stage_start
+            if previous is not None:
+                previous.ended = True
+                self.check_done(previous)
+            if "concurrency" in stage:
+                await self.drive_concurrency(self.record, stage_start, stage_end)
+            else:
+                self.set_concurrency(0)
+                if "rate" in stage:
+                    await self.drive_rate(self.record, stage_start, stage_end)
+                else:
+                    await self.sleep_until(stage_end)
+            stage_start = stage_end
+        self.set_concurrency(0)
+        self.record.ended = True
+        self.check_done(self.record)
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+def get_stage_stats(record: StageRecord) -> Dict[str, Any]:
+    """Describe how much load a profile stage actually offered."""
+    stage_time = record.end_time - record.start_time
+    stage_stats = {
+        "stage": record.stage,
+        "sent": record.sent,
+        "achieved_rate": record.sent / record.stage["duration"] if record.stage["duration"] else 0,
+    }
+    if "rate" in record.stage:
+        stage_stats["late"] = record.late
+        stage_stats["dropped"] = record.dropped
+        stage_stats["max_send_lag"] = record.max_send_lag
+    stage_stats["drain_time"] = max(stage_time - record.stage["duration"], 0)
+    return stage_stats
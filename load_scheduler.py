@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+
+def next_interval(rate: float, arrival: str, rng: random.Random) -> float:
+    """Get the gap until the next scheduled request."""
+    if arrival == "poisson":
+        return rng.expovariate(rate)
+    return 1 / rate
+
+
+async def run_open_loop(
+    send: Callable[[], Awaitable[Dict[str, Any]]],
+    on_result: Callable[[Dict[str, Any]], None],
+    rate: float,
+    duration: float,
+    arrival: str = "fixed",
+    max_in_flight: Optional[int] = None,
+    late_threshold: float = 0.05,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Issue requests at a target rate for a set duration, regardless of how fast they finish.
+
+    Latency is measured from when each request was scheduled to go out, so a stalled
+    target or a stalled harness shows up in the numbers instead of silently lowering
+    the offered load (coordinated omission). Requests that would exceed max_in_flight
+    are dropped and requests that go out more than late_threshold seconds after their
+    scheduled time are counted as late. Each finished request is handed to
+    on_result and the achieved rate stats are returned.
+    """
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    completed = 0
+    in_flight = set()
+    scheduled = 0
+    sent = 0
+    dropped = 0
+    late = 0
+    max_send_lag = 0.0
+
+    async def timed_send(scheduled_time: float):
+        nonlocal completed
+        send_time = loop.time()
+        result = await send()
+        stop_time = loop.time()
+        result["service_time"] = result["response_time"]
+        result["response_time"] = stop_time - scheduled_time
+        result["send_lag"] = send_time - scheduled_time
+        completed += 1
+        on_result(result)
+
+    start_time = loop.time()
+    end_time = start_time + duration
+    scheduled_time = start_time
+    while scheduled_time < end_time:
+        delay = scheduled_time - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        scheduled += 1
+        send_lag = loop.time() - scheduled_time
+        if max_in_flight is not None and len(in_flight) >= max_in_flight:
+            dropped += 1
+        else:
+            sent += 1
+            if send_lag > late_threshold:
+                late += 1
+            max_send_lag = max(max_send_lag, send_lag)
+            task = asyncio.create_task(timed_send(scheduled_time))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        scheduled_time += next_interval(rate, arrival, rng)
+    send_window = loop.time() - start_time
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    total_time = loop.time() - start_time
+
+    rate_stats = {
+        "arrival": arrival,
+        "target_rate": rate,
+        "achieved_rate": sent / send_window if send_window > 0 else 0,
+        "completed_rate": completed / total_time if total_time > 0 else 0,
+        "duration": duration,
+        "scheduled": scheduled,
+        "sent": sent,
+        "dropped": dropped,
+        "late": late,
+        "max_send_lag": max_send_lag,
+    }
+    return rate_stats
+
+
+async def run_burst(lookups: Iterable[Awaitable[Dict[str, Any]]], on_result: Callable[[Dict[str, Any]], None]):
+    """Send a burst of requests at once, handing each result to on_result as soon as it's back instead of after the whole burst."""
+    async def send(lookup: Awaitable[Dict[str, Any]]):
+        on_result(await lookup)
+
+    await asyncio.gather(*[send(lookup) for lookup in lookups])
+
+
+def add_load_arguments(parser: argparse.ArgumentParser):
+    """Add the load mode command line arguments."""
+    parser.add_argument("--mode", type=str, choices=["burst", "open_loop", "profile", "capacity", "cache", "compression"], help="Fire gathered bursts, a steady arrival rate, a load profile, search for capacity under an SLO, compare cold and warm caches or compare compression settings", default="burst")
+    parser.add_argument("--rate", type=float, help="Open loop target requests per second", default=10)
+    parser.add_argument("--duration", type=float, help="Open loop seconds to send requests for", default=60)
+    parser.add_argument("--arrival", type=str, choices=["fixed", "poisson"], help="Open loop inter-arrival distribution", default="fixed")
+    parser.add_argument("--max_in_flight", type=int, help="Open loop requests in flight before new ones are dropped", default=None)
+    parser.add_argument("--profile", type=str, help="Load profile config file for --mode profile", default="profiles/ramp.json")
+    parser.add_argument("--seed", type=int, help="Random seed for poisson arrivals", default=None)
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+from collections import OrderedDict
+import functools
+import gzip
+import hashlib
+from http import HTTPStatus
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_SETTINGS = {
+    # seconds before the response headers go out
+    "latency": {"distribution": "fixed", "mean": 0.05},
+    # extra seconds for every edge in the query graph, so bigger query graphs answer slower
+    "latency_per_edge": 0.0,
+    "results": 10,
+    # extra results for every curie in the query graph
+    "results_per_curie": 0,
+    # padding added to every edge so responses can be made bigger without more results
+    "result_bytes": 200,
+    # status code weights, anything but 200 gets a small error body
+    "statuses": {"200": 1.0},
+    # slow streaming, a chunk_delay above 0 sends the body chunked with a pause before each chunk
+    "chunk_bytes": 65536,
+    "chunk_delay": 0.0,
+    # how long ARS jobs run before their merged message is ready, and how many end in Error
+    "job_latency": {"distribution": "fixed", "mean": 5.0},
+    "job_error_rate": 0.0,
+    # a response cache: queries seen before come back after cache_latency instead, unless they ask
+    # to bypass_cache, and the least recently used of more than cache_entries queries are forgotten
+    "cache_latency": None,
+    "cache_entries": 1000,
+    # response encodings (gzip, zstd) offered to clients that accept them, zstd only when zstandard is installed
+    "encodings": [],
+}
+# forget ARS jobs an hour after they were submitted
+JOB_TTL = 3600
+
+
+def sample_latency(latency: Dict[str, Any], rng: random.Random) -> float:
+    """Draw a delay in seconds from a latency distribution config."""
+    distribution = latency.get("distribution", "fixed")
+    if distribution == "fixed":
+        delay = latency["mean"]
+    elif distribution == "uniform":
+        delay = rng.uniform(latency["min"], latency["max"])
+    elif distribution == "exponential":
+        delay = rng.expovariate(1 / latency["mean"])
+    elif distribution == "lognormal":
+        delay = rng.lognormvariate(math.log(latency["median"]), latency["sigma"])
+    else:
+        raise ValueError(f"Unknown latency distribution {distribution}")
+    return min(max(delay, 0), latency.get("cap", math.inf))
+
+
+def sample_status(statuses: Dict[str, float], rng: random.Random) -> int:
+    codes = list(statuses)
+    return int(rng.choices(codes, weights=[statuses[code] for code in codes])[0])
+
+
+def bypasses_cache(body: bytes) -> bool:
+    try:
+        return json.loads(body).get("bypass_cache") is True
+    except (ValueError, AttributeError):
+        return False
+
+
+def count_curies(body: bytes) -> int:
+    try:
+        query = json.loads(body)
+        nodes = query["message"]["query_graph"]["nodes"]
+    except (ValueError, KeyError, TypeError):
+        return 0
+    return sum(len(node.get("ids") or []) for node in nodes.values())
+
+
+def count_edges(body: bytes) -> int:
+    try:
+        return len(json.loads(body)["message"]["query_graph"]["edges"])
+    except (ValueError, KeyError, TypeError):
+        return 0
+
+
+def decode_body(body: bytes, encoding: str) -> bytes:
+    """Undo a request body's Content-Encoding, raising ValueError for ones the mock doesn't speak."""
+    encoding = encoding.strip().lower()
+    if encoding in ["", "identity"]:
+        return body
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd needs zstandard")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError(f"Unsupported content encoding {encoding}")
+
+
+def pick_encoding(accept_encoding: str, offered: List[str]) -> Optional[str]:
+    """Pick the first encoding the client accepts that the route offers, None for identity."""
+    for value in accept_encoding.split(","):
+        encoding, _, params = value.strip().lower().partition(";")
+        if params.replace(" ", "") in ["q=0", "q=0.0"]:
+            continue
+        if encoding == "zstd" and encoding in offered:
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                continue
+            return encoding
+        if encoding == "gzip" and encoding in offered:
+            return encoding
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def encode_body(body: bytes, encoding: str) -> bytes:
+    """Compress (once) a response body."""
+    if encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, 6)
+
+
+@functools.lru_cache(maxsize=64)
+def trapi_message(num_results: int, result_bytes: int) -> bytes:
+    """Build (once) the serialized TRAPI message for a result count and padding size."""
+    nodes = {"MOCK:0": {"name": "mock disease", "categories": ["biolink:Disease"]}}
+    edges = {}
+    results = []
+    padding = "x" * result_bytes
+    for ndx in range(1, num_results + 1):
+        nodes[f"MOCK:{ndx}"] = {"name": f"mock chemical {ndx}", "categories": ["biolink:ChemicalEntity"]}
+        edges[f"e{ndx}"] = {
+            "subject": f"MOCK:{ndx}",
+            "object": "MOCK:0",
+            "predicate": "biolink:treats_or_applied_or_studied_to_treat",
+            "sources": [{"resource_id": "infores:mock", "resource_role": "primary_knowledge_source"}],
+            "attributes": [{"attribute_type_id": "biolink:description", "value": padding}],
+        }
+        results.append({
+            "node_bindings": {"chemical": [{"id": f"MOCK:{ndx}"}], "f": [{"id": "MOCK:0"}]},
+            "analyses": [{
+                "resource_id": "infores:mock",
+                "edge_bindings": {"edge_1": [{"id": f"e{ndx}"}]},
+                "score": 1 / ndx,
+            }],
+        })
+    return json.dumps({
+        "query_graph": {},
+        "knowledge_graph": {"nodes": nodes, "edges": edges},
+        "results": results,
+    }).encode()
+
+
+class MockServer:
+    """
+    Asyncio mock of the Translator services the stress tests talk to.
+
+    Any POST is answered like a KP or ARA /query, except paths ending in /submit,
+    which start an ARS job whose parent message can be polled at
+    {prefix}/messages/{pk} until it's Done and points at a merged message. Each
+    request gets the settings of the longest matching route prefix on top of the
+    defaults, which set the latency distribution, result count, response size,
+    status codes, how slowly the body is streamed and whether repeated queries
+    are answered from a cache. Only HTTP/1.1 with keep-alive is spoken, which is
+    all the harness needs.
+    """
+
+    def __init__(self, config: Dict[str, Any], seed: Optional[int] = None):
+        self.defaults = dict(DEFAULT_SETTINGS, **config.get("defaults", {}))
+        self.routes = config.get("routes", {})
+        self.rng = random.Random(seed)
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        # merged message pk -> parent pk
+        self.merged: Dict[str, str] = {}
+        # (path, body hash) of the queries each route has cached
+        self.cache: "OrderedDict[Tuple[str, bytes], None]" = OrderedDict()
+
+    def settings(self, path: str) -> Dict[str, Any]:
+        prefixes = [prefix for prefix in self.routes if path.startswith(prefix)]
+        if not prefixes:
+            return self.defaults
+        return dict(self.defaults, **self.routes[max(prefixes, key=len)])
+
+    def num_results(self, settings: Dict[str, Any], body: bytes) -> int:
+        num_results = settings["results"]
+        if settings["results_per_curie"]:
+            num_results += settings["results_per_curie"] * count_curies(body)
+        return num_results
+
+    def submit(self, settings: Dict[str, Any], body: bytes) -> bytes:
+        now = time.monotonic()
+        self.jobs = {pk: job for pk, job in self.jobs.items() if now - job["submitted"] < JOB_TTL}
+        self.merged = {merged_pk: pk for merged_pk, pk in self.merged.items() if pk in self.jobs}
+        pk = str(uuid.uuid4())
+        self.jobs[pk] = {
+            "submitted": now,
+            "done_at": now + sample_latency(settings["job_latency"], self.rng),
+            "status": "Error" if self.rng.random() < settings["job_error_rate"] else "Done",
+            "merged_pk": str(uuid.uuid4()),
+            "num_results": self.num_results(settings, body),
+            "result_bytes": settings["result_bytes"],
+        }
+        self.merged[self.jobs[pk]["merged_pk"]] = pk
+        return json.dumps({"pk": pk}).encode()
+
+    def message(self, pk: str) -> Tuple[int, bytes]:
+        if pk in self.merged:
+            job = self.jobs[self.merged[pk]]
+            message = trapi_message(job["num_results"], job["result_bytes"])
+            return 200, b'{"pk":"%s","fields":{"status":"Done","data":{"message":%s}}}' % (pk.encode(), message)
+        job = self.jobs.get(pk)
+        if job is None:
+            return 404, b'{"detail":"Unknown message"}'
+        if time.monotonic() < job["done_at"]:
+            return 200, json.dumps({"pk": pk, "status": "Running", "merged_version": None}).encode()
+        merged_pk = job["merged_pk"] if job["status"] == "Done" else None
+        return 200, json.dumps({"pk": pk, "status": job["status"], "merged_version": merged_pk}).encode()
+
+    def cached(self, settings: Dict[str, Any], path: str, body: bytes) -> bool:
+        """Check whether a query is in the cache, caching it if it isn't."""
+        if settings["cache_latency"] is None or bypasses_cache(body):
+            return False
+        key = (path, hashlib.sha1(body).digest())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return True
+        self.cache[key] = None
+        if len(self.cache) > settings["cache_entries"]:
+            self.cache.popitem(last=False)
+        return False
+
+    async def respond(self, method: str, path: str, body: bytes) -> Tuple[int, bytes, Dict[str, Any]]:
+        settings = self.settings(path)
+        if method == "GET" and "/messages/" in path:
+            status, response = self.message(path.rsplit("/messages/", 1)[1])
+            return status, response, settings
+        if method != "POST":
+            return 404, b'{"detail":"Not found"}', settings
+        latency = settings["cache_latency"] if self.cached(settings, path, body) else settings["latency"]
+        delay = sample_latency(latency, self.rng)
+        if settings["latency_per_edge"] and latency is settings["latency"]:
+            delay += settings["latency_per_edge"] * count_edges(body)
+        await asyncio.sleep(delay)
+        status = sample_status(settings["statuses"], self.rng)
+        if status != 200:
+            return status, b'{"detail":"Mock error"}', settings
+        if path.endswith("/submit"):
+            return 200, self.submit(settings, body), settings
+        message = trapi_message(self.num_results(settings, body), settings["result_bytes"])
+        return 200, b'{"message":%s}' % message, settings
+
+    async def send(self, writer: asyncio.StreamWriter, status: int, body: bytes, settings: Dict[str, Any], keep_alive: bool, encoding: Optional[str] = None):
+        headers = [
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+            "Content-Type: application/json",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if encoding is not None:
+            body = encode_body(body, encoding)
+            headers.append(f"Content-Encoding: {encoding}")
+        if settings["chunk_delay"] <= 0:
+            headers.append(f"Content-Length: {len(body)}")
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+            return
+        headers.append("Transfer-Encoding: chunked")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+        await writer.drain()
+        for ndx in range(0, len(body), settings["chunk_bytes"]):
+            await asyncio.sleep(settings["chunk_delay"])
+            chunk = body[ndx:ndx + settings["chunk_bytes"]]
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    return body
+                body += chunk[:-2]
+        return await reader.readexactly(int(headers.get("content-length", 0)))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await self.read_body(reader, headers)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                path = target.split("?")[0]
+                try:
+                    body = decode_body(body, headers.get("content-encoding", ""))
+                except (ValueError, OSError, EOFError):
+                    await self.send(writer, 415, b'{"detail":"Unsupported or broken content encoding"}', self.settings(path), keep_alive)
+                    if not keep_alive:
+                        break
+                    continue
+                status, response, settings = await self.respond(method, path, body)
+                encoding = pick_encoding(headers.get("accept-encoding", ""), settings["encodings"]) if status == 200 else None
+                await self.send(writer, status, response, settings, keep_alive, encoding)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Mock Translator services listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=("Mock Translator Services"))
+    parser.add_argument("--host", type=str, help="Address to listen on", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port to listen on", default=8080)
+    parser.add_argument("--config", type=str, help="Route settings config file", default="mock/mock_server.json")
+    parser.add_argument("--seed", type=int, help="Random seed for latencies, statuses and ARS jobs", default=None)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    await MockServer(config, args.seed).serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+import argparse
+from collections import OrderedDict
+import json
+import time
+from typing import Any, Callable, Dict, Hashable
+
+# same encoding httpx uses for json=
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def encode_payload(payload: Any) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+class PayloadCache:
+    """
+    LRU cache of request bodies that are already serialized to bytes.
+
+    Each distinct body (like one KP's query template cut down to a batch size) is
+    built and encoded once, then the same bytes are sent with every request that
+    needs it, so query building doesn't cost client CPU on every lookup. The
+    least recently used bodies are dropped once there are more than max_entries
+    of them or they take up more than max_bytes. A max_entries of 0 turns caching
+    off and builds every body fresh. Bodies that will only ever be sent once are
+    got with store=False, so they don't push out ones that repeat.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+        self.build_time = 0.0
+
+    def configure(self, args: argparse.Namespace):
+        self.max_entries = args.payload_cache_entries
+        self.max_bytes = int(args.payload_cache_mb * 1024 * 1024)
+
+    def get(self, key: Hashable, build: Callable[[], Any], store: bool = True) -> bytes:
+        """Get the encoded body for key, building it with build() if it isn't cached, or every time when not store."""
+        if not store:
+            self.uncached += 1
+            start_time = time.perf_counter()
+            body = encode_payload(build())
+            self.build_time += time.perf_counter() - start_time
+            return body
+        body = self.entries.get(key)
+        if body is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return body
+        self.misses += 1
+        start_time = time.perf_counter()
+        body = encode_payload(build())
+        self.build_time += time.perf_counter() - start_time
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return body
+        self.entries[key] = body
+        self.size += len(body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+        return body
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "uncached": self.uncached,
+            "build_time": self.build_time,
+        }
+
+
+def merge_cache_stats(merged: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Add up the payload cache stats of two workers."""
+    if not merged:
+        return dict(other)
+    merged = {key: merged[key] + other[key] for key in ["entries", "bytes", "hits", "misses", "evictions", "uncached", "build_time"]}
+    lookups = merged["hits"] + merged["misses"]
+    merged["hit_rate"] = merged["hits"] / lookups if lookups else None
+    return merged
+
+
+def add_payload_cache_arguments(parser: argparse.ArgumentParser):
+    """Add the payload cache command line arguments."""
+    parser.add_argument("--payload_cache_entries", type=int, help="Request bodies to keep serialized, 0 builds every body fresh", default=4096)
+    parser.add_argument("--payload_cache_mb", type=float, help="Max megabytes of cached request bodies", default=256)
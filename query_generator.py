@@ -0,0 +1,208 @@
+import argparse
+import json
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from payload_cache import PayloadCache
+from result_stats import ResultStats
+
+DEFAULT_SHAPE = {
+    "weight": 1,
+    # edges along each branch out of the pinned node
+    "hops": 1,
+    # chains fanning out of the pinned node, so a shape has 1 + hops * branches nodes
+    "branches": 1,
+    # curies on the pinned node
+    "batch_size": 1,
+    # curie list or kp_queries.json style file the pinned node's ids are drawn from
+    "ids": "curie_list.json",
+    "pinned_categories": None,
+    # cycled along each branch, one per unpinned node and one per edge
+    "categories": ["biolink:ChemicalEntity"],
+    "predicates": ["biolink:related_to"],
+    "knowledge_type": None,
+    # distinct queries built up front, each one a different draw of ids
+    "templates": 20,
+}
+
+
+def load_ids(filename: str) -> List[str]:
+    """Load the curies a pinned node can draw from, a list of curies or every pinned id of a kp_queries.json file."""
+    with open(filename, "r") as f:
+        ids = json.load(f)
+    if isinstance(ids, list):
+        return ids
+    pool = []
+    for kp in ids.values():
+        for node in kp["query"]["message"]["query_graph"]["nodes"].values():
+            pool.extend(node.get("ids") or [])
+    # keep the first of each, so the pool and the draws from it are the same every run
+    return list(dict.fromkeys(pool))
+
+
+def load_workload(filename: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Load a workload config file into its query shapes.
+
+    A workload looks like:
+    {
+      "seed": 1,
+      "shapes": {
+        "one_hop": {"weight": 4, "batch_size": 1, "predicates": ["biolink:treats"]},
+        "two_hop": {"hops": 2, "categories": ["biolink:Gene", "biolink:ChemicalEntity"]},
+        "star": {"branches": 3, "batch_size": 10, "ids": "kp_queries.json"}
+      }
+    }
+
+    Shapes are picked at random in proportion to their weight. Any key a shape
+    leaves out gets its DEFAULT_SHAPE value.
+    """
+    with open(filename, "r") as f:
+        workload = json.load(f)
+    shapes = {}
+    for name, shape in workload["shapes"].items():
+        unknown = set(shape) - set(DEFAULT_SHAPE)
+        if unknown:
+            raise ValueError(f"Shape {name} has unknown keys {sorted(unknown)}")
+        shape = dict(DEFAULT_SHAPE, **shape)
+        for key in ["hops", "branches", "batch_size", "templates"]:
+            if not isinstance(shape[key], int) or shape[key] < 1:
+                raise ValueError(f"Shape {name} needs a positive whole {key}")
+        if shape["weight"] <= 0:
+            raise ValueError(f"Shape {name} needs a positive weight")
+        if not shape["categories"] or not shape["predicates"]:
+            raise ValueError(f"Shape {name} needs at least one category and predicate")
+        shapes[name] = shape
+    if not shapes:
+        raise ValueError(f"Workload {filename} has no shapes")
+    return shapes
+
+
+def build_query_graph(shape: Dict[str, Any], ids: List[str]) -> Dict[str, Any]:
+    """Build a query graph with branches chains of hops edges out of a node pinned to ids."""
+    pinned = {"ids": ids}
+    if shape["pinned_categories"]:
+        pinned["categories"] = shape["pinned_categories"]
+    if len(ids) > 1:
+        pinned["set_interpretation"] = "BATCH"
+    nodes = {"n0": pinned}
+    edges = {}
+    for branch in range(shape["branches"]):
+        previous = "n0"
+        for hop in range(shape["hops"]):
+            node = f"n{branch}_{hop + 1}"
+            nodes[node] = {"categories": [shape["categories"][hop % len(shape["categories"])]]}
+            # point at the pinned node, like a chemical that treats a disease
+            edge = {
+                "subject": node,
+                "object": previous,
+                "predicates": [shape["predicates"][hop % len(shape["predicates"])]],
+            }
+            if shape["knowledge_type"]:
+                edge["knowledge_type"] = shape["knowledge_type"]
+            edges[f"e{branch}_{hop + 1}"] = edge
+            previous = node
+    return {"nodes": nodes, "edges": edges}
+
+
+def describe_shape(shape: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "weight": shape["weight"],
+        "hops": shape["hops"],
+        "branches": shape["branches"],
+        "nodes": 1 + shape["hops"] * shape["branches"],
+        "edges": shape["hops"] * shape["branches"],
+        "batch_size": shape["batch_size"],
+    }
+
+
+class QueryGenerator:
+    """
+    Seeded generator of synthetic TRAPI queries from a weighted mix of query graph shapes.
+
+    Every shape's templates (query graphs with their ids already drawn) are built
+    once when the workload is loaded, and each is encoded once through the
+    payload cache the first time it's sent, so a run only picks a shape and a
+    template per request. The same seed gives the same templates and the same
+    sequence of picks. Results are tallied per target and shape, to see how
+    latency grows with query complexity.
+    """
+
+    def __init__(self):
+        self.filename = None
+        self.shapes: Dict[str, Dict[str, Any]] = {}
+        self.templates: Dict[str, List[Dict[str, Any]]] = {}
+        self.rng = random.Random()
+        self.payload_cache = PayloadCache()
+        # target -> shape -> stats
+        self.stats: Dict[str, Dict[str, ResultStats]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.filename is not None
+
+    def configure(self, args: argparse.Namespace):
+        if args.workload is None:
+            return
+        self.load(args.workload, args.workload_seed)
+
+    def load(self, filename: str, seed: Optional[int] = None):
+        with open(filename, "r") as f:
+            file_seed = json.load(f).get("seed", 0)
+        self.filename = filename
+        self.shapes = load_workload(filename)
+        self.rng = random.Random(file_seed if seed is None else seed)
+        pools: Dict[str, List[str]] = {}
+        for name, shape in self.shapes.items():
+            if shape["ids"] not in pools:
+                pools[shape["ids"]] = load_ids(shape["ids"])
+            pool = pools[shape["ids"]]
+            if len(pool) < shape["batch_size"]:
+                raise ValueError(f"Shape {name} wants {shape['batch_size']} ids but {shape['ids']} only has {len(pool)}")
+            self.templates[name] = [
+                build_query_graph(shape, self.rng.sample(pool, shape["batch_size"]))
+                for _ in range(shape["templates"])
+            ]
+
+    def next(self, bypass_cache: Optional[bool] = None) -> Tuple[str, bytes]:
+        """Pick the next query, giving back its shape name and encoded body."""
+        names = list(self.shapes)
+        name = self.rng.choices(names, weights=[self.shapes[name]["weight"] for name in names])[0]
+        index = self.rng.randrange(len(self.templates[name]))
+
+        def build() -> Dict[str, Any]:
+            message = {"message": {"query_graph": self.templates[name][index]}}
+            if bypass_cache is not None:
+                message["bypass_cache"] = bypass_cache
+            return message
+
+        return name, self.payload_cache.get((name, index, bypass_cache), build)
+
+    def record(self, target: str, shape: str, result: Dict[str, Any]):
+        target_stats = self.stats.setdefault(target, {})
+        if shape not in target_stats:
+            target_stats[shape] = ResultStats()
+        target_stats[shape].add(result)
+
+    def summary(self, names: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Get the shapes and each target's stats per shape, with targets under the names of their urls."""
+        if not self.enabled:
+            return None
+        targets = {}
+        for target, target_stats in self.stats.items():
+            targets[names.get(target, target)] = {
+                shape: dict(stats.to_dict(None), shape=describe_shape(self.shapes[shape]))
+                for shape, stats in sorted(target_stats.items())
+            }
+        return {
+            "workload": self.filename,
+            "shapes": {name: describe_shape(shape) for name, shape in self.shapes.items()},
+            "targets": targets,
+            "payload_cache": self.payload_cache.stats(),
+        }
+
+
+def add_query_generator_arguments(parser: argparse.ArgumentParser):
+    """Add the synthetic query workload command line arguments."""
+    parser.add_argument("--workload", type=str, help="Workload file of weighted query graph shapes to send instead of the fixed query, like workloads/complexity.json", default=None)
+    parser.add_argument("--workload_seed", type=int, help="Seed for the workload's templates and picks, the workload file's seed by default", default=None)
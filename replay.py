@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from client_pool import ClientPool, add_client_pool_arguments
+from event_loop import add_event_loop_arguments, run
+from host_scheduler import ConcurrencyBudget, add_host_scheduler_arguments
+from harness_monitor import HarnessMonitor, add_harness_monitor_arguments
+from live_metrics import LiveMetrics, add_live_metrics_arguments
+from payload_cache import JSON_HEADERS, encode_payload
+from request_errors import classify, deadline
+from request_trace import DEFAULT_TRACE, read_traces
+from result_stats import ResultStats
+from request_timing import AsyncRequestTimer
+from results_sink import ResultsSink
+from results_store import add_results_store_arguments, check_format, write_columns
+from trapi_stream import TrapiReader, add_trapi_stream_arguments, empty_counts
+
+# filled from --targets, if given
+targets = {}
+
+output = {
+    "replay": {},
+}
+
+client_pool = ClientPool(timeout=60, read_timeout=300, deadline=600)
+results_sink = ResultsSink()
+trapi_reader = TrapiReader()
+request_budget = ConcurrencyBudget()
+live_metrics = LiveMetrics()
+harness_monitor = HarnessMonitor()
+
+
+def resolve_url(request: Dict[str, Any]) -> Optional[str]:
+    """Send a request to its target's configured url, or where it originally went."""
+    target = targets.get(request.get("target"))
+    if target is not None:
+        return target["url"]
+    return request.get("url")
+
+
+async def lookup(url: str, body: bytes) -> Dict[str, Any]:
+    """Replay a single request."""
+    status = None
+    error = None
+    counts = empty_counts()
+    timer = AsyncRequestTimer()
+    budget_wait = None
+    try:
+        async with request_budget.slot(url) as budget_wait:
+            # waiting for the slot is budget_wait, not part of the request's own time
+            timer.start()
+            async with deadline(client_pool.deadline):
+                async with client_pool.client(url) as client:
+                    async with client.stream(
+                        "POST",
+                        url,
+                        content=body,
+                        headers=JSON_HEADERS,
+                        extensions={"trace": timer},
+                    ) as response:
+                        status = response.status_code
+                        response.raise_for_status()
+                        counts = await trapi_reader.read(response, timer)
+    except Exception as e:
+        error = e
+        counts = empty_counts()
+
+    timer.stop()
+    client_pool.record(url, timer.new_connection)
+    error_class = classify(error, status)
+    result = {
+        "status": error_class if status is None else status,
+        "error": error_class,
+        **counts,
+        "response_time": timer.elapsed(),
+        "new_connection": timer.new_connection,
+        "phases": {**timer.phases(), "budget_wait": budget_wait},
+        "completed_at": time.time(),
+    }
+    return result
+
+
+async def run_replay(
+    requests: Iterator[Dict[str, Any]],
+    speed: Optional[float],
+    max_in_flight: Optional[int],
+    late_threshold: float = 0.05,
+) -> Dict[str, Any]:
+    """
+    Replay a trace, keeping its inter-arrival times divided by speed.
+
+    The trace is read one request at a time as each one comes due, so only the
+    requests in flight are ever in memory. Like the open loop runs, latency is
+    measured from when each request was due to go out, so a slow service can't
+    hold the replay back without it showing up. A speed of None replays at max
+    throughput instead, keeping max_in_flight requests going with no pacing.
+    Paced requests over max_in_flight are dropped and counted.
+    """
+    loop = asyncio.get_running_loop()
+    stats: Dict[str, ResultStats] = {}
+    in_flight = set()
+    slots = asyncio.Semaphore(max_in_flight) if speed is None else None
+    scheduled = 0
+    sent = 0
+    dropped = 0
+    skipped = 0
+    late = 0
+    max_send_lag = 0.0
+    first_timestamp = None
+    last_timestamp = None
+
+    async def timed_send(target: str, url: str, body: bytes, scheduled_time: float):
+        send_time = loop.time()
+        try:
+            result = await lookup(url, body)
+        finally:
+            if slots is not None:
+                slots.release()
+        stop_time = loop.time()
+        result["service_time"] = result["response_time"]
+        result["response_time"] = stop_time - scheduled_time
+        result["send_lag"] = send_time - scheduled_time
+        if target not in stats:
+            stats[target] = ResultStats()
+        results_sink.record(stats[target], result, mode="replay", target=target, stage="trace")
+
+    start_time = loop.time()
+    for request in requests:
+        url = resolve_url(request)
+        if url is None or "body" not in request:
+            skipped += 1
+            continue
+        if first_timestamp is None:
+            first_timestamp = request["timestamp"]
+        last_timestamp = request["timestamp"]
+        if speed is None:
+            await slots.acquire()
+            scheduled_time = loop.time()
+        else:
+            scheduled_time = start_time + (request["timestamp"] - first_timestamp) / speed
+            delay = scheduled_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        scheduled += 1
+        if speed is not None and max_in_flight is not None and len(in_flight) >= max_in_flight:
+            dropped += 1
+            continue
+        send_lag = loop.time() - scheduled_time
+        if send_lag > late_threshold:
+            late += 1
+        max_send_lag = max(max_send_lag, send_lag)
+        sent += 1
+        body = encode_payload(request["body"])
+        task = asyncio.create_task(timed_send(request.get("target") or url, url, body, scheduled_time))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    send_window = loop.time() - start_time
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    total_time = loop.time() - start_time
+
+    trace_duration = last_timestamp - first_timestamp if first_timestamp is not None else 0.0
+    return {
+        "targets": {target: target_stats.to_dict(total_time) for target, target_stats in stats.items()},
+        "replay": {
+            "speed": speed,
+            "trace_duration": trace_duration,
+            "send_window": send_window,
+            "total_time": total_time,
+            "scheduled": scheduled,
+            "sent": sent,
+            "dropped": dropped,
+            "skipped": skipped,
+            "late": late,
+            "max_send_lag": max_send_lag,
+            "offered_rate": scheduled * speed / trace_duration if speed and trace_duration else None,
+            "achieved_rate": sent / send_window if send_window > 0 else None,
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=("Translator Traffic Replay"))
+    parser.add_argument("--trace", type=str, help="Comma separated trace files to replay, merged by timestamp", default=DEFAULT_TRACE)
+    parser.add_argument("--speed", type=float, help="Replay this many times faster than the trace was recorded", default=1.0)
+    parser.add_argument("--max_throughput", action="store_true", help="Ignore the trace timing and replay as fast as --max_in_flight allows")
+    parser.add_argument("--max_in_flight", type=int, help="Most replayed requests in flight, later ones are dropped unless at max throughput", default=None)
+    parser.add_argument("--targets", type=str, help="Targets file to send each request's target to, instead of the url it was recorded with", default=None)
+    add_client_pool_arguments(parser)
+    add_trapi_stream_arguments(parser)
+    add_event_loop_arguments(parser)
+    add_host_scheduler_arguments(parser)
+    add_live_metrics_arguments(parser)
+    add_harness_monitor_arguments(parser)
+    add_results_store_arguments(parser)
+    args = parser.parse_args()
+    check_format(args.results_format)
+    if args.max_throughput and not args.max_in_flight:
+        raise SystemExit("--max_throughput needs a --max_in_flight to keep the replay bounded")
+    if args.targets is not None:
+        with open(args.targets, "r") as f:
+            targets.update(json.load(f))
+    client_pool.configure(args)
+    trapi_reader.configure(args)
+    live_metrics.configure(args)
+    harness_monitor.configure(args)
+    request_budget.configure(args)
+
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    output_filename = f"results/replay_{timestamp}.json"
+    results_sink.open(f"results/replay_{timestamp}.jsonl")
+    output["records"] = results_sink.filename
+    output["trace"] = args.trace
+    await live_metrics.start(results_sink, client_pool)
+    harness_monitor.start()
+
+    speed = None if args.max_throughput else args.speed
+    print(f"Replaying {args.trace} {'at max throughput' if speed is None else f'at {speed}x'}")
+    replayed = await run_replay(read_traces(args.trace.split(",")), speed, args.max_in_flight)
+    output["harness"] = harness_monitor.check("the replay", harness_monitor.start_time)
+    await harness_monitor.stop()
+    await live_metrics.stop()
+    await client_pool.aclose()
+    trapi_reader.close()
+    results_sink.close()
+    output["columns"] = write_columns(results_sink.filename, args.results_format)
+    output["replay"] = replayed["targets"]
+    output["rate"] = replayed["replay"]
+    output["connections"] = client_pool.stats()
+    output["decoding"] = {**trapi_reader.settings(), "event_loop": args.event_loop}
+    output["budget"] = request_budget.stats()
+    with open(output_filename, "w") as f:
+        json.dump(output, f, indent = 2)
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,241 @@
+import argparse
+from collections import Counter
+from datetime import datetime
+import html
+import json
+import math
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from request_errors import classify_status
+from results_store import find_columns, read_columns
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+REPORT_PERCENTILES = [50, 95, 99]
+COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b"]
+
+
+def percentiles(values: Sequence[float], points: List[float]) -> List[Optional[float]]:
+    """Get linearly interpolated percentiles, with numpy when it's installed."""
+    if not len(values):
+        return [None for _ in points]
+    if numpy is not None:
+        return [float(value) for value in numpy.percentile(numpy.asarray(values, dtype=float), points)]
+    ordered = sorted(values)
+    result = []
+    for point in points:
+        rank = point / 100 * (len(ordered) - 1)
+        low = math.floor(rank)
+        high = min(low + 1, len(ordered) - 1)
+        result.append(ordered[low] + (ordered[high] - ordered[low]) * (rank - low))
+    return result
+
+
+def error_class(error: Optional[str], status: Any) -> str:
+    """Get a record's error class, which says whether it got its answer since a 200 can still fail in the body."""
+    if error is None:
+        # recorded before requests had error classes
+        return classify_status(status)
+    return error
+
+
+def sort_cells(columns: Dict[str, list]) -> Tuple[List[Tuple[str, str, str]], List[int], Dict[str, Sequence]]:
+    """
+    Sort the rows by target / mode / stage once, so every cell is one contiguous slice.
+
+    Gives back each cell's key, the row each cell starts at (plus the end) and
+    the columns the summaries need in sorted order, as numpy arrays when numpy
+    is installed so each cell's aggregates are whole-column operations.
+    """
+    keys = [
+        (target or "", mode or "", stage or "")
+        for target, mode, stage in zip(columns["target"], columns["mode"], columns["stage"])
+    ]
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    cells: List[Tuple[str, str, str]] = []
+    bounds: List[int] = []
+    for position, row in enumerate(order):
+        if not cells or keys[row] != cells[-1]:
+            cells.append(keys[row])
+            bounds.append(position)
+    bounds.append(len(order))
+    sorted_columns: Dict[str, Sequence] = {
+        "error": [error_class(columns["error"][row], columns["status"][row]) for row in order],
+    }
+    for name in ["response_time", "completed_at", "num_curies"]:
+        values = [columns[name][row] for row in order]
+        if numpy is not None:
+            values = numpy.array([numpy.nan if value is None else value for value in values], dtype=float)
+        sorted_columns[name] = values
+    sorted_columns["success"] = [error == "ok" for error in sorted_columns["error"]]
+    if numpy is not None:
+        sorted_columns["success"] = numpy.array(sorted_columns["success"], dtype=bool)
+    return cells, bounds, sorted_columns
+
+
+def summarize_cell(cell: Dict[str, Sequence]) -> Dict[str, Any]:
+    """Summarize one cell's slice of the sorted columns: throughput, latency percentiles, errors and the concurrency it ran at."""
+    response_times = cell["response_time"]
+    requests = len(response_times)
+    if numpy is not None:
+        start = float(numpy.min(cell["completed_at"] - response_times))
+        end = float(numpy.max(cell["completed_at"]))
+        busy = float(numpy.sum(response_times))
+        successes = int(numpy.count_nonzero(cell["success"]))
+        curies = cell["num_curies"][~numpy.isnan(cell["num_curies"])]
+        total_curies, num_batches = float(numpy.sum(curies)), len(curies)
+    else:
+        start = min(done - elapsed for done, elapsed in zip(cell["completed_at"], response_times))
+        end = max(cell["completed_at"])
+        busy = sum(response_times)
+        successes = sum(cell["success"])
+        curies = [value for value in cell["num_curies"] if value is not None]
+        total_curies, num_batches = sum(curies), len(curies)
+    duration = max(end - start, 1e-9)
+    errors = requests - successes
+    error_classes = dict(Counter(error for error in cell["error"] if error != "ok"))
+    summary = {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": errors / requests,
+        "error_classes": error_classes,
+        "duration": duration,
+        "throughput": requests / duration,
+        # Little's law: average requests in flight is arrival rate times time in the system
+        "concurrency": busy / duration,
+        "batch_size": total_curies / num_batches if num_batches else None,
+        "curies_per_second": total_curies / duration if num_batches else None,
+    }
+    for percentile, value in zip(REPORT_PERCENTILES, percentiles(response_times, REPORT_PERCENTILES)):
+        summary[f"p{percentile}"] = value
+    return summary
+
+
+def summarize(filenames: List[str]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Summarize every cell of the given results, by target and then by mode/stage."""
+    summaries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for filename in filenames:
+        # a run's columnar file holds the same records and is much quicker to read
+        columns = read_columns(find_columns(filename))
+        # the same cell from different runs stays apart, labeled with its run
+        label = f" ({os.path.basename(filename)})" if len(filenames) > 1 else ""
+        cells, bounds, sorted_columns = sort_cells(columns)
+        for (target, mode, stage), start, stop in zip(cells, bounds, bounds[1:]):
+            cell = {name: values[start:stop] for name, values in sorted_columns.items()}
+            summaries.setdefault(target, {})[f"{mode}/{stage}{label}"] = summarize_cell(cell)
+    return summaries
+
+
+def svg_chart(title: str, series: Dict[str, List[Tuple[float, float]]], x_label: str, y_label: str, width: int = 560, height: int = 320) -> str:
+    """Draw a line chart as inline SVG."""
+    points = [point for line in series.values() for point in line]
+    if not points:
+        return ""
+    margin = 50
+    x_min, x_max = min(x for x, _ in points), max(x for x, _ in points)
+    y_max = max(y for _, y in points) or 1
+    x_span = (x_max - x_min) or 1
+
+    def position(x: float, y: float) -> Tuple[float, float]:
+        return (
+            margin + (x - x_min) / x_span * (width - 2 * margin),
+            height - margin - y / y_max * (height - 2 * margin),
+        )
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="11">',
+        f'<text x="{width / 2}" y="16" text-anchor="middle" font-size="13">{html.escape(title)}</text>',
+        f'<line x1="{margin}" y1="{height - margin}" x2="{width - margin}" y2="{height - margin}" stroke="black"/>',
+        f'<line x1="{margin}" y1="{margin}" x2="{margin}" y2="{height - margin}" stroke="black"/>',
+        f'<text x="{width / 2}" y="{height - 10}" text-anchor="middle">{html.escape(x_label)}</text>',
+        f'<text x="12" y="{height / 2}" text-anchor="middle" transform="rotate(-90 12 {height / 2})">{html.escape(y_label)}</text>',
+    ]
+    for tick in range(5):
+        x = x_min + x_span * tick / 4
+        y = y_max * tick / 4
+        px, _ = position(x, 0)
+        _, py = position(x_min, y)
+        parts.append(f'<text x="{px:.1f}" y="{height - margin + 14}" text-anchor="middle">{x:.3g}</text>')
+        parts.append(f'<text x="{margin - 4}" y="{py + 4:.1f}" text-anchor="end">{y:.3g}</text>')
+    for index, (name, line) in enumerate(series.items()):
+        color = COLORS[index % len(COLORS)]
+        coordinates = " ".join("%.1f,%.1f" % position(x, y) for x, y in sorted(line))
+        parts.append(f'<polyline fill="none" stroke="{color}" stroke-width="2" points="{coordinates}"/>')
+        for x, y in line:
+            px, py = position(x, y)
+            parts.append(f'<circle cx="{px:.1f}" cy="{py:.1f}" r="3" fill="{color}"/>')
+        parts.append(f'<text x="{width - margin + 4}" y="{margin + 14 * index}" fill="{color}">{html.escape(name)}</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def target_section(target: str, cells: Dict[str, Dict[str, Any]]) -> str:
+    """Render one target's curves and summary table."""
+    latency_series = {
+        f"p{percentile}": [(cell["concurrency"], cell[f"p{percentile}"]) for cell in cells.values() if cell[f"p{percentile}"] is not None]
+        for percentile in REPORT_PERCENTILES
+    }
+    batched = [cell for cell in cells.values() if cell["batch_size"] is not None]
+    throughput_series = {"requests/s": [(cell["batch_size"], cell["throughput"]) for cell in batched]}
+    curie_series = {"curies/s": [(cell["batch_size"], cell["curies_per_second"]) for cell in batched]}
+    rows = "\n".join(
+        "<tr><td>{}</td><td>{}</td><td>{:.1%}</td><td>{}</td><td>{:.2f}</td><td>{:.1f}</td><td>{}</td>{}</tr>".format(
+            html.escape(key),
+            cell["requests"],
+            cell["error_rate"],
+            html.escape(", ".join(f"{error} {count}" for error, count in sorted(cell["error_classes"].items()))),
+            cell["throughput"],
+            cell["concurrency"],
+            "" if cell["batch_size"] is None else f"{cell['batch_size']:.0f}",
+            "".join(f"<td>{cell[f'p{percentile}']:.3f}</td>" for percentile in REPORT_PERCENTILES),
+        )
+        for key, cell in sorted(cells.items())
+    )
+    return "\n".join([
+        f"<h2>{html.escape(target)}</h2>",
+        svg_chart("Latency vs concurrency", latency_series, "requests in flight (Little's law)", "latency (s)"),
+        svg_chart("Throughput vs batch size", throughput_series, "curies per request", "requests/s") if batched else "",
+        svg_chart("Curie throughput vs batch size", curie_series, "curies per request", "curies/s") if batched else "",
+        "<table><tr><th>mode/stage</th><th>requests</th><th>errors</th><th>error classes</th><th>req/s</th><th>in flight</th><th>batch</th>"
+        + "".join(f"<th>p{percentile} (s)</th>" for percentile in REPORT_PERCENTILES) + "</tr>",
+        rows,
+        "</table>",
+    ])
+
+
+def render_report(summaries: Dict[str, Dict[str, Dict[str, Any]]], sources: List[str]) -> str:
+    return "\n".join([
+        "<!DOCTYPE html>",
+        "<html><head><meta charset=\"utf-8\"><title>Stress Test Report</title>",
+        "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}"
+        "td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}td:first-child{text-align:left}</style>",
+        "</head><body>",
+        "<h1>Stress Test Report</h1>",
+        f"<p>From {', '.join(html.escape(source) for source in sources)}</p>",
+        *[target_section(target, cells) for target, cells in sorted(summaries.items())],
+        "</body></html>",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=("Stress Test Report"))
+    parser.add_argument("records", type=str, nargs="+", help="Per-request records, .jsonl, .parquet or .npz")
+    parser.add_argument("--output", type=str, help="Report file to write, results/report_<timestamp>.html by default", default=None)
+    args = parser.parse_args()
+
+    summaries = summarize(args.records)
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    output_filename = args.output or f"results/report_{timestamp}.html"
+    with open(output_filename, "w") as f:
+        f.write(render_report(summaries, args.records))
+    with open(f"{output_filename.rsplit('.', 1)[0]}.json", "w") as f:
+        json.dump(summaries, f, indent = 2)
+    print(f"Wrote {output_filename}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+from contextlib import asynccontextmanager
+import socket
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+# every failure lands in exactly one of these, "ok" is a request that got its answer
+ERROR_CLASSES = [
+    "ok",
+    # past the total deadline and cancelled
+    "deadline",
+    "connect_timeout",
+    "read_timeout",
+    "write_timeout",
+    # waited too long for a connection from the client's own pool
+    "pool_timeout",
+    "dns",
+    "connect_refused",
+    "connect_error",
+    # the server closed or reset the connection part way through
+    "connection_reset",
+    "protocol_error",
+    "rate_limited",
+    "client_error",
+    "server_error",
+    # the body wasn't valid JSON (or content encoding)
+    "decode_error",
+    # a 200 whose TRAPI message has errors, or an ARS job that ended in Error
+    "trapi_error",
+    "other",
+]
+
+
+def normalize_status(status: Any) -> Any:
+    """Turn an HTTP status read back as a string (a JSON key or a string column) into its int code."""
+    if isinstance(status, str) and status.isdigit():
+        return int(status)
+    return status
+
+
+def normalize_statuses(statuses: Dict[Any, int]) -> Dict[Any, int]:
+    """Normalize the keys of a status count map, adding up any that turn out to be the same status."""
+    normalized: Dict[Any, int] = {}
+    for status, count in statuses.items():
+        status = normalize_status(status)
+        normalized[status] = normalized.get(status, 0) + count
+    return normalized
+
+
+class DeadlineExceeded(Exception):
+    """A request ran past its total deadline and was cancelled."""
+
+
+class TrapiError(Exception):
+    """A successful response whose TRAPI message reports errors."""
+
+
+def caused_by(error: BaseException, kind: type) -> bool:
+    """Check whether kind is anywhere in an exception's chain of causes."""
+    while error is not None:
+        if isinstance(error, kind):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def classify_status(status: Any) -> str:
+    """Get the error class of an HTTP status, or an ARS job status."""
+    if status == "Error":
+        return "trapi_error"
+    if status == "timeout":
+        # the ARS poller gave up on the job
+        return "deadline"
+    if not isinstance(status, int):
+        return "ok" if status == "Done" else "other"
+    if status == 429:
+        return "rate_limited"
+    if 400 <= status < 500:
+        return "client_error"
+    if status >= 500:
+        return "server_error"
+    return "ok"
+
+
+def classify(error: Optional[BaseException], status: Any = None) -> str:
+    """Sort a finished request into one of ERROR_CLASSES, from the exception it raised (if any) and its status."""
+    if error is None:
+        return classify_status(status)
+    if isinstance(error, httpx.HTTPStatusError):
+        # the failed response's own code, status can be an ARS job's whose merged message fetch failed
+        return classify_status(error.response.status_code)
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    if isinstance(error, TrapiError):
+        return "trapi_error"
+    if isinstance(error, httpx.ConnectTimeout):
+        return "connect_timeout"
+    if isinstance(error, httpx.ReadTimeout):
+        return "read_timeout"
+    if isinstance(error, httpx.WriteTimeout):
+        return "write_timeout"
+    if isinstance(error, httpx.PoolTimeout):
+        return "pool_timeout"
+    if isinstance(error, httpx.ConnectError):
+        if caused_by(error, socket.gaierror) or "Name or service not known" in str(error):
+            return "dns"
+        if caused_by(error, ConnectionRefusedError) or "refused" in str(error).lower():
+            return "connect_refused"
+        return "connect_error"
+    if isinstance(error, (httpx.ReadError, httpx.WriteError, httpx.RemoteProtocolError)):
+        return "connection_reset"
+    if isinstance(error, httpx.ProtocolError):
+        return "protocol_error"
+    if isinstance(error, (httpx.DecodingError, ValueError)):
+        return "decode_error"
+    return "other"
+
+
+@asynccontextmanager
+async def deadline(seconds: Optional[float]):
+    """
+    Cancel whatever runs inside once it has taken seconds, raising DeadlineExceeded.
+
+    Cancelling unwinds the request's own context managers, so its connection
+    goes back to (or is dropped from) the pool and its concurrency slot is freed
+    right away instead of when the server finally answers. A deadline of None
+    never expires.
+    """
+    if seconds is None:
+        yield
+        return
+    task = asyncio.current_task()
+    expired = False
+
+    def expire():
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    handle = asyncio.get_running_loop().call_later(seconds, expire)
+    try:
+        yield
+    except asyncio.CancelledError:
+        if expired:
+            # the cancel was ours, so it shouldn't count against anything else cancelling the task
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            raise DeadlineExceeded(f"Past the {seconds}s deadline")
+        raise
+    finally:
+        handle.cancel()
+
+
+class SyncDeadline:
+    """
+    The deadline for a synchronous request.
+
+    Nothing can cancel a blocking request part way through, so instead each of
+    its waits is capped at what is left of the deadline and check() is called
+    between reads, raising DeadlineExceeded once the deadline has passed. A
+    deadline of None never expires.
+    """
+
+    def __init__(self, seconds: Optional[float]):
+        self.seconds = seconds
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def check(self):
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(f"Past the {self.seconds}s deadline")
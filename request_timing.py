@@ -0,0 +1,94 @@
+import time
+from typing import Any, Dict, Optional
+
+PHASES = ["pool_wait", "dns", "connect", "tls", "send", "server_wait", "ttfb", "download", "decode", "decode_wait", "total"]
+
+
+class RequestTimer:
+    """
+    httpx trace extension that times each phase of a request on a monotonic clock.
+
+    Pass it as extensions={"trace": timer} and call stop() once the response has been
+    read. httpcore resolves the host inside its TCP connect without a trace event of
+    its own, so dns is always None and connect, the TCP connect of a new connection,
+    includes the lookup. tls is the handshake, send writing the request, server_wait
+    the gap until the response headers arrive, ttfb the time from the start until the
+    response headers arrive, download reading the body and decode the time spent
+    parsing it, which is tracked by whoever parses the body and taken out of download
+    when it happened mid-stream.
+    decode_wait is how long a body handed off to a decode pool waited for a worker.
+    pool_wait covers everything before the first network event, like waiting for a
+    free connection from the pool.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stop_time = None
+        self.events: Dict[str, float] = {}
+        self.new_connection = False
+        self.decode_time = 0.0
+        # parsing done while the body was still streaming in, which download shouldn't count
+        self.streamed_decode_time = 0.0
+        self.decode_wait: Optional[float] = None
+
+    def start(self):
+        """Start the clock over, for a request that waited for its turn after the timer was made."""
+        self.start_time = time.perf_counter()
+
+    def record_event(self, event_name: str):
+        # http11.send_request_headers.started and http2.send_request_headers.started are the same phase
+        _, _, name = event_name.partition(".")
+        if name not in self.events:
+            self.events[name] = time.perf_counter()
+
+    def __call__(self, event_name: str, info: Dict[str, Any]):
+        self.record_event(event_name)
+        if event_name == "connection.connect_tcp.started":
+            self.new_connection = True
+
+    def stop(self):
+        self.stop_time = time.perf_counter()
+
+    def elapsed(self) -> float:
+        stop_time = self.stop_time if self.stop_time is not None else time.perf_counter()
+        return stop_time - self.start_time
+
+    def between(self, start: str, stop: str) -> Optional[float]:
+        if start not in self.events or stop not in self.events:
+            return None
+        return self.events[stop] - self.events[start]
+
+    def phases(self) -> Dict[str, Optional[float]]:
+        """Get the duration of every phase that happened, in seconds."""
+        first_event = min(self.events.values()) if self.events else None
+        body_start = self.events.get("receive_response_body.started")
+        body_stop = self.events.get("receive_response_body.complete", self.stop_time)
+        download = None
+        if body_start is not None and body_stop is not None:
+            download = max(body_stop - body_start - self.streamed_decode_time, 0)
+        headers_done = self.events.get("receive_response_headers.complete")
+        send_start = "send_request_headers.started"
+        send_stop = "send_request_body.complete" if "send_request_body.complete" in self.events else "send_request_headers.complete"
+        return {
+            "pool_wait": first_event - self.start_time if first_event is not None else None,
+            # not measurable without a lookup of our own on the request's critical path
+            "dns": None,
+            "connect": self.between("connect_tcp.started", "connect_tcp.complete"),
+            "tls": self.between("start_tls.started", "start_tls.complete"),
+            "send": self.between(send_start, send_stop),
+            "server_wait": self.between(send_stop, "receive_response_headers.complete"),
+            "ttfb": headers_done - self.start_time if headers_done is not None else None,
+            "download": download,
+            "decode": self.decode_time if body_start is not None or self.decode_time else None,
+            "decode_wait": self.decode_wait,
+            "total": self.elapsed(),
+        }
+
+
+class AsyncRequestTimer(RequestTimer):
+    """Async flavor of RequestTimer, httpcore awaits the callback for async clients."""
+
+    async def __call__(self, event_name: str, info: Dict[str, Any]):
+        self.record_event(event_name)
+        if event_name == "connection.connect_tcp.started":
+            self.new_connection = True
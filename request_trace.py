@@ -0,0 +1,82 @@
+import argparse
+import heapq
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from payload_cache import encode_payload
+
+DEFAULT_TRACE = "traces/requests.jsonl"
+
+
+class TraceWriter:
+    """
+    Append-only JSON Lines trace of the requests sent to the services.
+
+    Each line is one request: when it went out (epoch seconds), the name of the
+    target it went to, its url and its JSON body, the format replay.py reads
+    back. Bodies that are already encoded are written as is. Lines are buffered
+    and written out every flush_every requests, and a writer that was never
+    opened does nothing, so capturing costs nothing unless it's asked for.
+    """
+
+    def __init__(self, flush_every: int = 100):
+        self.flush_every = flush_every
+        self.filename = None
+        self.file = None
+        self.names: Dict[str, str] = {}
+        self.buffer = []
+        self.num_requests = 0
+
+    def open(self, filename: str, names: Optional[Dict[str, str]] = None):
+        """Start capturing to filename, naming requests by url with names."""
+        self.filename = filename
+        self.file = open(filename, "ab")
+        self.names = names or {}
+
+    def write(self, url: str, body: Union[bytes, Any], target: Optional[str] = None):
+        if self.file is None:
+            return
+        if not isinstance(body, bytes):
+            body = encode_payload(body)
+        self.buffer.append(b'{"timestamp":%s,"target":%s,"url":%s,"body":%s}' % (
+            repr(time.time()).encode(),
+            json.dumps(target or self.names.get(url)).encode(),
+            json.dumps(url).encode(),
+            body,
+        ))
+        self.num_requests += 1
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer and self.file is not None:
+            self.file.write(b"\n".join(self.buffer) + b"\n")
+            self.file.flush()
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_trace(filename: str) -> Iterator[Dict[str, Any]]:
+    """Read a trace one request at a time, so it never has to fit in memory."""
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_traces(filenames: List[str]) -> Iterator[Dict[str, Any]]:
+    """Read several traces, like one per worker, interleaved by timestamp."""
+    if len(filenames) == 1:
+        return read_trace(filenames[0])
+    return heapq.merge(*[read_trace(filename) for filename in filenames], key=lambda request: request["timestamp"])
+
+
+def add_trace_arguments(parser: argparse.ArgumentParser):
+    """Add the trace capture command line arguments."""
+    parser.add_argument("--capture_trace", type=str, help="Write every request sent to this trace file, for replay.py", default=None)
@@ -0,0 +1,140 @@
+import time
+from typing import Any, Dict, Optional
+
+from latency_histogram import LatencyHistogram, WindowedHistogram
+from request_errors import classify_status, normalize_status, normalize_statuses
+from request_timing import PHASES
+
+WINDOW_SECONDS = 10.0
+
+
+def shift_windows(windowed: WindowedHistogram, offset: float) -> WindowedHistogram:
+    """Move windowed latencies later by offset seconds, rounded to whole windows."""
+    shifted = WindowedHistogram(windowed.window, windowed.precision_bits)
+    windows = round(offset / windowed.window)
+    shifted.windows = {index + windows: histogram for index, histogram in windowed.windows.items()}
+    return shifted
+
+
+def count_failures(stage: Dict[str, Any]) -> int:
+    """Count the requests of a written out stage whose error class isn't ok."""
+    errors = stage.get("errors")
+    if errors is None:
+        # written before requests had error classes, so only the statuses can say
+        return sum(count for status, count in stage["statuses"].items() if classify_status(normalize_status(status)) != "ok")
+    return stage["num_requests"] - errors.get("ok", 0)
+
+
+class ResultStats:
+    """Stage stats aggregated one result at a time, without holding on to the results."""
+
+    def __init__(self, start_time: Optional[float] = None, window: float = WINDOW_SECONDS):
+        self.start_time = time.time() if start_time is None else start_time
+        self.num_requests = 0
+        self.total_results = 0
+        self.response_bytes = 0
+        self.statuses = {}
+        # requests per error class, see request_errors.ERROR_CLASSES
+        self.errors = {}
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.latency = LatencyHistogram()
+        self.latency_windows = WindowedHistogram(window)
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+
+    def add(self, result: Dict[str, Any]):
+        self.num_requests += 1
+        self.total_results += result["num_results"]
+        self.response_bytes += result.get("response_bytes", 0)
+        if result["status"] not in self.statuses:
+            self.statuses[result["status"]] = 1
+        else:
+            self.statuses[result["status"]] += 1
+        error = result.get("error", "ok")
+        self.errors[error] = self.errors.get(error, 0) + 1
+        if result.get("new_connection"):
+            self.new_connections += 1
+        else:
+            self.reused_connections += 1
+        self.latency.record(result["response_time"])
+        completed_at = result.get("completed_at", time.time())
+        self.latency_windows.record(completed_at - self.start_time, result["response_time"])
+        for phase, seconds in (result.get("phases") or {}).items():
+            if seconds is not None:
+                if phase not in self.phases:
+                    self.phases[phase] = LatencyHistogram()
+                self.phases[phase].record(seconds)
+
+    def merge(self, other: "ResultStats"):
+        """Fold another stage's stats into these ones."""
+        start_time = min(self.start_time, other.start_time)
+        # windows are relative to each stats' own start, so line them up on the earliest one
+        self.latency_windows = shift_windows(self.latency_windows, self.start_time - start_time)
+        self.latency_windows.merge(shift_windows(other.latency_windows, other.start_time - start_time))
+        self.start_time = start_time
+        self.num_requests += other.num_requests
+        self.total_results += other.total_results
+        self.response_bytes += other.response_bytes
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for error, count in other.errors.items():
+            self.errors[error] = self.errors.get(error, 0) + count
+        self.new_connections += other.new_connections
+        self.reused_connections += other.reused_connections
+        self.latency.merge(other.latency)
+        for phase, histogram in other.phases.items():
+            if phase not in self.phases:
+                self.phases[phase] = LatencyHistogram()
+            self.phases[phase].merge(histogram)
+
+    def to_state(self) -> Dict[str, Any]:
+        """Serialize everything needed to merge these stats somewhere else."""
+        return {
+            "start_time": self.start_time,
+            "num_requests": self.num_requests,
+            "total_results": self.total_results,
+            "response_bytes": self.response_bytes,
+            "statuses": self.statuses,
+            "errors": self.errors,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "latency": self.latency.to_dict(),
+            "latency_windows": self.latency_windows.to_dict(),
+            "phases": {phase: histogram.to_dict() for phase, histogram in self.phases.items()},
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "ResultStats":
+        stats = cls(state["start_time"])
+        stats.num_requests = state["num_requests"]
+        stats.total_results = state["total_results"]
+        stats.response_bytes = state["response_bytes"]
+        # the state went through JSON, which turned the HTTP status keys into strings
+        stats.statuses = normalize_statuses(state["statuses"])
+        stats.errors = state.get("errors", {})
+        stats.new_connections = state["new_connections"]
+        stats.reused_connections = state["reused_connections"]
+        stats.latency = LatencyHistogram.from_dict(state["latency"])
+        stats.latency_windows = WindowedHistogram.from_dict(state["latency_windows"])
+        for phase, histogram in state["phases"].items():
+            stats.phases[phase] = LatencyHistogram.from_dict(histogram)
+        return stats
+
+    def to_dict(self, total_time: float) -> Dict[str, Any]:
+        return {
+            "total_time": total_time,
+            "num_requests": self.num_requests,
+            "total_results": self.total_results,
+            "response_bytes": self.response_bytes,
+            "statuses": self.statuses,
+            "errors": self.errors,
+            "error_rate": 1 - self.errors.get("ok", 0) / self.num_requests if self.num_requests else None,
+            "throughput": self.num_requests / total_time if total_time else None,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "latency": self.latency.summary(),
+            "latency_windows": self.latency_windows.series(),
+            "latency_histogram": self.latency.to_dict(),
+            "phases": {phase: histogram.summary() for phase, histogram in self.phases.items() if histogram.count},
+        }
+
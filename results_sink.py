@@ -0,0 +1,71 @@
+import json
+import time
+from typing import Any, Dict, Optional
+
+from result_stats import ResultStats
+
+
+class ResultsSink:
+    """
+    Append-only JSON Lines file with one compact record per request.
+
+    Records are buffered and written out every flush_every records or
+    flush_interval seconds, whichever comes first, so nothing about a run
+    has to stay in memory and a crashed run still leaves its results behind.
+    """
+
+    def __init__(self, flush_every: int = 1000, flush_interval: float = 5.0):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.filename = None
+        self.file = None
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.num_records = 0
+        # set by LiveMetrics.start to see every result as it's recorded
+        self.metrics = None
+
+    def open(self, filename: str):
+        self.filename = filename
+        self.file = open(filename, "a")
+
+    def open_stream(self, stream: Any, name: str):
+        """Write records to any object with write, flush and close, like a worker's link to its coordinator."""
+        self.filename = name
+        self.file = stream
+
+    def write(self, record: Dict[str, Any]):
+        self.buffer.append(json.dumps(record, separators=(",", ":")))
+        self.num_records += 1
+        if (
+            len(self.buffer) >= self.flush_every or
+            time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def write_lines(self, text: str):
+        """Append record lines that were already encoded somewhere else, like on a worker."""
+        self.flush()
+        self.file.write(text)
+        self.num_records += text.count("\n")
+
+    def record(self, stats: Optional[ResultStats], result: Dict[str, Any], **context: Any):
+        """Add a lookup result to its stage stats and write it out with its run context."""
+        if stats is not None:
+            stats.add(result)
+        if self.metrics is not None:
+            self.metrics.record(context.get("target"), result)
+        self.write({**context, **result})
+
+    def flush(self):
+        if self.buffer and self.file is not None:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
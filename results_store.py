@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from request_errors import normalize_status
+from request_timing import PHASES
+
+# phases that only some runners time, on top of the http ones
+# the ARS merged message fetch's own phases, as merged_<phase>
+MERGED_PHASES = ["pool_wait", "connect", "server_wait", "download", "decode"]
+EXTRA_PHASES = (
+    ["budget_wait", "submit", "time_to_done", "done_uncertainty", "merged_fetch", "compress", "decompress"]
+    + [f"merged_{phase}" for phase in MERGED_PHASES]
+)
+
+# one row per request, the same for every runner; missing values are null
+SCHEMA: List[Tuple[str, str]] = [
+    ("mode", "string"),
+    ("target", "string"),
+    ("stage", "string"),
+    ("status", "string"),
+    ("error", "string"),
+    ("response_time", "float64"),
+    ("service_time", "float64"),
+    ("send_lag", "float64"),
+    ("completed_at", "float64"),
+    ("num_curies", "int64"),
+    ("num_results", "int64"),
+    ("num_nodes", "int64"),
+    ("num_edges", "int64"),
+    ("response_bytes", "int64"),
+    ("request_bytes", "int64"),
+    ("wire_bytes", "int64"),
+    ("response_encoding", "string"),
+    ("new_connection", "bool"),
+    ("polls", "int64"),
+    ("query_shape", "string"),
+] + [(f"phase_{phase}", "float64") for phase in PHASES + EXTRA_PHASES]
+
+FORMATS = ["jsonl", "parquet", "npz"]
+BATCH_SIZE = 50000
+
+
+def flatten_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Fit a results sink record to the shared schema."""
+    row = {}
+    for name, kind in SCHEMA:
+        if name.startswith("phase_"):
+            value = (record.get("phases") or {}).get(name[len("phase_"):])
+        else:
+            value = record.get(name)
+        # stage keys are ints in some runners and strings in others, statuses are codes or ARS states
+        if kind == "string" and value is not None:
+            value = str(value)
+        row[name] = value
+    # the response time before it was measured from the scheduled send, when it was
+    if row["service_time"] is None:
+        row["service_time"] = row["response_time"]
+    return row
+
+
+def read_records(filename: str) -> Iterator[Dict[str, Any]]:
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                yield flatten_record(json.loads(line))
+
+
+def check_format(results_format: str):
+    """Fail early if the packages a results format needs aren't installed."""
+    try:
+        if results_format == "parquet":
+            import pyarrow  # noqa: F401
+        elif results_format == "npz":
+            import numpy  # noqa: F401
+    except ImportError as e:
+        raise SystemExit(f"--results_format {results_format} requires {e.name}: pip install {e.name}")
+
+
+def has_format(results_format: str) -> bool:
+    """Check whether the packages a results format needs are installed."""
+    try:
+        check_format(results_format)
+    except SystemExit:
+        return False
+    return True
+
+
+class ColumnWriter:
+    """
+    Writes rows to a columnar file, a batch at a time.
+
+    Parquet is written one row group per batch, so it streams. npz is a set of
+    numpy arrays, one per column, so the columns are collected until close.
+    """
+
+    def __init__(self, filename: str, results_format: str):
+        self.filename = filename
+        self.format = results_format
+        self.writer = None
+        self.columns: Dict[str, list] = {name: [] for name, _ in SCHEMA}
+        if self.format == "parquet":
+            import pyarrow
+            import pyarrow.parquet
+            types = {"string": pyarrow.string(), "float64": pyarrow.float64(), "int64": pyarrow.int64(), "bool": pyarrow.bool_()}
+            self.schema = pyarrow.schema([(name, types[kind]) for name, kind in SCHEMA])
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression="zstd")
+
+    def write_batch(self, rows: List[Dict[str, Any]]):
+        if self.format == "parquet":
+            import pyarrow
+            self.writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+            return
+        for name in self.columns:
+            self.columns[name].extend(row[name] for row in rows)
+
+    def close(self):
+        if self.format == "parquet":
+            self.writer.close()
+            return
+        import numpy
+        arrays = {}
+        for name, kind in SCHEMA:
+            values = self.columns[name]
+            if kind == "string":
+                arrays[name] = numpy.array(["" if value is None else value for value in values], dtype=str)
+            elif kind == "bool":
+                arrays[name] = numpy.array([bool(value) for value in values], dtype=bool)
+            else:
+                # nan stands in for missing values, ints included
+                arrays[name] = numpy.array([numpy.nan if value is None else value for value in values], dtype=float)
+        numpy.savez_compressed(self.filename, **arrays)
+
+
+def write_columns(jsonl_filename: str, results_format: str) -> Optional[str]:
+    """Convert a results sink's records to a columnar file next to it, returning its name."""
+    if results_format == "jsonl" or jsonl_filename is None:
+        return None
+    filename = f"{os.path.splitext(jsonl_filename)[0]}.{results_format}"
+    writer = ColumnWriter(filename, results_format)
+    batch = []
+    for row in read_records(jsonl_filename):
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            writer.write_batch(batch)
+            batch = []
+    if batch:
+        writer.write_batch(batch)
+    writer.close()
+    return filename
+
+
+def find_columns(filename: str) -> str:
+    """Get the columnar file a run wrote next to its .jsonl records, if there is one that can be read, else the records."""
+    if not filename.endswith(".jsonl"):
+        return filename
+    for results_format in ["parquet", "npz"]:
+        columnar = f"{os.path.splitext(filename)[0]}.{results_format}"
+        if os.path.exists(columnar) and has_format(results_format):
+            return columnar
+    return filename
+
+
+def read_columns(filename: str) -> Dict[str, list]:
+    """Read the shared schema columns back from any results format, with HTTP statuses as ints again."""
+    if filename.endswith(".parquet"):
+        check_format("parquet")
+        import pyarrow.parquet
+        columns = pyarrow.parquet.read_table(filename).to_pydict()
+    elif filename.endswith(".npz"):
+        check_format("npz")
+        import numpy
+        columns = {}
+        with numpy.load(filename) as arrays:
+            for name, kind in SCHEMA:
+                values = arrays[name].tolist()
+                if kind == "string":
+                    columns[name] = [value or None for value in values]
+                elif kind == "bool":
+                    columns[name] = values
+                elif kind == "int64":
+                    columns[name] = [None if value != value else int(value) for value in values]
+                else:
+                    columns[name] = [None if value != value else value for value in values]
+    else:
+        columns = {name: [] for name, _ in SCHEMA}
+        for row in read_records(filename):
+            for name in columns:
+                columns[name].append(row[name])
+    # the status column is strings, to hold ARS states next to HTTP codes
+    columns["status"] = [normalize_status(status) for status in columns["status"]]
+    return columns
+
+
+def add_results_store_arguments(parser: argparse.ArgumentParser):
+    """Add the results format command line arguments."""
+    parser.add_argument("--results_format", type=str, choices=FORMATS, help="Also write the per-request records as Parquet (needs pyarrow) or npz (needs numpy)", default="jsonl")
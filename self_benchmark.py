@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import copy
+from datetime import datetime
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from generate_message import generate_kp_message
+from harness_monitor import LoopLagMonitor, get_rss
+import kp_stress_tests
+from payload_cache import PayloadCache
+from result_stats import ResultStats
+from results_sink import ResultsSink
+from trapi_stream import TrapiCounter
+
+BENCHMARK_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock", "benchmark.json")
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py")
+QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock", "kp_queries.json")
+# a level only counts towards the max sustainable rate if it got every request through
+SUSTAINABLE_ERROR_RATE = 0.0
+# seconds between RSS readings during a level, reading /proc per request would show up in its CPU
+RSS_SAMPLE_INTERVAL = 0.1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cpu_per_call(function: Callable[[], Any], iterations: int) -> float:
+    """Get the CPU seconds one call of function takes on average."""
+    start_time = time.process_time()
+    for _ in range(iterations):
+        function()
+    return (time.process_time() - start_time) / iterations
+
+
+def run_micro_benchmarks(kp: dict, iterations: int) -> Dict[str, float]:
+    """Time the per-request CPU work the lookup paths do besides the network."""
+    query = kp["query"]
+    curies = query["message"]["query_graph"]["nodes"]["n00"]["ids"]
+    message = kp_stress_tests.generate_message(copy.deepcopy(query), 1000)
+    response = b'{"message":%s}' % json.dumps({
+        "knowledge_graph": {"nodes": {f"N:{ndx}": {} for ndx in range(11)}, "edges": {f"e{ndx}": {} for ndx in range(10)}},
+        "results": [{"node_bindings": {}, "analyses": []} for _ in range(10)],
+    }).encode()
+    result = {
+        "status": 200,
+        "num_results": 10,
+        "num_nodes": 11,
+        "num_edges": 10,
+        "response_bytes": len(response),
+        "response_time": 0.01,
+        "new_connection": False,
+        "phases": {"pool_wait": 0.0001, "send": 0.0001, "server_wait": 0.008, "download": 0.001, "decode": 0.0001, "total": 0.01},
+        "completed_at": time.time(),
+    }
+
+    def parse_response():
+        counter = TrapiCounter()
+        counter.feed(response)
+        counter.close()
+
+    payload_cache = PayloadCache()
+    stats = ResultStats()
+    with tempfile.TemporaryDirectory() as directory:
+        sink = ResultsSink()
+        sink.open(os.path.join(directory, "records.jsonl"))
+        timings = {
+            "deepcopy_query": cpu_per_call(lambda: copy.deepcopy(query), iterations),
+            "generate_message": cpu_per_call(lambda: kp_stress_tests.generate_message(copy.deepcopy(query), 1000), iterations),
+            "generate_kp_message": cpu_per_call(lambda: generate_kp_message(curies, kp), iterations),
+            "json_encode_query": cpu_per_call(lambda: json.dumps(message).encode(), iterations),
+            "cached_payload": cpu_per_call(lambda: payload_cache.get(("kp_query", kp["url"], 1000), lambda: message), iterations),
+            "parse_response": cpu_per_call(parse_response, iterations),
+            "aggregate_result": cpu_per_call(lambda: stats.add(result), iterations),
+            "record_result": cpu_per_call(lambda: sink.record(None, result, mode="benchmark", target="mock", stage="micro"), iterations),
+        }
+        sink.close()
+    return timings
+
+
+async def run_level(kp: dict, concurrency: int, duration: float, num_curies: int) -> Dict[str, Any]:
+    """Keep concurrency lookups in flight against the mock server for duration seconds."""
+    loop = asyncio.get_running_loop()
+    monitor = LoopLagMonitor()
+    stats = ResultStats()
+    errors = 0
+    max_rss = get_rss()
+    end_time = loop.time() + duration
+
+    async def worker():
+        nonlocal errors
+        while loop.time() < end_time:
+            result = await kp_stress_tests.lookup(kp, num_curies)
+            stats.add(result)
+            if result["status"] != 200:
+                errors += 1
+
+    async def sample_rss():
+        nonlocal max_rss
+        while True:
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+            max_rss = max(max_rss, get_rss())
+
+    monitor.start()
+    rss_task = asyncio.create_task(sample_rss())
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cpu_time = time.process_time() - start_cpu
+    total_time = time.perf_counter() - start_time
+    rss_task.cancel()
+    try:
+        await rss_task
+    except asyncio.CancelledError:
+        pass
+    max_rss = max(max_rss, get_rss())
+    loop_lag = await monitor.stop()
+    return {
+        "concurrency": concurrency,
+        "requests": stats.num_requests,
+        "errors": errors,
+        "requests_per_second": stats.num_requests / total_time,
+        "cpu_per_request": cpu_time / stats.num_requests if stats.num_requests else None,
+        "cpu_utilization": cpu_time / total_time,
+        "latency": stats.latency.summary(),
+        "loop_lag": loop_lag,
+        "max_rss": max_rss,
+    }
+
+
+def compare_to_baseline(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """List everything that got more than tolerance worse than the baseline."""
+    regressions = []
+    for name, seconds in baseline["micro"].items():
+        current = report["micro"].get(name)
+        if current is not None and current > seconds * (1 + tolerance):
+            regressions.append(f"{name} takes {current * 1e6:.1f}us per call, baseline {seconds * 1e6:.1f}us")
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        baseline_level = baseline_levels.get(level["concurrency"])
+        if baseline_level is None:
+            continue
+        if level["requests_per_second"] < baseline_level["requests_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{level['concurrency']} concurrent does {level['requests_per_second']:.0f} req/s, "
+                f"baseline {baseline_level['requests_per_second']:.0f} req/s"
+            )
+        if (
+            level["cpu_per_request"] is not None and baseline_level["cpu_per_request"] is not None and
+            level["cpu_per_request"] > baseline_level["cpu_per_request"] * (1 + tolerance)
+        ):
+            regressions.append(
+                f"{level['concurrency']} concurrent uses {level['cpu_per_request'] * 1e3:.2f}ms CPU per request, "
+                f"baseline {baseline_level['cpu_per_request'] * 1e3:.2f}ms"
+            )
+    if report["max_sustainable_rate"] < baseline["max_sustainable_rate"] * (1 - tolerance):
+        regressions.append(
+            f"max sustainable rate is {report['max_sustainable_rate']:.0f} req/s, "
+            f"baseline {baseline['max_sustainable_rate']:.0f} req/s"
+        )
+    return regressions
+
+
+async def start_mock_server(port: int, config: str) -> asyncio.subprocess.Process:
+    """Start the mock server in its own process so its CPU isn't counted against the harness."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, MOCK_SERVER, "--port", str(port), "--config", config,
+        stdout=asyncio.subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return process
+        except OSError:
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock server didn't come up")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=("Stress Tester Self Benchmark"))
+    parser.add_argument("--concurrency", type=str, help="Comma separated concurrency levels", default="1,10,50,100,200")
+    parser.add_argument("--duration", type=float, help="Seconds to run each concurrency level for", default=10)
+    parser.add_argument("--num_curies", type=int, help="Curies per query", default=100)
+    parser.add_argument("--iterations", type=int, help="Calls per micro benchmark", default=1000)
+    parser.add_argument("--config", type=str, help="Mock server config", default=BENCHMARK_CONFIG)
+    parser.add_argument("--baseline", type=str, help="Baseline file to check for regressions against", default="benchmarks/baseline.json")
+    parser.add_argument("--save_baseline", action="store_true", help="Save this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, help="Fraction worse than the baseline that counts as a regression", default=0.2)
+    args = parser.parse_args()
+
+    with open(QUERIES, "r") as f:
+        kp = dict(next(iter(json.load(f).values())))
+    port = free_port()
+    kp["url"] = f"http://127.0.0.1:{port}/benchmark/query"
+
+    print("Running micro benchmarks")
+    report = {
+        "python": sys.version.split()[0],
+        "micro": run_micro_benchmarks(kp, args.iterations),
+        "levels": [],
+    }
+    server = await start_mock_server(port, args.config)
+    try:
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            print(f"Running {concurrency} concurrent lookups for {args.duration}s")
+            report["levels"].append(await run_level(kp, concurrency, args.duration, args.num_curies))
+    finally:
+        await kp_stress_tests.client_pool.aclose()
+        server.kill()
+        await server.wait()
+    sustainable = [
+        level["requests_per_second"] for level in report["levels"]
+        if level["errors"] <= SUSTAINABLE_ERROR_RATE * level["requests"]
+    ]
+    report["max_sustainable_rate"] = max(sustainable, default=0)
+
+    for name, seconds in report["micro"].items():
+        print(f"{name}: {seconds * 1e6:.1f}us CPU per call")
+    for level in report["levels"]:
+        print(
+            f"{level['concurrency']} concurrent: {level['requests_per_second']:.0f} req/s, "
+            f"{(level['cpu_per_request'] or 0) * 1e3:.2f}ms CPU per request, "
+            f"p99 loop lag {(level['loop_lag']['p99'] or 0) * 1e3:.1f}ms, "
+            f"{level['max_rss'] / 1e6:.0f}MB RSS, {level['errors']} errors"
+        )
+    print(f"Max sustainable rate: {report['max_sustainable_rate']:.0f} req/s")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"Regression: {regression}")
+
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    with open(f"results/self_benchmark_{timestamp}.json", "w") as f:
+        json.dump(report, f, indent = 2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent = 2)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import codecs
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import httpx
+import json
+import json.decoder
+import json.scanner
+import re
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from request_errors import SyncDeadline, TrapiError
+from request_timing import RequestTimer
+
+RESULTS_PATH = ("message", "results")
+KNOWLEDGE_GRAPH_PATH = ("message", "knowledge_graph")
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+VALUE_END = set(",]} \t\n\r")
+
+DECODE_IN = ["loop", "thread", "process"]
+JSON_LIBRARIES = ["json", "orjson"]
+# bodies handed off whole are still counted a slice at a time, to bound the decoded buffer
+CHUNK_SIZE = 1 << 20
+
+
+class TrapiCounter:
+    """
+    Incremental JSON scanner that counts TRAPI results, nodes and edges.
+
+    Feed it the response body chunk by chunk. Only the containers on the way down
+    to the results array and the knowledge graph maps are walked token by token,
+    everything below them is handed to the C JSON scanner one value at a time and
+    thrown away, so memory is bounded by the biggest single result, node or edge
+    rather than by the size of the body. Results are counted as the values in the
+    results array, nodes and edges as the keys of the knowledge graph maps, and
+    the values of the message's errors array (the results' sibling) as errors.
+    """
+
+    def __init__(
+        self,
+        results_path: Tuple[str, ...] = RESULTS_PATH,
+        knowledge_graph_path: Tuple[str, ...] = KNOWLEDGE_GRAPH_PATH,
+    ):
+        self.item_targets = {results_path: "num_results"}
+        self.errors_path = results_path[:-1] + ("errors",)
+        self.key_targets = {
+            knowledge_graph_path + ("nodes",): "num_nodes",
+            knowledge_graph_path + ("edges",): "num_edges",
+        }
+        self.prefixes = set()
+        for path in list(self.item_targets) + list(self.key_targets) + [self.errors_path]:
+            for ndx in range(len(path) + 1):
+                self.prefixes.add(path[:ndx])
+        # walk one level below the deepest counted container so results get their own frame
+        self.max_depth = max(len(path) for path in self.prefixes) + 1
+        self.counts = empty_counts()
+        # kept out of counts, which go into every result
+        self.errors = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.scan_once = json.scanner.make_scanner(json.JSONDecoder())
+        self.buffer = ""
+        # don't retry a value that didn't fit in the buffer until the buffer has doubled
+        self.retry_at = 0
+        # each frame is [opening bracket, path or None when nothing below it is counted, expecting a key, last key]
+        self.stack = []
+
+    def child_path(self) -> Optional[Tuple[str, ...]]:
+        if not self.stack:
+            return ()
+        kind, path, _, key = self.stack[-1]
+        if path is None or kind == "[":
+            return None
+        child = path + (key,)
+        return child if child in self.prefixes else None
+
+    def count_value(self):
+        if self.stack:
+            kind, path, _, _ = self.stack[-1]
+            if kind == "[" and path == self.errors_path:
+                self.errors += 1
+            elif kind == "[" and path in self.item_targets:
+                self.counts[self.item_targets[path]] += 1
+
+    def feed(self, data: bytes):
+        self.counts["response_bytes"] += len(data)
+        self.buffer += self.decoder.decode(data)
+        if len(self.buffer) >= self.retry_at:
+            self.scan()
+
+    def close(self):
+        """Finish the body, raising a ValueError if it was cut short or a TrapiError if its message has errors."""
+        self.buffer += self.decoder.decode(b"", final=True)
+        self.scan(final=True)
+        if self.stack or self.buffer.strip():
+            raise ValueError("Incomplete JSON response body")
+        if self.errors:
+            raise TrapiError(f"Response has {self.errors} errors")
+
+    def scan(self, final: bool = False):
+        buffer = self.buffer
+        length = len(buffer)
+        ndx = 0
+        while True:
+            ndx = WHITESPACE.match(buffer, ndx).end()
+            if ndx >= length:
+                break
+            char = buffer[ndx]
+            frame = self.stack[-1] if self.stack else None
+            if char == "}" or char == "]":
+                self.stack.pop()
+                ndx += 1
+            elif char == ",":
+                if frame[0] == "{":
+                    frame[2] = True
+                ndx += 1
+            elif char == ":":
+                frame[2] = False
+                ndx += 1
+            elif frame is not None and frame[0] == "{" and frame[2]:
+                try:
+                    key, end = json.decoder.scanstring(buffer, ndx + 1)
+                except ValueError:
+                    break
+                frame[3] = key
+                if frame[1] in self.key_targets:
+                    self.counts[self.key_targets[frame[1]]] += 1
+                ndx = end
+            elif (char == "{" or char == "[") and len(self.stack) < self.max_depth:
+                self.count_value()
+                self.stack.append([char, self.child_path(), char == "{", None])
+                ndx += 1
+            else:
+                try:
+                    _, end = self.scan_once(buffer, ndx)
+                except (StopIteration, ValueError):
+                    if final:
+                        raise ValueError("Invalid JSON response body")
+                    break
+                if not final and (end >= length or buffer[end] not in VALUE_END):
+                    # a number or literal might carry on in the next chunk
+                    break
+                self.count_value()
+                ndx = end
+        self.buffer = buffer[ndx:]
+        self.retry_at = 2 * len(self.buffer)
+
+
+def empty_counts() -> Dict[str, int]:
+    """Counts for a response that never arrived."""
+    return {
+        "num_results": 0,
+        "num_nodes": 0,
+        "num_edges": 0,
+        "response_bytes": 0,
+    }
+
+
+def count_trapi(response: dict, results_path: Tuple[str, ...] = RESULTS_PATH, knowledge_graph_path: Tuple[str, ...] = KNOWLEDGE_GRAPH_PATH) -> Dict[str, int]:
+    """Count results, nodes and edges of a fully decoded TRAPI response."""
+    results = response
+    for key in results_path:
+        results = (results or {}).get(key)
+    knowledge_graph = response
+    for key in knowledge_graph_path:
+        knowledge_graph = (knowledge_graph or {}).get(key)
+    knowledge_graph = knowledge_graph or {}
+    return {
+        "num_results": len(results or []),
+        "num_nodes": len(knowledge_graph.get("nodes") or {}),
+        "num_edges": len(knowledge_graph.get("edges") or {}),
+    }
+
+
+def check_errors(response: dict, results_path: Tuple[str, ...] = RESULTS_PATH):
+    """Raise a TrapiError if a fully decoded TRAPI response's message, the results' parent, has errors."""
+    message = response
+    for key in results_path[:-1]:
+        message = (message or {}).get(key)
+    errors = (message or {}).get("errors")
+    if errors:
+        raise TrapiError(f"Response has errors: {errors}")
+
+
+def load_json(body: bytes, json_library: str = "json") -> Any:
+    if json_library == "orjson":
+        import orjson
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def count_body(
+    body: bytes,
+    stream: bool,
+    json_library: str = "json",
+    results_path: Tuple[str, ...] = RESULTS_PATH,
+    knowledge_graph_path: Tuple[str, ...] = KNOWLEDGE_GRAPH_PATH,
+) -> Tuple[Dict[str, int], float]:
+    """Count what is in a whole response body, giving back the counts and the seconds it took. Runs in the decode pool."""
+    start_time = time.perf_counter()
+    if stream:
+        counter = TrapiCounter(results_path, knowledge_graph_path)
+        view = memoryview(body)
+        for offset in range(0, len(body), CHUNK_SIZE):
+            counter.feed(bytes(view[offset : offset + CHUNK_SIZE]))
+        counter.close()
+        counts = counter.counts
+    else:
+        decoded = load_json(body, json_library)
+        check_errors(decoded, results_path)
+        counts = count_trapi(decoded, results_path, knowledge_graph_path)
+        counts["response_bytes"] = len(body)
+    return counts, time.perf_counter() - start_time
+
+
+class TrapiReader:
+    """
+    Reads TRAPI response bodies either incrementally or by fully decoding them.
+
+    Decoding normally happens on the event loop as the body comes in, which holds
+    up every other request in flight for as long as a big body takes. With
+    decode_in "thread" or "process" the body is downloaded whole and handed to a
+    pool instead, so the loop only waits on the network. Threads still share the
+    GIL: they help the incremental counter, which lets go of it between values,
+    but a full json.loads (or orjson) holds it until it's done, so full parsing
+    wants processes. Time spent decoding in the pool is the decode phase, time
+    waiting for a free worker is decode_wait.
+    """
+
+    def __init__(self, stream: bool = True):
+        self.stream = stream
+        self.decode_in = "loop"
+        self.json_library = "json"
+        self.executor: Optional[Executor] = None
+
+    def configure(self, args: argparse.Namespace):
+        self.stream = args.response_parsing == "stream"
+        self.decode_in = args.decode_in
+        self.json_library = args.json_library
+        if self.json_library == "orjson":
+            try:
+                import orjson  # noqa: F401
+            except ImportError:
+                raise SystemExit("--json_library orjson requires orjson: pip install orjson")
+        if self.decode_in == "thread":
+            self.executor = ThreadPoolExecutor(args.decode_workers, thread_name_prefix="decode")
+        elif self.decode_in == "process":
+            self.executor = ProcessPoolExecutor(args.decode_workers)
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            "parsing": "stream" if self.stream else "full",
+            "decode_in": self.decode_in,
+            "json_library": self.json_library,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def chunks(self, response: httpx.Response, decompressor: Optional[Any] = None) -> AsyncIterator[bytes]:
+        """Iterate over a response body, undoing its content encoding with decompressor instead of httpx when given one."""
+        if decompressor is None:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+            return
+        async for chunk in response.aiter_raw():
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+    async def body(self, response: httpx.Response, decompressor: Optional[Any] = None) -> bytes:
+        if decompressor is None:
+            return await response.aread()
+        return b"".join([chunk async for chunk in self.chunks(response, decompressor)])
+
+    async def read(
+        self,
+        response: httpx.Response,
+        timer: Optional[RequestTimer] = None,
+        results_path: Tuple[str, ...] = RESULTS_PATH,
+        knowledge_graph_path: Tuple[str, ...] = KNOWLEDGE_GRAPH_PATH,
+        decompressor: Optional[Any] = None,
+    ) -> Dict[str, int]:
+        """Read a streamed response body and count what is in it, adding the parsing time to the timer."""
+        decode_time = 0.0
+        if self.executor is not None:
+            body = await self.body(response, decompressor)
+            start_time = time.perf_counter()
+            counts, decode_time = await asyncio.get_running_loop().run_in_executor(
+                self.executor, count_body, body, self.stream, self.json_library, results_path, knowledge_graph_path,
+            )
+            if timer is not None:
+                timer.decode_wait = (timer.decode_wait or 0.0) + max(time.perf_counter() - start_time - decode_time, 0)
+                timer.decode_time += decode_time
+            return counts
+        if self.stream:
+            counter = TrapiCounter(results_path, knowledge_graph_path)
+            async for chunk in self.chunks(response, decompressor):
+                start_time = time.perf_counter()
+                counter.feed(chunk)
+                decode_time += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            counter.close()
+            decode_time += time.perf_counter() - start_time
+            counts = counter.counts
+        else:
+            body = await self.body(response, decompressor)
+            start_time = time.perf_counter()
+            decoded = load_json(body, self.json_library)
+            decode_time = time.perf_counter() - start_time
+            check_errors(decoded, results_path)
+            counts = count_trapi(decoded, results_path, knowledge_graph_path)
+            counts["response_bytes"] = len(body)
+        if timer is not None:
+            timer.decode_time += decode_time
+            if self.stream:
+                timer.streamed_decode_time += decode_time
+        return counts
+
+    def read_sync(
+        self,
+        response: httpx.Response,
+        timer: Optional[RequestTimer] = None,
+        results_path: Tuple[str, ...] = RESULTS_PATH,
+        knowledge_graph_path: Tuple[str, ...] = KNOWLEDGE_GRAPH_PATH,
+        deadline: Optional[SyncDeadline] = None,
+    ) -> Dict[str, int]:
+        """Read a streamed response body and count what is in it, synchronously, checking deadline between reads."""
+        def chunks() -> Iterator[bytes]:
+            for chunk in response.iter_bytes():
+                if deadline is not None:
+                    deadline.check()
+                yield chunk
+
+        decode_time = 0.0
+        if self.stream:
+            counter = TrapiCounter(results_path, knowledge_graph_path)
+            for chunk in chunks():
+                start_time = time.perf_counter()
+                counter.feed(chunk)
+                decode_time += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            counter.close()
+            decode_time += time.perf_counter() - start_time
+            counts = counter.counts
+        else:
+            body = b"".join(chunks())
+            start_time = time.perf_counter()
+            decoded = load_json(body, self.json_library)
+            check_errors(decoded, results_path)
+            counts = count_trapi(decoded, results_path, knowledge_graph_path)
+            decode_time = time.perf_counter() - start_time
+            counts["response_bytes"] = len(body)
+        if timer is not None:
+            timer.decode_time += decode_time
+            if self.stream:
+                timer.streamed_decode_time += decode_time
+        return counts
+
+
+def add_trapi_stream_arguments(parser: argparse.ArgumentParser):
+    """Add the response parsing command line arguments."""
+    parser.add_argument(
+        "--response_parsing",
+        type=str,
+        choices=["stream", "full"],
+        help="Count results while streaming the body, or decode the whole body first",
+        default="stream",
+    )
+    parser.add_argument(
+        "--decode_in",
+        type=str,
+        choices=DECODE_IN,
+        help="Decode response bodies on the event loop, or hand them to a thread or process pool so big bodies don't stall other requests",
+        default="loop",
+    )
+    parser.add_argument("--decode_workers", type=int, help="Threads or processes in the decode pool, the CPU count by default", default=None)
+    parser.add_argument("--json_library", type=str, choices=JSON_LIBRARIES, help="JSON library for full parsing, orjson needs pip install orjson", default="json")